@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+
+import pytest
+
+from dropshare import tools
+
+from conftest import dropshare_app, run_filter, hexdigest
+
+@pytest.fixture
+def sample(make_repo):
+    synthetic = make_repo()
+    fname, data = sorted(synthetic.contents.items())[0]
+    return synthetic, fname, data
+
+def bench_clean_content(benchmark, sample):
+    synthetic, fname, data = sample
+    synthetic.materialize()
+    try:
+        with dropshare_app(synthetic.work) as app:
+            output = benchmark(run_filter, app, 'ds_filter_clean', data, fname)
+    finally:
+        synthetic.dematerialize()
+    assert output == tools.DS_WRITE(hexdigest(data), fname)
+
+def bench_clean_stub(benchmark, sample):
+    synthetic, fname, data = sample
+    stub = tools.DS_WRITE(hexdigest(data), fname)
+    with dropshare_app(synthetic.work) as app:
+        assert benchmark(run_filter, app, 'ds_filter_clean', stub, fname) == stub
+
+def bench_smudge_cached(benchmark, sample):
+    synthetic, fname, data = sample
+    digest = hexdigest(data)
+    with dropshare_app(synthetic.work) as app:
+        with open(os.path.join(app.obj_directory, digest), 'wb') as stream:
+            stream.write(data)
+        output = benchmark(run_filter, app, 'ds_filter_smudge', tools.DS_WRITE(digest, fname), fname)
+    synthetic.clear_cache()
+    assert output == data
+
+def bench_smudge_missing(benchmark, sample):
+    synthetic, fname, data = sample
+    synthetic.clear_cache()
+    stub = tools.DS_WRITE(hexdigest(data), fname)
+    with dropshare_app(synthetic.work) as app:
+        assert benchmark(run_filter, app, 'ds_filter_smudge', stub, fname) == stub
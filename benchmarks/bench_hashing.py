@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+
+import pytest
+
+from dropshare import tools
+from dropshare.store import DropboxContentHasher
+
+from conftest import payload
+
+SIZES = [64 * 1024, 4 * 1024 * 1024, 32 * 1024 * 1024]
+
+@pytest.fixture(params=SIZES, ids=lambda size: f'{size // 1024}KiB')
+def sample(request, tmp_path):
+    path = tmp_path / 'sample.bin'
+    path.write_bytes(payload(request.param, request.param))
+    return str(path)
+
+def bench_hash_file(benchmark, sample):
+    benchmark(tools.hash_file, sample, DropboxContentHasher())
+    benchmark.extra_info['bytes'] = os.path.getsize(sample)
+
+@pytest.mark.parametrize('size', SIZES, ids=lambda size: f'{size // 1024}KiB')
+def bench_hasher_update(benchmark, size):
+    data = payload(size, size)
+    def run():
+        hasher = DropboxContentHasher()
+        hasher.update(data)
+        return hasher.hexdigest()
+    benchmark(run)
+    benchmark.extra_info['bytes'] = size
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+import datetime
+
+import pytest
+
+from dropshare.store import HashTable
+
+from conftest import dropshare_app, ENTRIES, FILES, COMMITS, NOTES
+
+@pytest.fixture(scope='module')
+def hash_table_dir(tmp_path_factory):
+    gitdir = tmp_path_factory.mktemp('gitdir')
+    os.makedirs(gitdir / 'dropshare')
+    table = HashTable(str(gitdir))
+    modified = datetime.datetime(2018, 1, 1)
+    for index in range(ENTRIES):
+        digest = f'{index:064x}'
+        table.hash_table['files'][f'{digest[:2]}/{digest[2:4]}/{digest}'] = {
+            'id': f'id:{index:012d}', 'rev': f'{index:09x}', 'size': index,
+            'modified': modified, 'sharing_info': None}
+    table.save()
+    return str(gitdir)
+
+def bench_hash_table_load(benchmark, hash_table_dir):
+    files = benchmark(lambda: HashTable(hash_table_dir).hash_table['files'])
+    assert len(files) == ENTRIES
+
+def bench_index_exists(benchmark, hash_table_dir):
+    digest = f'{ENTRIES // 2:064x}'
+    obj = f'{digest[:2]}/{digest[2:4]}/{digest}'
+    assert benchmark(lambda: HashTable(hash_table_dir).index.contains_obj(obj))
+
+def bench_hash_table_save(benchmark, hash_table_dir):
+    table = HashTable(hash_table_dir)
+    benchmark(table.save)
+
+def bench_filtered_by_attributes(benchmark, make_repo):
+    synthetic = make_repo()
+    with dropshare_app(synthetic.work) as app:
+        items = benchmark(lambda: list(app.filtered_by_attributes([])))
+    assert len(items) == FILES
+
+def bench_manifest(benchmark, make_repo):
+    synthetic = make_repo(files=FILES, commits=COMMITS, notes=NOTES)
+    sha, _ = synthetic.stubs()[0]
+    with dropshare_app(synthetic.work) as app:
+        lines = benchmark(lambda: list(app.ds_manifest(sha, reverse=True)))
+    assert len(lines) == NOTES
+
+def bench_log(benchmark, make_repo):
+    synthetic = make_repo(files=FILES, commits=COMMITS, notes=NOTES)
+    _, fname = synthetic.stubs()[0]
+    with dropshare_app(synthetic.work, _paths=[fname]) as app:
+        benchmark(app.ds_log)
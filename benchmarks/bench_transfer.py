@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Push and pull of a whole synthetic repository against a local storage
+area, so the figures reflect dropshare itself rather than the network."""
+
+from conftest import dropshare_app, FILES, SIZE
+
+def bench_push(benchmark, make_repo):
+    synthetic = make_repo()
+    def setup():
+        synthetic.clear_area()
+        synthetic.clear_notes()
+        synthetic.materialize()
+    try:
+        with dropshare_app(synthetic.work) as app:
+            benchmark.pedantic(app.ds_push, setup=setup, rounds=3)
+    finally:
+        synthetic.dematerialize()
+        synthetic.fill_area()
+    benchmark.extra_info['bytes'] = FILES * SIZE
+
+def bench_pull_cold(benchmark, make_repo):
+    """Empty cache: every object is fetched then checked out."""
+    synthetic = make_repo()
+    def setup():
+        synthetic.clear_cache()
+        synthetic.dematerialize()
+    with dropshare_app(synthetic.work) as app:
+        benchmark.pedantic(app.ds_pull, setup=setup, rounds=3)
+    benchmark.extra_info['bytes'] = FILES * SIZE
+
+def bench_pull_warm(benchmark, make_repo):
+    """Objects already cached: only the re-checkout of the stubs remains."""
+    synthetic = make_repo()
+    def setup():
+        synthetic.dematerialize()
+        synthetic.fill_cache()
+    with dropshare_app(synthetic.work) as app:
+        benchmark.pedantic(app._checkout, setup=setup, rounds=3)
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Synthetic repositories for the benchmark suite.
+
+Sizes are tuned through the environment: DS_BENCH_FILES (tracked files per
+repository), DS_BENCH_SIZE (bytes per file), DS_BENCH_COMMITS (history depth),
+DS_BENCH_NOTES (notes lines per blob) and DS_BENCH_ENTRIES (hash table size).
+Every repository uses a local storage area, so no network is involved."""
+
+import io
+import os
+import sys
+import random
+import shutil
+import subprocess
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+import pytest
+
+from dropshare import tools, repo, front
+from dropshare.back import Backend
+from dropshare.store import DropboxContentHasher
+
+pytest_plugins = ['dropshare.fakebox']
+
+FILES = int(os.environ.get('DS_BENCH_FILES', 200))
+SIZE = int(os.environ.get('DS_BENCH_SIZE', 64 * 1024))
+COMMITS = int(os.environ.get('DS_BENCH_COMMITS', 10))
+NOTES = int(os.environ.get('DS_BENCH_NOTES', 20))
+ENTRIES = int(os.environ.get('DS_BENCH_ENTRIES', 100000))
+
+def git(cwd: str, *args: str, data: bytes = None) -> str:
+    return subprocess.run(['git', *args], cwd=cwd, input=data, check=True,
+                          stdout=subprocess.PIPE).stdout.decode()
+
+def payload(size: int, seed) -> bytes:
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+def hexdigest(data: bytes) -> str:
+    hasher = DropboxContentHasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+class SyntheticRepo(object):
+    """Work tree, bare origin and local storage area under a single root.
+
+    The history holds `commits` commits; the first one adds `files` tracked
+    files, each of the next ones rewrites a single file. Every stub blob gets
+    `notes` lines in refs/notes/dropshare."""
+
+    def __init__(self, root: str, files: int, size: int, commits: int = 1, notes: int = 1):
+        self.root = root
+        self.work = os.path.join(root, 'work')
+        self.origin = os.path.join(root, 'origin.git')
+        self.area = os.path.join(root, 'area')
+        self.contents = dict()  # type: Dict[str, bytes]
+        os.makedirs(self.work)
+        git(root, 'init', '-q', '--bare', self.origin)
+        git(root, 'init', '-q', self.work)
+        for key, val in (('user.name', 'bench'), ('user.email', 'bench@localhost'),
+                         ('remote.origin.url', self.origin),
+                         ('remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'),
+                         ('dropshare.account', 'bench'),
+                         ('dropshare.bench.backend', 'local'),
+                         ('dropshare.bench.root-path', self.area)):
+            git(self.work, 'config', key, val)
+        with open(os.path.join(self.work, '.gitattributes'), 'wt') as stream:
+            stream.write('*.bin filter=dropshare\n')
+        for commit in range(commits):
+            indices = range(files) if commit == 0 else [commit % files]
+            for index in indices:
+                self.write_stub(f'data/{index // 100:03d}/file{index:05d}.bin', payload(size, f'{commit}-{index}'))
+            git(self.work, 'add', '-A')
+            git(self.work, 'commit', '-q', '-m', f'commit {commit}')
+        if notes:
+            self.write_notes(notes)
+        # filters are only declared once the stubs are committed
+        for val in ('clean', 'smudge'):
+            git(self.work, 'config', f'filter.dropshare.{val}', f'git-ds filter-{val} -f %f')
+        git(self.work, 'push', '-q', 'origin', 'HEAD', repo.Repo.DS_REF_NOTES)
+
+    def write_stub(self, fname: str, data: bytes):
+        path = os.path.join(self.work, fname)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        digest = hexdigest(data)
+        self.contents[fname] = data
+        self.store_object(digest, data)
+        with open(path, 'wb') as stream:
+            stream.write(tools.DS_WRITE(digest, fname))
+
+    def store_object(self, digest: str, data: bytes):
+        with Backend.data_location(digest) as obj:
+            location = os.path.join(self.area, *obj.split('/'))
+        os.makedirs(os.path.dirname(location), exist_ok=True)
+        with open(location, 'wb') as stream:
+            stream.write(data)
+
+    def stubs(self) -> List[Tuple[str, str]]:
+        """(blob sha, path) for every tracked file at HEAD."""
+        lines = git(self.work, 'ls-tree', '-r', 'HEAD').splitlines()
+        return [(meta.split(' ')[2], fname) for meta, fname in (x.split('\t') for x in lines)
+                if fname.endswith('.bin')]
+
+    def write_notes(self, count: int):
+        """Bulk notes through fast-import, git notes append is far too slow."""
+        blobs = git(self.work, 'rev-list', '--objects', '--all').splitlines()
+        stream = io.BytesIO()
+        stream.write(b'commit refs/notes/dropshare\n'
+                     b'committer bench <bench@localhost> 1500000000 +0000\ndata 0\n')
+        for line in blobs:
+            sha, _, fname = line.partition(' ')
+            if not fname.endswith('.bin'):
+                continue
+            text = ''.join(f'{1500000000 + i}\t{"push" if i == 0 else "pull"}\t{"0" * 64}\t{fname}\tbench\n'
+                           for i in range(count)).encode()
+            stream.write(f'N inline {sha}\ndata {len(text)}\n'.encode() + text + b'\n')
+        git(self.work, 'fast-import', '--quiet', data=stream.getvalue())
+
+    def materialize(self):
+        """Replace the stubs of the work tree by their actual content."""
+        for fname, data in self.contents.items():
+            with open(os.path.join(self.work, fname), 'wb') as stream:
+                stream.write(data)
+
+    def dematerialize(self):
+        """Put the stubs back in the work tree."""
+        for fname, data in self.contents.items():
+            with open(os.path.join(self.work, fname), 'wb') as stream:
+                stream.write(tools.DS_WRITE(hexdigest(data), fname))
+
+    @property
+    def cache(self) -> str:
+        return os.path.join(self.work, '.git', 'dropshare', 'objects')
+
+    def fill_cache(self):
+        os.makedirs(self.cache, exist_ok=True)
+        for data in self.contents.values():
+            with open(os.path.join(self.cache, hexdigest(data)), 'wb') as stream:
+                stream.write(data)
+
+    def clear_cache(self):
+        for name in os.listdir(self.cache) if os.path.isdir(self.cache) else []:
+            os.unlink(os.path.join(self.cache, name))
+
+    def fill_area(self):
+        for data in self.contents.values():
+            self.store_object(hexdigest(data), data)
+
+    def clear_area(self):
+        shutil.rmtree(self.area, ignore_errors=True)
+        table = os.path.join(self.work, '.git', 'dropshare', 'hash_table.yml')
+        if os.path.exists(table):
+            os.unlink(table)
+
+    def clear_notes(self):
+        for where in (self.work, self.origin):
+            subprocess.run(['git', 'update-ref', '-d', repo.Repo.DS_REF_NOTES], cwd=where)
+
+@pytest.fixture(scope='session', autouse=True)
+def git_ds_on_path(tmp_path_factory):
+    """The filters run `git-ds`: make sure it resolves to this source tree."""
+    bindir = tmp_path_factory.mktemp('bin')
+    script = bindir / 'git-ds'
+    script.write_text(f'#!{sys.executable}\n'
+                      f'import sys\nsys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})\n'
+                      'from dropshare import main\nsys.exit(main())\n')
+    script.chmod(0o755)
+    previous = os.environ['PATH']
+    os.environ['PATH'] = f'{bindir}{os.pathsep}{previous}'
+    yield str(bindir)
+    os.environ['PATH'] = previous
+
+_REPOS = dict()  # type: Dict[Tuple, SyntheticRepo]
+
+@pytest.fixture(scope='session')
+def make_repo(tmp_path_factory):
+    """Factory of synthetic repositories, cached by shape across the session."""
+    def factory(files: int = FILES, size: int = SIZE, commits: int = 1, notes: int = 1) -> SyntheticRepo:
+        key = (files, size, commits, notes)
+        if key not in _REPOS:
+            root = str(tmp_path_factory.mktemp(f'repo-{files}x{size}-{commits}-{notes}'))
+            _REPOS[key] = SyntheticRepo(root, files, size, commits, notes)
+        return _REPOS[key]
+    return factory
+
+@contextmanager
+def dropshare_app(path: str, **args):
+    """Fresh front.Dropshare instance run from path, with its CLI arguments."""
+    cwd = os.getcwd()
+    defaults = dict((key, getattr(front.Dropshare, key)) for key in args)
+    repo.Repo._Repo__instance = None
+    os.chdir(path)
+    try:
+        for key, val in args.items():
+            setattr(front.Dropshare, key, val)
+        yield front.Dropshare()
+    finally:
+        for key, val in defaults.items():
+            setattr(front.Dropshare, key, val)
+        repo.Repo._Repo__instance = None
+        os.chdir(cwd)
+
+def run_filter(app: front.Dropshare, method: str, data: bytes, fname: str) -> bytes:
+    """Feed data to a filter as git would, returning its output."""
+    stdin, stdout = sys.stdin, sys.stdout
+    output = io.BytesIO()
+    sys.stdin = io.TextIOWrapper(io.BytesIO(data))
+    sys.stdout = io.TextIOWrapper(output, write_through=True)
+    try:
+        app._filename = fname
+        getattr(app, method)()
+        sys.stdout.flush()
+        return output.getvalue()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
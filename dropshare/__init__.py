@@ -8,11 +8,16 @@
 # If not, see http://www.gnu.org/licenses/gpl-3.0.html
 
 import sys
+import time
 import argparse
 from contextlib import contextmanager
 from typing import Iterator
 
-from . import front, store, git
+_IMPORT_START = time.perf_counter()
+
+from . import front, store, git, metrics, profiling
+
+metrics.observe('import', time.perf_counter() - _IMPORT_START)
 
 __version__ = '0.1.4'
 __author__ = 'Philippe Audebaud <paudebau@gmail.com>'
@@ -27,6 +32,8 @@ class Parser:
         self.parser.add_argument('-C', dest='_repository', metavar="REPOSITORY",
                                  action='store', default='.',
                                  help='git working repository')
+        self.parser.add_argument('--stats', dest='_stats', action='store_true',
+                                 help='print transfer, request and git metrics on exit')
         self.subparser = self.parser.add_subparsers()
 
     def help(self):
@@ -49,26 +56,55 @@ def main():
     with p.action('track', help='add pattern to set of tracked files') as cmd:
         cmd.add_argument('_match', nargs=1, metavar='PATTERN', help='file pattern')
         cmd.set_defaults(call=front.Dropshare.ds_track)
+    with p.action('add', help='hash and stage many files at once (git add)') as cmd:
+        cmd.add_argument('_paths', nargs='+', metavar='PATHS')
+        cmd.set_defaults(call=front.Dropshare.ds_add)
+    with p.action('migrate', help='rewrite history, storing matching files with dropshare') as cmd:
+        cmd.add_argument('--include', dest='_include', action='append', required=True, metavar='PATTERN',
+                         help='file pattern (repeatable)')
+        cmd.add_argument('--yes', dest='_yes', action='store_true',
+                         help='confirm the rewrite (old tips are kept under refs/dropshare/original/)')
+        cmd.set_defaults(call=front.Dropshare.ds_migrate)
     with p.action('push', help='upload tracked files to Dropbox shared folder') as cmd:
         cmd.add_argument('_match', nargs='*', metavar='PATTERN', help='limit push by pattern(s)')
         cmd.set_defaults(call=front.Dropshare.ds_push)
     with p.action('pull', help='download tracked files from Dropbox shared folder') as cmd:
         cmd.add_argument('_match', nargs='*', metavar='PATTERN', help='limit pull by pattern(s)')
+        cmd.add_argument('--ignore-policy', dest='_ignore_policy', action='store_true',
+                         help='ignore dropshare.fetch* settings')
         cmd.set_defaults(call=front.Dropshare.ds_pull)
     with p.action('fetch', help='fetch and merge notes from a remote repository') as cmd:
-        cmd.add_argument('_remote', nargs=1, metavar='REMOTE', help='fetch dropshare notes from remote')
+        cmd.add_argument('_remote', nargs='?', metavar='REMOTE', help='fetch dropshare notes from remote')
+        cmd.add_argument('--all', dest='_all', action='store_true', help='fetch dropshare notes from all remotes')
         cmd.set_defaults(call=front.Dropshare.ds_fetch)
+    with p.action('prefetch', help='download the objects a checkout of REV would need') as cmd:
+        cmd.add_argument('_rev', nargs='?', metavar='REV', help='target revision (default: @{upstream})')
+        cmd.add_argument('--ignore-policy', dest='_ignore_policy', action='store_true',
+                         help='ignore dropshare.fetch* settings')
+        cmd.set_defaults(call=front.Dropshare.ds_prefetch)
     with p.action('filter-clean', help='clean stdin stream ') as cmd:
         cmd.add_argument('-f', dest='_filename', action='store', metavar='PATH', default='stdin')
         cmd.set_defaults(call=front.Dropshare.ds_filter_clean)
     with p.action('filter-smudge', help='smudge sdin stream') as cmd:
         cmd.add_argument('-f', dest='_filename', action='store', metavar='PATH', default='stdin')
         cmd.set_defaults(call=front.Dropshare.ds_filter_smudge)
+    with p.action('filter-process', help='long running clean/smudge filter (filter.<driver>.process)') as cmd:
+        cmd.set_defaults(call=front.Dropshare.ds_filter_process)
     with p.action('delta', help='index dropshare storage area') as cmd:
         cmd.set_defaults(call=front.Dropshare.ds_delta)
     with p.action('log', help='dump history from dropshare notes') as cmd:
         cmd.add_argument('_paths', nargs='+', metavar='FILES')
         cmd.set_defaults(call=front.Dropshare.ds_log)
+    with p.action('verify', help='check stored and cached objects against their hashes, downloading nothing') as cmd:
+        cmd.set_defaults(call=front.Dropshare.ds_verify)
+    with p.action('fsck', help='rehash the local cache, quarantine corrupt objects, report dangling and missing ones') as cmd:
+        cmd.set_defaults(call=front.Dropshare.ds_fsck)
+    with p.action('notes-compact', help='collapse redundant pull events in dropshare notes') as cmd:
+        cmd.set_defaults(call=front.Dropshare.ds_notes_compact)
+    with p.action('profile-report', help=f'aggregate {profiling.PROFILE_ENV} records') as cmd:
+        cmd.add_argument('_directory', nargs='?', metavar='DIRECTORY',
+                         help=f'profile directory (default: ${profiling.PROFILE_ENV})')
+        cmd.set_defaults(call=front.Dropshare.ds_profile_report)
 
     try:
         _ = p.parser.parse_args(namespace=front.Dropshare)
@@ -76,10 +112,21 @@ def main():
         p.help()
         sys.exit(1)
 
-    app = front.Dropshare()
-    if hasattr(app, 'call'):
-        sys.exit(app.call())
-    else:
-        p.help()
+    # commands needing no repository are class methods, run without an app
+    if getattr(getattr(front.Dropshare, 'call', None), '__self__', None) is front.Dropshare:
+        sys.exit(front.Dropshare.call())
+
+    status = None
+    with profiling.profile(front.Dropshare.call.__name__):
+        with metrics.timer('Backend.__init__'):
+            app = front.Dropshare()
+        if hasattr(app, 'call'):
+            try:
+                status = app.call()
+            finally:
+                app.ds_metrics(app.call.__name__)
+        else:
+            p.help()
+    sys.exit(status)
 
-__all__ = ['main', 'store', 'git']
+__all__ = ['main', 'store', 'git', 'metrics', 'profiling']
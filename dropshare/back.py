@@ -7,13 +7,21 @@
 # You should have received a copy of the license with the software.
 # If not, see http://www.gnu.org/licenses/gpl-3.0.html
 
+import io
+import os
 import posixpath # for Dropbox API
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import Tuple, Generator, Optional, Dict, IO
+from typing import Tuple, Generator, Optional, Dict, IO, List, Iterable, Set
 
 from .git import GitCommandError
-from .store import DropboxContentHasher, Storage
-from . import tools, repo
+from .store import DropboxContentHasher, ObjectStore, Storage
+from .local import LocalStorage
+from . import tools, repo, metrics, chunks, codecs, policy, packs
+from .index import obj_digest
+from .statcache import StatCache
 
 class BackendException(Exception):
     def __init__(self, message):
@@ -24,18 +32,40 @@ class Backend(repo.Repo):
     """dropshare backend"""
 
     store = False # type: bool
-    dbx = None # type: Optional[Storage]
+    dbx = None # type: Optional[ObjectStore]
 
     def __init__(self):
         super().__init__()
         self.hasher = DropboxContentHasher
-        if tools.reachable():
+        if self.backend_kind() == 'local':
+            self._connect_local()
+        elif tools.reachable():
             self._connect_dropbox()
         else:
             tools.Console.info('Unable to connect Dropbox servers.')
             self.store = False
 
+    DS_BACKENDS = ('dropbox', 'local')
     DS_KEYS = ('root-path', 'token')
+    DS_LOCAL_KEYS = ('root-path', 'backend')
+
+    def backend_kind(self, tag: Optional[str] = None) -> str:
+        """Storage backend of the account, set by dropshare.<tag>.backend."""
+        if tag is None:
+            tag = self.git_config('dropshare.account')
+        if tag is None:
+            return 'dropbox'
+        return self.git_config(f'dropshare.{tag}.backend', default='dropbox')
+
+    def _connect_local(self):
+        tag = self.git_config('dropshare.account')
+        root_path = self.git_config(f'dropshare.{tag}.root-path')
+        if root_path is None:
+            root_path, _ = self.set_credentials()
+        transfer = self.git_config(f'dropshare.{tag}.transfer', default='copy')
+        self.dbx = LocalStorage(self.git_directory, root_path, transfer)
+        self.store = self.dbx is not None
+
     def _connect_dropbox(self):
         tag, root_path, token = None, '', None
         try:
@@ -45,8 +75,19 @@ class Backend(repo.Repo):
         except GitCommandError:
             root_path, token = self.set_credentials()
         finally:
-            self.dbx = Storage(self.git_directory, root_path, token)
-            self.store = self.dbx is not None
+            if self.backend_kind() == 'local':
+                self._connect_local()
+            else:
+                self.dbx = Storage(self.git_directory, root_path, token)
+                self.store = self.dbx is not None
+                for kind, limiter in self.dbx.limits.items():
+                    limiter.maximum = self.transfer_jobs(kind)
+                    limiter.limit = min(limiter.limit, limiter.maximum)
+
+    def transfer_jobs(self, kind: str) -> int:
+        """Maximum concurrent reads (dropshare.readJobs, 8) or writes (dropshare.writeJobs, 4);
+        Dropbox requests adapt their actual concurrency below it."""
+        return max(1, int(self.ds_option(f'dropshare.{kind}Jobs', '8' if kind == 'read' else '4')))
 
     def set_credentials(self) -> Tuple[str, str]:
         data = self.list_credentials()
@@ -72,14 +113,35 @@ class Backend(repo.Repo):
             if tag and tag not in accounts:
                 break
         description = input(' * Short description: ')
+        backend = None
+        while backend not in Backend.DS_BACKENDS:
+            backend = input(' * Storage backend (dropbox/local) [dropbox]: ').strip() or 'dropbox'
+        self.git.config('--global', f'dropshare.{tag}.description', description)
+        self.git.config('--global', f'dropshare.{tag}.backend', backend)
+        if backend == 'local':
+            root_path = input(' * Storage directory (local or mounted path): ')
+            self.git.config('--global', f'dropshare.{tag}.root-path', root_path)
+            self.git.config('dropshare.account', tag)
+            return root_path, ''
         root_path = input(' * Share base path relative to Dropbox root: ')
         token = input(" * Dropbox access token: ")
-        self.git.config('--global', f'dropshare.{tag}.description', description)
         self.git.config('--global', f'dropshare.{tag}.root-path', root_path)
         self.git.config('--global', f'dropshare.{tag}.token', token)
         self.git.config('dropshare.account', tag)
         return root_path, token
 
+    _fetch_policy = None # type: Optional[policy.FetchPolicy]
+    @property
+    def fetch_policy(self) -> policy.FetchPolicy:
+        if self._fetch_policy is None:
+            recent = self.ds_option('dropshare.fetchRecent')
+            self._fetch_policy = policy.FetchPolicy(
+                self.ds_options('dropshare.fetchInclude'),
+                self.ds_options('dropshare.fetchExclude'),
+                policy.parse_size(self.ds_option('dropshare.fetchMaxSize')),
+                (lambda: self.git_recent_paths(int(recent))) if recent else None)
+        return self._fetch_policy
+
     @staticmethod
     @contextmanager
     def data_location(hexdigest: str) -> Generator[str, None, None]:
@@ -88,25 +150,506 @@ class Backend(repo.Repo):
         finally:
             pass
 
+    def data_size(self, hexdigest: str) -> Optional[int]:
+        with Backend.data_location(hexdigest) as obj:
+            located = self.dbx.locate(obj) if self.dbx is not None else None
+            if located:
+                return self.dbx.size(located)
+        entry = self.pack_index.find(hexdigest)
+        return entry[2] if entry else None
+
     def data_exists(self, hexdigest: str) -> bool:
         # tools.Console.info(f' * exists {hexdigest}?')
         with Backend.data_location(hexdigest) as obj:
-            return self.dbx.exists(obj)
+            return self.dbx.exists(obj) or self.pack_index.find(hexdigest) is not None
+
+    _copy_sources = None # type: Optional[List[Storage]]
+    _copy_lock = threading.Lock()
+    @property
+    def copy_sources(self) -> List[Storage]:
+        """Storage areas of the Dropbox accounts listed in dropshare.copyFrom
+        (other projects, forks): objects found there are copied server-side.
+        Their listings are those of the last sync_copy_sources()."""
+        with self._copy_lock:
+            if self._copy_sources is None:
+                self._copy_sources = []
+                own = self.git_config('dropshare.account')
+                for tag in self.ds_options('dropshare.copyFrom') if isinstance(self.dbx, Storage) else []:
+                    token = self.git_config(f'dropshare.{tag}.token')
+                    if tag == own or self.backend_kind(tag) != 'dropbox' or token is None:
+                        tools.Console.warning(f' \u2717 dropshare.copyFrom: {tag} is not another Dropbox account.')
+                        continue
+                    self._copy_sources.append(Storage(self.git_directory,
+                                                      self.git_config(f'dropshare.{tag}.root-path', default=''),
+                                                      token, area=tag))
+        return self._copy_sources
+
+    def sync_copy_sources(self):
+        """Bring the listings of the copy sources up to date."""
+        for source in self.copy_sources:
+            with metrics.timer('copy.sources.delta'):
+                source.delta()
+
+    def data_copy_shared(self, hexdigests: Iterable[str]) -> Set[str]:
+        """Copy server-side, from the copy sources, the objects missing here;
+        returns the hexdigests copied."""
+        copied = set() # type: Set[str]
+        wanted = list(dict.fromkeys(hexdigests))
+        for source in self.copy_sources:
+            objs = []
+            for hexdigest in wanted:
+                with Backend.data_location(hexdigest) as obj:
+                    # encoded objects depend on the settings of their project
+                    if hexdigest not in copied and source.exists(obj) and source.locate(obj) == obj:
+                        objs.append(obj)
+            if objs:
+                with metrics.timer('copy.shared'):
+                    copied.update(posixpath.basename(x) for x in self.dbx.copy_from(source, objs))
+        return copied
+
+    _pack_index = None # type: Optional[packs.PackIndex]
+    @property
+    def pack_index(self) -> packs.PackIndex:
+        if self._pack_index is None:
+            location = os.path.join(self.git_directory, 'dropshare', packs.PACK_DIR)
+            os.makedirs(location, exist_ok=True)
+            self._pack_index = packs.PackIndex(location)
+        return self._pack_index
+
+    def sync_pack_indexes(self) -> int:
+        """Mirror the pack indexes of the storage area missing from the cache."""
+        missing = [x for x in map(packs.pack_id_of, self.dbx.hash_table['files'])
+                   if x is not None and not self.pack_index.known(x)]
+        for pack_id in missing:
+            with tempfile.NamedTemporaryFile(dir=self.pack_index.directory, suffix='.tmp') as stream:
+                if not self.dbx.download(stream, packs.index_obj(pack_id), pack_id):
+                    raise BackendException(f' \u2717 fails to download pack index {pack_id}.')
+                with open(stream.name, 'rb') as index_stream:
+                    self.pack_index.add(index_stream.read())
+        return len(missing)
+
+    def pack_threshold(self) -> Optional[int]:
+        """Files smaller than dropshare.packThreshold go to packs (unset: never)."""
+        return policy.parse_size(self.ds_option('dropshare.packThreshold'))
+
+    def data_push_packs(self, items: List[Tuple[str, str]]) -> int:
+        """Upload the (path, hexdigest) items in packs of dropshare.packSize
+        bytes at most (32 MiB by default); returns the number of packs."""
+        limit = policy.parse_size(self.ds_option('dropshare.packSize')) or 32 * 1024 * 1024
+        batches, batch, size = [], [], 0
+        for path, hexdigest in items:
+            length = os.path.getsize(path)
+            if batch and size + length > limit:
+                batches.append(batch)
+                batch, size = [], 0
+            batch.append((hexdigest, path))
+            size += length
+        if batch:
+            batches.append(batch)
+        for batch in batches:
+            with metrics.span('data_push_pack', objects=len(batch)):
+                try:
+                    pack_id, objects = packs.write_pack(self.pack_index.directory, batch, self.hasher)
+                except ValueError as exc:
+                    raise BackendException(f' \u2717 fails to pack: {exc}.')
+                index = packs.dump_index(pack_id, objects)
+                with open(self.pack_index.cached_pack(pack_id), 'rb') as in_stream:
+                    uploaded = self.dbx.upload(in_stream, packs.pack_obj(pack_id), pack_id)
+                if not uploaded or not self.dbx.upload(io.BytesIO(index), packs.index_obj(pack_id), pack_id):
+                    raise BackendException(f' \u2717 fails to upload pack {pack_id}.')
+                self.pack_index.add(index)
+                tools.Console.info(f' * pushed {len(objects)} objects in pack {pack_id[:12]}')
+        return len(batches)
+
+    def fetch_packs(self, hexdigests: Iterable[str]) -> int:
+        """Download whole the packs most of which is wanted, rather than ranges."""
+        selected = self.pack_index.whole_packs(hexdigests)
+        for pack_id in selected:
+            location = os.path.join(self.pack_index.directory, pack_id + packs.PACK_SUFFIX)
+            with open(f'{location}.{os.getpid()}.tmp', 'wb') as stream:
+                if not self.dbx.download(stream, packs.pack_obj(pack_id), pack_id):
+                    raise BackendException(f' \u2717 fails to download pack {pack_id}.')
+            os.replace(f'{location}.{os.getpid()}.tmp', location)
+        return len(selected)
+
+    def _pull_packed(self, out_stream: IO[bytes], entry: packs.Entry, hexdigest: str, path: str) -> bool:
+        pack_id, offset, length = entry
+        cached = self.pack_index.cached_pack(pack_id)
+        if cached is not None:
+            with open(cached, 'rb') as stream:
+                stream.seek(offset)
+                data = stream.read(length)
+            metrics.count('packs.cached')
+        else:
+            data = self.dbx.download_range(packs.pack_obj(pack_id), offset, length)
+            if data is None:
+                return False
+            metrics.count('packs.ranges')
+        hash_function = self.hasher()
+        hash_function.update(data)
+        if hash_function.hexdigest() != hexdigest:
+            raise BackendException(f' \u2717 packed {path} does not match {hexdigest}.')
+        out_stream.write(data)
+        out_stream.flush()
+        return True
+
+    _stat_cache = None # type: Optional[StatCache]
+    @property
+    def stat_cache(self) -> StatCache:
+        if self._stat_cache is None:
+            self._stat_cache = StatCache(os.path.join(self.git_directory, 'dropshare', 'stat_cache.json'))
+        return self._stat_cache
+
+    def _stored_hashes(self, objs: List[str]) -> Dict[str, Optional[str]]:
+        """content_hash of stored objects, as listed; listings older than
+        content hashes are done again, once, from scratch."""
+        files = self.dbx.hash_table['files']
+        if any(not files[x].get('content_hash') for x in objs):
+            with metrics.timer('verify.relist'):
+                self.dbx.relist()
+            files = self.dbx.hash_table['files']
+        return dict((obj, files.get(obj, dict()).get('content_hash')) for obj in objs)
+
+    def verify_store(self) -> Tuple[List[str], int]:
+        """Stored objects (plain ones and packs) whose content hash does not match
+        their name, without downloading anything: Dropbox lists content hashes,
+        a local store is rehashed in place. Returns (corrupt, checked)."""
+        files = self.dbx.hash_table['files']
+        named = dict() # type: Dict[str, str] # stored object -> expected hash
+        for obj in files:
+            pack_id = packs.pack_id_of(obj, packs.PACK_SUFFIX)
+            if pack_id is not None:
+                named[obj] = pack_id
+            elif obj_digest(obj) is not None and '.' not in posixpath.basename(obj):
+                named[obj] = posixpath.basename(obj)
+        if isinstance(self.dbx, LocalStorage):
+            digests = self.stat_cache.hash_files(self.dbx.remote_path(x) for x in named)
+            actual = dict((obj, digests[self.dbx.remote_path(obj)]) for obj in named)
+        else:
+            actual = self._stored_hashes(list(named))
+        corrupt = [obj for obj, hexdigest in named.items() if actual[obj] != hexdigest]
+        for pack_id in set(map(packs.pack_id_of, files)) - {None}:
+            entries = [x for x in self.pack_index.entries.values() if x[0] == pack_id]
+            size = self.dbx.size(packs.pack_obj(pack_id))
+            if size is None or any(offset + length > size for _, offset, length in entries):
+                corrupt.append(packs.index_obj(pack_id))
+        return (sorted(corrupt), len(named))
+
+    @property
+    def chunk_directory(self) -> str:
+        location = os.path.join(self.git_directory, 'dropshare', 'chunks')
+        os.makedirs(location, exist_ok=True)
+        return location
+
+    def _chunked(self, in_stream: IO[bytes]) -> bool:
+        """Large files are chunked when dropshare.chunking is set, from
+        dropshare.chunkThreshold bytes (64 MiB by default)."""
+        if not self.ds_flag('dropshare.chunking'):
+            return False
+        try:
+            size = os.fstat(in_stream.fileno()).st_size
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return False
+        return size >= int(self.ds_option('dropshare.chunkThreshold', str(64 * 1024 * 1024)))
+
+    def _cache_chunk(self, digest: str, data: bytes):
+        location = os.path.join(self.chunk_directory, digest)
+        if not os.path.exists(location):
+            with open(f'{location}.{os.getpid()}.tmp', 'wb') as stream:
+                stream.write(data)
+            os.replace(f'{location}.{os.getpid()}.tmp', location)
+
+    def _push_chunks(self, in_stream: IO[bytes], obj: str, hexdigest: str, path: str):
+        """Upload the chunks missing from the store, then the manifest."""
+        listing, size = [], 0
+        for digest, data in chunks.chunk_stream(in_stream, self.hasher):
+            listing.append((digest, len(data)))
+            size += len(data)
+            self._cache_chunk(digest, data)
+            with Backend.data_location(digest) as chunk_obj:
+                if self.dbx.exists(chunk_obj):
+                    metrics.count('chunks.reused', len(data))
+                elif self.dbx.upload(io.BytesIO(data), chunk_obj, path):
+                    metrics.count('chunks.uploaded', len(data))
+                else:
+                    return None
+        manifest = chunks.dump_manifest(hexdigest, size, listing)
+        # the cached manifest keeps its chunks from being pruned
+        self._cache_chunk(hexdigest + chunks.MANIFEST_SUFFIX, manifest)
+        return self.dbx.upload(io.BytesIO(manifest), obj + chunks.MANIFEST_SUFFIX, path)
+
+    def _pull_chunks(self, out_stream: IO[bytes], manifest_obj: str, hexdigest: str, path: str) -> bool:
+        """Reassemble out_stream from cached chunks, fetching the missing ones."""
+        with tempfile.NamedTemporaryFile(dir=self.chunk_directory, suffix='.tmp') as stream:
+            if not self.dbx.download(stream, manifest_obj, path):
+                return False
+            with open(stream.name, 'rb') as manifest_stream:
+                data = manifest_stream.read()
+        manifest = chunks.load_manifest(data)
+        self._cache_chunk(hexdigest + chunks.MANIFEST_SUFFIX, data)
+        hash_function = self.hasher()
+        for digest, _ in manifest['chunks']:
+            location = os.path.join(self.chunk_directory, digest)
+            if os.access(location, os.R_OK):
+                metrics.count('chunks.cached')
+            else:
+                with Backend.data_location(digest) as chunk_obj:
+                    with open(f'{location}.{os.getpid()}.tmp', 'wb') as chunk_stream:
+                        if not self.dbx.download(chunk_stream, chunk_obj, path):
+                            return False
+                os.replace(f'{location}.{os.getpid()}.tmp', location)
+            with open(location, 'rb') as chunk_stream:
+                for block in tools.read_as_blocks(chunk_stream):
+                    hash_function.update(block)
+                    out_stream.write(block)
+        out_stream.flush()
+        if hash_function.hexdigest() != hexdigest:
+            raise BackendException(f' \u2717 chunks of {path} do not match {hexdigest}.')
+        return True
+
+    def prune_chunks(self, referenced: Set[str]) -> Tuple[int, int]:
+        """Remove the cached chunks and manifests that no referenced object
+        needs, as told by the cached manifests; returns (files, bytes) removed."""
+        names = [x for x in os.listdir(self.chunk_directory) if not x.endswith('.tmp')]
+        kept = set() # type: Set[str]
+        for name in names:
+            if name.endswith(chunks.MANIFEST_SUFFIX) and name[:-len(chunks.MANIFEST_SUFFIX)] in referenced:
+                try:
+                    with open(os.path.join(self.chunk_directory, name), 'rb') as stream:
+                        kept.update(digest for digest, _ in chunks.load_manifest(stream.read())['chunks'])
+                except (OSError, ValueError):
+                    continue
+                kept.add(name)
+        removed, freed = 0, 0
+        for name in names:
+            if name not in kept:
+                location = os.path.join(self.chunk_directory, name)
+                try:
+                    freed += os.path.getsize(location)
+                    os.unlink(location)
+                except OSError:
+                    continue
+                removed += 1
+        return (removed, freed)
+
+    _dictionary = None # type: Optional[bytes]
+    def _compression_dict(self) -> Optional[bytes]:
+        if self._dictionary is None:
+            location = self.ds_option('dropshare.compressionDict')
+            self._dictionary = b''
+            if location:
+                with open(os.path.expanduser(location), 'rb') as stream:
+                    self._dictionary = stream.read()
+        return self._dictionary or None
+
+    _dictionary_hash = None # type: Optional[str]
+    _dictionary_stored = False
+    _dictionary_lock = threading.Lock()
+    def _compression_dict_id(self, store=False) -> Optional[str]:
+        """Content hash of dropshare.compressionDict; with store, the dictionary
+        is also stored in the area (once per process) as any other object."""
+        dictionary = self._compression_dict()
+        if dictionary is None:
+            return None
+        with self._dictionary_lock:
+            if self._dictionary_hash is None:
+                hash_function = self.hasher()
+                hash_function.update(dictionary)
+                self._dictionary_hash = hash_function.hexdigest()
+            if store and not self._dictionary_stored:
+                with Backend.data_location(self._dictionary_hash) as obj:
+                    if self.dbx.locate(obj) != obj and \
+                       not self.dbx.upload(io.BytesIO(dictionary), obj, 'compression dictionary'):
+                        raise BackendException(' \u2717 fails to upload the compression dictionary.')
+                self._dictionary_stored = True
+        return self._dictionary_hash
+
+    _dictionaries = None # type: Optional[Dict[str, bytes]] # hash -> dictionary
+    def _dictionary_for(self, dict_id: Optional[str], path: str) -> Optional[bytes]:
+        """Dictionary of hash dict_id: dropshare.compressionDict, or else the one
+        stored in the area, kept in the object cache. Objects without dictionary
+        header fall back to dropshare.compressionDict."""
+        if dict_id is None or dict_id == self._compression_dict_id():
+            return self._compression_dict()
+        with self._dictionary_lock:
+            if self._dictionaries is None:
+                self._dictionaries = dict()
+            if dict_id not in self._dictionaries:
+                cached = os.path.join(self.obj_directory, dict_id)
+                if not os.access(cached, os.R_OK):
+                    self._fetch_dictionary(dict_id, cached, path)
+                with open(cached, 'rb') as stream:
+                    self._dictionaries[dict_id] = stream.read()
+            return self._dictionaries[dict_id]
+
+    def _fetch_dictionary(self, dict_id: str, cached: str, path: str):
+        with Backend.data_location(dict_id) as obj:
+            located = self.dbx.locate(obj) if self.dbx.exists(obj) else None
+        if located != obj:
+            raise BackendException(f' \u2717 {path} was compressed with dictionary {dict_id}, '
+                                   'found neither locally nor in the storage area.')
+        with tempfile.NamedTemporaryFile(dir=self.obj_directory, suffix='.tmp', delete=False) as stream:
+            temp = stream.name
+            downloaded = self.dbx.download(stream, located, 'compression dictionary')
+        hash_function = self.hasher()
+        with open(temp, 'rb') as in_stream:
+            for block in tools.read_as_blocks(in_stream):
+                hash_function.update(block)
+        if not downloaded or hash_function.hexdigest() != dict_id:
+            os.unlink(temp)
+            raise BackendException(f' \u2717 fails to download dictionary {dict_id} for {path}.')
+        os.replace(temp, cached)
+
+    def _compression_level(self) -> Optional[int]:
+        level = self.ds_option('dropshare.compressionLevel')
+        return int(level) if level else None
+
+    _compress_attrs = dict() # type: Dict[str, str] # path -> dropshare-compress
+    _codec_warned = False
+
+    def prefetch_compress_attributes(self, paths: List[str]):
+        """dropshare-compress of the paths about to be pushed, with one check-attr call."""
+        if self.ds_option('dropshare.compression', 'none') in codecs.SUFFIXES:
+            self._compress_attrs = self.git_attr_values('dropshare-compress', paths)
+
+    def _codec(self, in_stream: IO[bytes], path: str) -> Optional[str]:
+        """Codec for path: dropshare.compression (zstd or zlib) applies to files
+        with the dropshare-compress attribute, or else whose first MiB compresses
+        below dropshare.compressionRatio (unless dropshare.compressionSample
+        is false)."""
+        codec = self.ds_option('dropshare.compression', 'none')
+        if codec not in codecs.SUFFIXES:
+            return None
+        setting = self._compress_attrs.get(path)
+        if setting is None:
+            setting = self.git_check_attr('dropshare-compress', path)
+        if setting == 'unset':
+            return None
+        if setting in codecs.SUFFIXES:
+            codec = setting
+        if not codecs.available(codec):
+            if not self._codec_warned:
+                tools.Console.warning(f' \u2717 {codec} compression unavailable, using zlib.')
+                self._codec_warned = True
+            codec = 'zlib'
+        if setting != 'unspecified':
+            return codec
+        if not self.ds_flag('dropshare.compressionSample', True):
+            return None
+        try:
+            sample = in_stream.read(codecs.SAMPLE_SIZE)
+            in_stream.seek(0)
+        except (OSError, io.UnsupportedOperation):
+            return None
+        threshold = float(self.ds_option('dropshare.compressionRatio', '0.9'))
+        with metrics.timer('compression.sample'):
+            ratio = codecs.ratio(sample, codec, self._compression_level(), self._compression_dict())
+        return codec if ratio < threshold else None
+
+    def _pull_compressed(self, out_stream: IO[bytes], located: str, hexdigest: str, path: str) -> bool:
+        """Download located into a temporary file, then inflate it into out_stream."""
+        hash_function = self.hasher()
+        with tempfile.NamedTemporaryFile(dir=self.obj_directory, suffix='.tmp') as stream:
+            if not self.dbx.download(stream, located, path):
+                return False
+            with open(stream.name, 'rb') as in_stream:
+                dictionary = self._dictionary_for(codecs.read_dictionary_id(in_stream), path)
+                try:
+                    codecs.decompress_stream(in_stream, out_stream, codecs.codec_of(located),
+                                             dictionary, hash_function)
+                except codecs.CodecError as exc:
+                    raise BackendException(f' \u2717 fails to decompress {path}: {exc}')
+        out_stream.flush()
+        if hash_function.hexdigest() != hexdigest:
+            raise BackendException(f' \u2717 {path} does not match {hexdigest} once decompressed.')
+        return True
+
+    def _ranged_size(self, out_stream: IO[bytes], located: str) -> Optional[int]:
+        """Size of a plain object to be fetched as parallel byte ranges: from
+        dropshare.rangedThreshold bytes (64 MiB by default, 0 disables), into a file."""
+        threshold = policy.parse_size(self.ds_option('dropshare.rangedThreshold'))
+        if threshold is None:
+            threshold = 64 * 1024 * 1024
+        size = self.dbx.size(located)
+        if not threshold or size is None or size < threshold:
+            return None
+        try:
+            out_stream.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None
+        return size
+
+    def _pull_ranged(self, out_stream: IO[bytes], located: str, size: int, hexdigest: str, path: str) -> bool:
+        """Download located as concurrent byte ranges of dropshare.rangeSize
+        (16 MiB by default, a multiple of the hash block), written in place into
+        a sparse file. Blocks are hashed as their range arrives, the content
+        hash being assembled from them at the end."""
+        block = DropboxContentHasher.BLOCK_SIZE
+        span = policy.parse_size(self.ds_option('dropshare.rangeSize')) or 4 * block
+        span = max(block, span - span % block)
+        digests = [b''] * ((size + block - 1) // block)
+        fd = out_stream.fileno()
+        os.ftruncate(fd, size)
+
+        def fetch(offset: int) -> bool:
+            length = min(span, size - offset)
+            data = self.dbx.download_range(located, offset, length)
+            if data is None or len(data) != length:
+                return False
+            os.pwrite(fd, data, offset)
+            for start in range(0, length, block):
+                digests[(offset + start) // block] = self.hasher.block_digest(data[start:start + block])
+            return True
+
+        with ThreadPoolExecutor(max_workers=self.transfer_jobs('read')) as pool, metrics.timer('download.ranged'):
+            fetched = all(list(pool.map(fetch, range(0, size, span))))
+        if not fetched:
+            return False
+        metrics.count('download.ranges', (size + span - 1) // span)
+        if self.hasher.combine(digests) != hexdigest:
+            raise BackendException(f' \u2717 {path} does not match {hexdigest}.')
+        return True
 
     def data_push(self, in_stream: IO[bytes], hexdigest: str, path: str, special=False) -> bool:
-        with Backend.data_location(hexdigest) as obj:
-            if not self.dbx.exists(obj):
+        with Backend.data_location(hexdigest) as obj, metrics.span('data_push', path=path):
+            if not self.data_exists(hexdigest):
                 tools.Console.info(f' * push {path} filter={special}')
-                if self.dbx.upload(in_stream, obj, path):
+                chunked = self._chunked(in_stream)
+                codec = None if chunked else self._codec(in_stream, path)
+                if chunked:
+                    uploaded = self._push_chunks(in_stream, obj, hexdigest, path)
+                elif codec is not None:
+                    reader = codecs.CompressingReader(in_stream, codec, self._compression_level(),
+                                                      self._compression_dict(), self._compression_dict_id(store=True))
+                    uploaded = self.dbx.upload(reader, obj + codecs.SUFFIXES[codec], path)
+                else:
+                    uploaded = self.dbx.upload(in_stream, obj, path)
+                if uploaded:
                     return True
                 raise BackendException(f' \u2717 fails to upload {path}.')
             return False
 
     def data_pull(self, out_stream: IO[bytes], hexdigest: str, path: str, special=False) -> bool:
-        with Backend.data_location(hexdigest) as obj:
-            if self.dbx.exists(obj):
+        with Backend.data_location(hexdigest) as obj, metrics.span('data_pull', path=path):
+            located = self.dbx.locate(obj) if self.dbx.exists(obj) else None
+            if located:
                 tools.Console.info(f' * pull {path} filter={special}')
-                if self.dbx.download(out_stream, obj, path):
+                if located.endswith(chunks.MANIFEST_SUFFIX):
+                    downloaded = self._pull_chunks(out_stream, located, hexdigest, path)
+                elif codecs.codec_of(located):
+                    downloaded = self._pull_compressed(out_stream, located, hexdigest, path)
+                else:
+                    size = self._ranged_size(out_stream, located)
+                    downloaded = size is not None and self._pull_ranged(out_stream, located, size, hexdigest, path)
+                    if not downloaded:
+                        downloaded = self.dbx.download(out_stream, located, path)
+                if downloaded:
+                    return True
+                raise BackendException(f' \u2717 fails to download {path}.')
+            entry = self.pack_index.find(hexdigest)
+            if entry is not None:
+                tools.Console.info(f' * pull {path} from pack filter={special}')
+                if self._pull_packed(out_stream, entry, hexdigest, path):
                     return True
                 raise BackendException(f' \u2717 fails to download {path}.')
             raise BackendException(f' \u2717 file {path} NOT found remotely.')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Content-defined chunking (FastCDC flavour) and chunk manifests.
+
+A chunked object is stored as its chunks, each addressed by its own
+content hash, plus a manifest object listing them in order. Boundaries
+only depend on the local content, so an edit in a large file only changes
+the chunks around it."""
+
+import json
+import struct
+import hashlib
+from typing import IO, Dict, Iterator, List, Tuple
+
+from . import metrics
+
+MANIFEST_SUFFIX = '.cdc'
+MANIFEST_VERSION = 1
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024 # a single Dropbox hashing block
+
+_M64 = (1 << 64) - 1
+GEAR = [int.from_bytes(hashlib.sha256(struct.pack('>I', i)).digest()[:8], 'big') for i in range(256)]
+
+def _mask(bits: int) -> int:
+    """bits ones on the high end: the gear hash shifts left."""
+    return ((1 << bits) - 1) << (64 - bits)
+
+def _cut(data: bytes, min_size: int, avg_size: int, max_size: int) -> int:
+    """Length of the next chunk at the start of data (normalized chunking)."""
+    size = len(data)
+    if size <= min_size:
+        return size
+    size = min(size, max_size)
+    normal = min(avg_size, size)
+    bits = avg_size.bit_length() - 1
+    mask_s, mask_l = _mask(bits + 2), _mask(bits - 2)
+    gear, h, i = GEAR, 0, min_size
+    while i < normal:
+        h = ((h << 1) + gear[data[i]]) & _M64
+        i += 1
+        if not h & mask_s:
+            return i
+    while i < size:
+        h = ((h << 1) + gear[data[i]]) & _M64
+        i += 1
+        if not h & mask_l:
+            return i
+    return size
+
+def chunk_stream(stream: IO[bytes], hasher, min_size: int = MIN_SIZE, avg_size: int = AVG_SIZE,
+                 max_size: int = MAX_SIZE) -> Iterator[Tuple[str, bytes]]:
+    """Yield (hexdigest, data) for the chunks of stream, hashed by hasher()."""
+    buffer, eof = bytearray(), False
+    while buffer or not eof:
+        while not eof and len(buffer) < max_size:
+            block = stream.read(max_size)
+            eof = not block
+            buffer.extend(block)
+        if not buffer:
+            break
+        with metrics.timer('chunks.cut'):
+            cut = _cut(buffer, min_size, avg_size, max_size)
+        data = bytes(buffer[:cut])
+        del buffer[:cut]
+        hash_function = hasher()
+        hash_function.update(data)
+        metrics.count('chunks.bytes', len(data))
+        yield (hash_function.hexdigest(), data)
+
+def dump_manifest(hexdigest: str, size: int, chunks: List[Tuple[str, int]]) -> bytes:
+    return json.dumps({'version': MANIFEST_VERSION, 'hexdigest': hexdigest, 'size': size,
+                       'chunks': chunks}).encode()
+
+def load_manifest(data: bytes) -> Dict:
+    manifest = json.loads(data.decode())
+    if manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError(f'unsupported chunk manifest version {manifest.get("version")}')
+    return manifest
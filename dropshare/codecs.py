@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Streaming compression of stored objects.
+
+Objects stay addressed by the hash of their uncompressed content; the codec
+is recorded by the suffix of the stored name. An object compressed with a
+dictionary starts with DICT_MAGIC and the content hash of the dictionary.
+zstd requires the optional `zstandard` module, zlib is always available."""
+
+import zlib
+from typing import IO, Optional
+
+from . import tools, metrics
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CodecError = (ValueError, zlib.error) + ((zstandard.ZstdError,) if zstandard else ())
+
+SUFFIXES = {'zstd': '.zst', 'zlib': '.zz'}
+LEVELS = {'zstd': 3, 'zlib': 6}
+SAMPLE_SIZE = 1024 * 1024
+DICT_MAGIC = b'DSD1'
+DICT_HEADER = len(DICT_MAGIC) + 32 # magic, dictionary hash
+
+def available(codec: str) -> bool:
+    return codec == 'zlib' or (codec == 'zstd' and zstandard is not None)
+
+def codec_of(obj: str) -> Optional[str]:
+    for codec, suffix in SUFFIXES.items():
+        if obj.endswith(suffix):
+            return codec
+    return None
+
+def dictionary_header(dict_id: Optional[str]) -> bytes:
+    return DICT_MAGIC + bytes.fromhex(dict_id) if dict_id else b''
+
+def read_dictionary_id(in_stream: IO[bytes]) -> Optional[str]:
+    """Hash of the dictionary in_stream was compressed with, read past its
+    header; None for an object without header, in_stream then rewound."""
+    header = in_stream.read(DICT_HEADER)
+    if len(header) == DICT_HEADER and header.startswith(DICT_MAGIC):
+        return header[len(DICT_MAGIC):].hex()
+    in_stream.seek(0)
+    return None
+
+def _zstd_dict(dictionary: Optional[bytes]):
+    return zstandard.ZstdCompressionDict(dictionary) if dictionary else None
+
+def _compressobj(codec: str, level: Optional[int], dictionary: Optional[bytes]):
+    level = LEVELS[codec] if level is None else level
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level, dict_data=_zstd_dict(dictionary)).compressobj()
+    return zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS, 9, zlib.Z_DEFAULT_STRATEGY,
+                            *([dictionary] if dictionary else []))
+
+def _decompressobj(codec: str, dictionary: Optional[bytes]):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ValueError('zstd compressed object, but module "zstandard" is missing')
+        return zstandard.ZstdDecompressor(dict_data=_zstd_dict(dictionary)).decompressobj()
+    return zlib.decompressobj(zlib.MAX_WBITS, *([dictionary] if dictionary else []))
+
+class CompressingReader(object):
+    """Read-only stream yielding the compressed content of stream, after the
+    header of dict_id, the hash of dictionary."""
+
+    def __init__(self, stream: IO[bytes], codec: str, level: Optional[int] = None,
+                 dictionary: Optional[bytes] = None, dict_id: Optional[str] = None) -> None:
+        self.stream = stream
+        self._compressor = _compressobj(codec, level, dictionary)
+        self._buffer = bytearray(dictionary_header(dict_id if dictionary else None))
+        self._eof = False
+
+    def read(self, size: Optional[int] = -1) -> bytes:
+        size = -1 if size is None else size
+        while not self._eof and (size < 0 or len(self._buffer) < size):
+            block = self.stream.read(tools.BLOCK_SIZE)
+            if block:
+                metrics.count('compression.bytes_in', len(block))
+                self._buffer += self._compressor.compress(block)
+            else:
+                self._buffer += self._compressor.flush()
+                self._eof = True
+        if size < 0:
+            size = len(self._buffer)
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        metrics.count('compression.bytes_out', len(data))
+        return data
+
+def decompress_stream(in_stream: IO[bytes], out_stream: IO[bytes], codec: str,
+                      dictionary: Optional[bytes] = None, hash_function=None):
+    decompressor = _decompressobj(codec, dictionary)
+    for block in tools.read_as_blocks(in_stream):
+        data = decompressor.decompress(block)
+        if hash_function is not None:
+            hash_function.update(data)
+        out_stream.write(data)
+    if codec == 'zlib':
+        data = decompressor.flush()
+        if hash_function is not None:
+            hash_function.update(data)
+        out_stream.write(data)
+
+def ratio(sample: bytes, codec: str, level: Optional[int] = None,
+          dictionary: Optional[bytes] = None) -> float:
+    """Compressed to raw size ratio of sample."""
+    if not sample:
+        return 1.0
+    compressor = _compressobj(codec, level, dictionary)
+    return len(compressor.compress(sample) + compressor.flush()) / len(sample)
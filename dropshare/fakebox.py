@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""In-memory stand-in for the Dropbox SDK client, for tests and benchmarks.
+
+FakeDropbox answers the subset of dropbox.Dropbox used by Storage, with
+configurable latency, bandwidth and rate limiting (429) injection. Temporary
+links are served by a local HTTP server honouring Range requests.
+
+Use it from pytest with `pytest_plugins = ['dropshare.fakebox']`, then
+request the `fake_dropbox` or `fake_storage` fixtures; both accept the
+FakeDropbox keyword arguments through indirect parametrization."""
+
+import os
+import re
+import time
+import random
+import threading
+import posixpath
+import itertools
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Tuple, Union, IO
+
+from dropbox import async_, files
+from dropbox.exceptions import ApiError, RateLimitError
+
+from .store import DropboxContentHasher, Storage
+
+class _Entry(object):
+    __slots__ = ('path_display', 'data', 'rev', 'id', 'modified')
+
+    def __init__(self, path_display: str, data: bytes, rev: str, id_: str):
+        self.path_display = path_display
+        self.data = data
+        self.rev = rev
+        self.id = id_
+        self.modified = datetime.utcnow().replace(microsecond=0)
+
+class FakeDropbox(object):
+    """Dropbox client double: state is kept in memory, the journal of
+    changes backs list_folder cursors."""
+
+    RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+    def __init__(self, latency: float = 0.0, bandwidth: Optional[float] = None,
+                 rate_limit: float = 0.0, retry_after: float = 0.0,
+                 page_size: int = 1000, seed: int = 0):
+        self.latency = latency          # seconds per call
+        self.bandwidth = bandwidth      # bytes per second, None for unlimited
+        self.rate_limit = rate_limit    # probability of a 429 answer per call
+        self.retry_after = retry_after  # backoff advertised with 429 answers
+        self.page_size = page_size
+        self.ranges = True              # temporary links honour Range requests
+        self.calls = dict()             # type: Dict[str, int]
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._entries = dict()          # type: Dict[str, _Entry]
+        self._journal = []              # type: List[Tuple[str, Optional[_Entry]]]
+        self._sessions = dict()         # type: Dict[str, bytearray]
+        self._links = dict()            # type: Dict[str, str]
+        self._counter = itertools.count(1)
+        self._server = None             # type: Optional[ThreadingHTTPServer]
+        self._throttled = 0             # next calls answered with a 429
+        self._jobs = dict()             # type: Dict[str, files.RelocationBatchV2Result]
+        self.fail_jobs = False          # copy jobs end with an internal error
+
+    # Network simulation
+
+    def _request(self, name: str, size: int = 0):
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            throttled = self._throttled > 0 or self._random.random() < self.rate_limit
+            self._throttled = max(0, self._throttled - 1)
+        if self.latency:
+            time.sleep(self.latency)
+        if throttled:
+            raise RateLimitError(f'fake-{name}', backoff=self.retry_after or None)
+        if self.bandwidth and size:
+            time.sleep(size / self.bandwidth)
+
+    # Internal state
+
+    def _serial(self) -> int:
+        with self._lock:
+            return next(self._counter)
+
+    def _metadata(self, entry: _Entry) -> files.FileMetadata:
+        hasher = DropboxContentHasher()
+        hasher.update(entry.data)
+        return files.FileMetadata(name=posixpath.basename(entry.path_display),
+                                  id=entry.id, rev=entry.rev, size=len(entry.data),
+                                  client_modified=entry.modified,
+                                  server_modified=entry.modified,
+                                  path_lower=entry.path_display.lower(),
+                                  path_display=entry.path_display,
+                                  content_hash=hasher.hexdigest())
+
+    def _deleted(self, path_display: str) -> files.DeletedMetadata:
+        return files.DeletedMetadata(name=posixpath.basename(path_display),
+                                     path_lower=path_display.lower(),
+                                     path_display=path_display)
+
+    def _lookup(self, path: str, error) -> _Entry:
+        entry = self._entries.get(path.lower())
+        if entry is None:
+            raise ApiError(f'fake-{path}', error(files.LookupError.not_found), None, None)
+        return entry
+
+    def _store(self, path: str, data: bytes) -> files.FileMetadata:
+        serial = self._serial()
+        previous = self._entries.get(path.lower())
+        id_ = previous.id if previous else f'id:fake{serial:012d}'
+        entry = _Entry(path, bytes(data), f'{serial:09x}', id_)
+        with self._lock:
+            self._entries[path.lower()] = entry
+            self._journal.append((path, entry))
+        return self._metadata(entry)
+
+    def _listing(self, folder: str, start: int) -> files.ListFolderResult:
+        with self._lock:
+            page = self._journal[start:start + self.page_size]
+            cursor = start + len(page)
+            has_more = cursor < len(self._journal)
+        prefix = folder.rstrip('/').lower() + '/'
+        entries = [self._metadata(entry) if entry else self._deleted(path)
+                   for path, entry in page if path.lower().startswith(prefix)]
+        return files.ListFolderResult(entries=entries, cursor=f'{cursor}:{folder}', has_more=has_more)
+
+    # Users
+
+    def users_get_current_account(self):
+        self._request('users_get_current_account')
+        return SimpleNamespace(account_id='dbid:fake')
+
+    def users_get_account(self, account_id: str):
+        self._request('users_get_account')
+        name = SimpleNamespace(abbreviated_name='FK', display_name='Fake Account')
+        return SimpleNamespace(account_id=account_id, name=name, email='fake@localhost')
+
+    # Listing and metadata
+
+    def files_list_folder(self, path: str, recursive: bool = False, include_deleted: bool = False):
+        self._request('files_list_folder')
+        return self._listing(path, 0)
+
+    def files_list_folder_continue(self, cursor: str):
+        self._request('files_list_folder_continue')
+        start, folder = cursor.split(':', 1)
+        return self._listing(folder, int(start))
+
+    def files_get_metadata(self, path: str):
+        self._request('files_get_metadata')
+        return self._metadata(self._lookup(path, files.GetMetadataError.path))
+
+    def files_delete_v2(self, path: str):
+        self._request('files_delete_v2')
+        entry = self._lookup(path, files.DeleteError.path_lookup)
+        with self._lock:
+            del self._entries[path.lower()]
+            self._journal.append((entry.path_display, None))
+        return files.DeleteResult(metadata=self._metadata(entry))
+
+    # Server-side copies
+
+    def files_copy_batch_v2(self, entries: List[files.RelocationPath], autorename: bool = False):
+        self._request('files_copy_batch_v2')
+        results = []
+        for entry in entries:
+            source = self._entries.get(entry.from_path.lower())
+            if source is None:
+                results.append(files.RelocationBatchResultEntry.failure(
+                    files.RelocationBatchErrorEntry.relocation_error(
+                        files.RelocationError.from_lookup(files.LookupError.not_found))))
+            else:
+                results.append(files.RelocationBatchResultEntry.success(self._store(entry.to_path, source.data)))
+        job = f'job-{self._serial()}'
+        self._jobs[job] = files.RelocationBatchV2Result(entries=results)
+        return files.RelocationBatchV2Launch.async_job_id(job)
+
+    def files_copy_batch_check_v2(self, async_job_id: str):
+        self._request('files_copy_batch_check_v2')
+        if self.fail_jobs:
+            raise ApiError(f'fake-{async_job_id}', async_.PollError.internal_error, None, None)
+        return files.RelocationBatchV2JobStatus.complete(self._jobs.pop(async_job_id))
+
+    # Uploads
+
+    def files_upload(self, data: bytes, path: str, mode=None, **kwargs):
+        self._request('files_upload', len(data))
+        return self._store(path, data)
+
+    def files_upload_session_start(self, data: bytes, close: bool = False, **kwargs):
+        self._request('files_upload_session_start', len(data))
+        session_id = f'session-{self._serial()}'
+        self._sessions[session_id] = bytearray(data)
+        return files.UploadSessionStartResult(session_id=session_id)
+
+    def files_upload_session_append_v2(self, data: bytes, cursor, close: bool = False):
+        self._request('files_upload_session_append_v2', len(data))
+        buffer = self._sessions[cursor.session_id]
+        if cursor.offset != len(buffer):
+            raise ApiError('fake-append', files.UploadSessionLookupError.incorrect_offset(
+                files.UploadSessionOffsetError(correct_offset=len(buffer))), None, None)
+        buffer.extend(data)
+
+    def files_upload_session_finish(self, data: bytes, cursor, commit):
+        self._request('files_upload_session_finish', len(data))
+        buffer = self._sessions.pop(cursor.session_id)
+        buffer.extend(data)
+        return self._store(commit.path, buffer)
+
+    # Downloads
+
+    def files_download(self, path: str, rev: Optional[str] = None):
+        entry = self._lookup(path, files.DownloadError.path)
+        self._request('files_download', len(entry.data))
+        content = entry.data
+        response = SimpleNamespace(content=content, close=lambda: None,
+                                   iter_content=lambda chunk_size=65536: (
+                                       content[i:i + chunk_size]
+                                       for i in range(0, len(content), chunk_size)))
+        return self._metadata(entry), response
+
+    def files_download_to_file(self, download_path: str, path: str, rev: Optional[str] = None):
+        meta, response = self.files_download(path, rev)
+        with open(download_path, 'wb') as out_stream:
+            out_stream.write(response.content)
+        return meta
+
+    def files_get_temporary_link(self, path: str):
+        self._request('files_get_temporary_link')
+        entry = self._lookup(path, files.GetTemporaryLinkError.path)
+        token = f'link{self._serial()}'
+        self._links[token] = path.lower()
+        host, port = self._serve()
+        return files.GetTemporaryLinkResult(metadata=self._metadata(entry),
+                                            link=f'http://{host}:{port}/{token}')
+
+    def _range(self, token: str, header: Optional[str]) -> Tuple[int, bytes, Optional[str]]:
+        entry = self._entries.get(self._links.get(token, ''))
+        if entry is None:
+            return 404, b'', None
+        data = entry.data
+        match = self.RANGE_RE.match(header or '')
+        if not match or not self.ranges:
+            return 200, data, None
+        first, last = match.groups()
+        if first == '':
+            first, last = max(0, len(data) - int(last)), len(data) - 1
+        else:
+            first, last = int(first), min(int(last) if last else len(data) - 1, len(data) - 1)
+        if first > last:
+            return 416, b'', f'bytes */{len(data)}'
+        return 206, data[first:last + 1], f'bytes {first}-{last}/{len(data)}'
+
+    def _serve(self) -> Tuple[str, int]:
+        if self._server is None:
+            fake = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    try:
+                        fake._request('temporary_link_get')
+                    except RateLimitError:
+                        self.send_response(429)
+                        self.send_header('Retry-After', str(fake.retry_after))
+                        self.end_headers()
+                        return
+                    status, body, content_range = fake._range(self.path.lstrip('/'),
+                                                              self.headers.get('Range'))
+                    if fake.bandwidth and body:
+                        time.sleep(len(body) / fake.bandwidth)
+                    self.send_response(status)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.send_header('Accept-Ranges', 'bytes')
+                    if content_range:
+                        self.send_header('Content-Range', content_range)
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, *args):
+                    pass
+
+            self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+            self._server.daemon_threads = True
+            threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server.server_address[:2]
+
+    def close(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    # Helpers for test writers
+
+    def throttle(self, calls: int):
+        """Answer the next calls with a 429, whatever rate_limit."""
+        with self._lock:
+            self._throttled = calls
+
+    def put(self, path: str, data: Union[bytes, IO[bytes]]) -> files.FileMetadata:
+        """Store data at path without going through the simulated network."""
+        if not isinstance(data, bytes):
+            data = data.read()
+        return self._store(path, data)
+
+def fake_storage_for(gitdir: str, client: FakeDropbox, root_path: str = 'dropshare') -> Storage:
+    """Storage instance backed by client, with its metadata kept under gitdir."""
+    os.makedirs(os.path.join(gitdir, 'dropshare'), exist_ok=True)
+    return Storage(gitdir, root_path, client=client)
+
+try:
+    import pytest
+except ImportError:
+    pass
+else:
+    @pytest.fixture
+    def fake_dropbox(request):
+        client = FakeDropbox(**getattr(request, 'param', dict()))
+        try:
+            yield client
+        finally:
+            client.close()
+
+    @pytest.fixture
+    def fake_storage(tmp_path, fake_dropbox):
+        yield fake_storage_for(str(tmp_path / 'git'), fake_dropbox)
@@ -9,12 +9,14 @@
 
 import os
 import sys
-import shutil
-import operator
+import time
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from . import tools, back
+from . import tools, back, metrics, profiling, process, policy, migrate, packs
 
 class Dropshare(back.Backend):
 
@@ -23,8 +25,15 @@ class Dropshare(back.Backend):
     _force = False    # init
     _match = []       # type: List[str] # pull/push
     _remote = None    # type: Optional[str] # fetch
+    _all = False      # fetch
+    _rev = None       # type: Optional[str] # prefetch
     _filename = None  # type: Optional[str] # log
     _paths = []       # type: List[str]
+    _include = []     # type: List[str] # migrate
+    _yes = False      # migrate
+    _stats = False    # print metrics on exit
+    _ignore_policy = False # pull
+    _directory = None # type: Optional[str] # profile-report
 
     def __init__(self):
         super().__init__()
@@ -35,6 +44,18 @@ class Dropshare(back.Backend):
     def call(self):
         pass
 
+    def ds_metrics(self, command: str):
+        """Report metrics on stderr (--stats) and/or to dropshare.metricsFile."""
+        if self._stats:
+            for line in metrics.report():
+                tools.Console.write(line)
+        path = self.ds_option('dropshare.metricsFile')
+        if path:
+            try:
+                metrics.dump(os.path.expanduser(path), command)
+            except OSError as exc:
+                tools.Console.warning(f' \u2717 metrics file: {exc}')
+
     @contextmanager
     def _dropshare_notes(self):
         """ Notes are neither pushed, pulled or fetched automatically, so... """
@@ -51,14 +72,47 @@ class Dropshare(back.Backend):
 
     def ds_fetch(self):
         with self._dropshare_notes():
-            self.ds_pull_notes(self._remote)
+            if self._all:
+                remotes = [x for x in self.git.remote().split('\n') if x.strip()]
+                jobs = int(self.ds_option('dropshare.fetchJobs', '4'))
+                tips = self.ds_fetch_all_notes(remotes, jobs)
+                tools.Console.info(f' * merged notes from {len(tips)} of {len(remotes)} remotes.')
+            else:
+                self.ds_pull_notes(self._remote or 'origin')
+        if self.ds_flag('dropshare.prefetchOnFetch'):
+            self._prefetch('@{upstream}')
+
+    def _prefetch(self, rev: str) -> int:
+        """Download into the cache the objects of the stubs rev would check out."""
+        try:
+            stubs = list(self.ds_changed_stubs(rev))
+        except back.GitCommandError:
+            tools.Console.warning(f' \u2717 prefetch: unknown revision {rev}.')
+            return 1
+        missing = dict((hexdigest, fname) for _, fname, hexdigest in stubs
+                       if self.ds_cached_object(hexdigest) is None and self._wanted(fname, hexdigest))
+        if not missing:
+            return 0
+        self.fetch_packs(missing.keys())
+        jobs = int(self.ds_option('dropshare.fetchJobs', '4'))
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            fetched = sum(pool.map(self.ds_fetch_object, missing.keys(), missing.values()))
+        tools.Console.info(f' * prefetched {fetched}/{len(missing)} objects for {rev}.')
+        return 0 if fetched == len(missing) else 1
+
+    def ds_prefetch(self):
+        self.ds_ready()
+        self.ds_delta()
+        return self._prefetch(self._rev or '@{upstream}')
 
     def _checkout(self):
-        # hack to trigger smudge filter on remaining stubs
-        for hexdigest, fname in self.ds_orphan_files():
-            if os.access(os.path.join(self.obj_directory, hexdigest), os.R_OK):
-                os.utime(fname, None)
-                self.git.checkout_index(fname, index=True, force=True)
+        # trigger smudge filter on remaining stubs, with a single checkout-index
+        cached = [fname for hexdigest, fname in self.ds_orphan_files()
+                  if os.access(os.path.join(self.obj_directory, hexdigest), os.R_OK)]
+        if cached:
+            self.ds_touch(cached)
+            self.git_input('checkout-index', '--index', '--force', '-z', '--stdin',
+                           data=b''.join(x.encode() + b'\0' for x in cached))
         # remove objects writtent by clean filter
         for fname in self.ds_staging_objects():
             if self.data_exists(fname):
@@ -66,66 +120,263 @@ class Dropshare(back.Backend):
         # tools.Console.write(' * check repository status: ', cr=False)
         # tools.Console.write('dirty' if self.git_repo.is_dirty() else 'OK')
 
+    def _wanted(self, fname: str, hexdigest: str) -> bool:
+        """Fetch policy check, unless pull --ignore-policy."""
+        if self._ignore_policy or os.environ.get(policy.IGNORE_ENV):
+            return True
+        return self.fetch_policy.allows(fname, lambda: self.data_size(hexdigest))
+
+    def _pull_on_demand(self):
+        """With the filter process, a checkout of the stubs fetches their objects."""
+        stubs = [(sha, fname, hexdigest) for sha, fname, hexdigest in self.filtered_by_attributes(self._match)
+                 if tools.ds_stub_file(fname) and self._wanted(fname, hexdigest)]
+        if stubs:
+            # unlike checkout-index, checkout supports delayed smudge
+            self.ds_touch([fname for _, fname, _ in stubs])
+            pathspecs = b''.join(fname.encode() + b'\0' for _, fname, _ in stubs)
+            # the filter fetches, whatever dropshare.smudgeFetch
+            self.git_input('-c', 'dropshare.smudgeFetch=true', '--literal-pathspecs', 'checkout',
+                           '--pathspec-from-file=-', '--pathspec-file-nul', data=pathspecs,
+                           env={policy.IGNORE_ENV: '1'} if self._ignore_policy else None)
+        for sha, fname, hexdigest in stubs:
+            if not tools.ds_stub_file(fname):
+                self.ds_append_note(sha, "pull", hexdigest, fname)
+
     def ds_pull(self):
         with self._dropshare_notes():
-            for sha, fname, hexdigest in self.filtered_by_attributes(self._match):
-                if hexdigest != tools.hash_file(fname, self.hasher()):
-                    obj_hexdigest = os.path.join(self.obj_directory, hexdigest)
-                    if not os.access(obj_hexdigest, os.W_OK):
-                        with open(obj_hexdigest, 'wb') as out_stream:
-                            if self.data_pull(out_stream, hexdigest, fname):
-                                self.ds_append_note(sha, "pull", hexdigest, fname)
-                                # self.git.add(fname)
-                            else:
-                                tools.Console.info(f' \u2717 fails to download {fname}.')
+            if self.git_config('filter.dropshare.process'):
+                self._pull_on_demand()
+                self._checkout()
+                self.git.status()
+                return
+            stubs = [(sha, fname, hexdigest) for sha, fname, hexdigest in self.filtered_by_attributes(self._match)
+                     if self._wanted(fname, hexdigest)]
+            self.fetch_packs(hexdigest for _, _, hexdigest in stubs)
+            todo = [(sha, fname, hexdigest) for sha, fname, hexdigest in stubs
+                    if hexdigest != tools.hash_file(fname, self.hasher())
+                    and not os.access(os.path.join(self.obj_directory, hexdigest), os.R_OK)]
+            with ThreadPoolExecutor(max_workers=self.transfer_jobs('read')) as pool:
+                fetched = pool.map(self.ds_fetch_object, [x for _, _, x in todo], [x for _, x, _ in todo])
+                for (sha, fname, hexdigest), done in zip(todo, fetched):
+                    if done:
+                        self.ds_append_note(sha, "pull", hexdigest, fname)
+                    else:
+                        tools.Console.info(f' \u2717 fails to download {fname}.')
             self._checkout()
             self.git.status()
 
     def ds_push(self):
         with self._dropshare_notes():
+            threshold, packed, todo = self.pack_threshold(), [], []
             for sha, fname, hexdigest in self.filtered_by_attributes(self._match):
                 if not self.ds_has_note(sha, fname, hexdigest, fname):
-                    with open(fname, 'rb') as in_stream:
-                        if not self.data_push(in_stream, hexdigest, fname):
-                            tools.Console.info(f' \u2713 file {fname} already in store.')
+                    # the cached object, if any, holds the committed content
+                    committed = self.ds_cached_object(hexdigest) or fname
+                    if threshold and os.path.getsize(committed) < threshold and not self.data_exists(hexdigest):
+                        packed.append((sha, fname, hexdigest))
+                    else:
+                        todo.append((sha, fname, hexdigest))
+            shared = self.data_copy_shared(hexdigest for _, _, hexdigest in todo + packed)
+            if shared:
+                for sha, fname, hexdigest in todo + packed:
+                    if hexdigest in shared:
+                        self.ds_append_note(sha, "push", hexdigest, fname)
+                todo = [x for x in todo if x[2] not in shared]
+                packed = [x for x in packed if x[2] not in shared]
+                tools.Console.info(f' \u2713 {len(shared)} objects copied from other storage areas.')
+            self.prefetch_compress_attributes([fname for _, fname, _ in todo])
+            with ThreadPoolExecutor(max_workers=self.transfer_jobs('write')) as pool:
+                for sha, fname, hexdigest in pool.map(self._push_file, todo):
+                    self.ds_append_note(sha, "push", hexdigest, fname)
+            if packed:
+                self.data_push_packs([(self.ds_cached_object(hexdigest) or fname, hexdigest)
+                                      for _, fname, hexdigest in packed])
+                for sha, fname, hexdigest in packed:
                     self.ds_append_note(sha, "push", hexdigest, fname)
 
+    def _push_file(self, item: Tuple[str, str, str]) -> Tuple[str, str, str]:
+        _, fname, hexdigest = item
+        # the cached object, if any, holds the committed content
+        with open(self.ds_cached_object(hexdigest) or fname, 'rb') as in_stream:
+            if not self.data_push(in_stream, hexdigest, fname):
+                tools.Console.info(f' \u2713 file {fname} already in store.')
+        return item
+
+    def ds_add(self):
+        """git add for many files at once: tracked files are hashed by a process
+        pool, kept in the cache, and their stubs staged with single git calls."""
+        self.ds_ready()
+        listed = self.git_input('ls-files', '-z', '--cached', '--others', '--exclude-standard',
+                                '--', *self._paths).split('\0')
+        paths = [x for x in listed if x and not os.path.islink(os.path.join(self.toplevel_dir, x))]
+        filtered = self.git_filtered_paths(paths)
+        others = [x for x in paths if x not in filtered]
+        if others:
+            self.git_input('add', '--pathspec-from-file=-', '--pathspec-file-nul',
+                           data=b''.join(x.encode() + b'\0' for x in others))
+        locations = dict((x, os.path.join(self.toplevel_dir, x)) for x in sorted(filtered))
+        digests = self.stat_cache.hash_files(locations.values())
+        tracked = [x for x in locations if digests[locations[x]] is not None]
+        unreadable = [x for x in locations if digests[locations[x]] is None]
+        removed = [x for x in unreadable if not os.path.lexists(locations[x])]
+        if removed:
+            self.git_input('update-index', '--remove', '-z', '--stdin',
+                           data=b''.join(x.encode() + b'\0' for x in removed))
+            tools.Console.info(f' \u2713 {len(removed)} deleted dropshare files staged.')
+        for path in unreadable:
+            if path not in removed:
+                tools.Console.warning(f' \u2717 cannot read {path}, not staged.')
+        if not tracked:
+            return
+        # one copy per content, duplicates are common
+        sources = dict((digests[locations[x]], locations[x]) for x in tracked)
+        with ThreadPoolExecutor(max_workers=self.transfer_jobs('write')) as pool:
+            list(pool.map(self.ds_keep_object, sources.values(), sources.keys()))
+        with tempfile.TemporaryDirectory(dir=self.obj_directory, suffix='.tmp') as stubs:
+            names = []
+            for number, path in enumerate(tracked):
+                names.append(os.path.join(stubs, str(number)))
+                with open(names[-1], 'wb') as stream:
+                    stream.write(tools.DS_WRITE(digests[locations[path]], path))
+            shas = self.git_input('hash-object', '-w', '--no-filters', '--stdin-paths',
+                                  data='\n'.join(names).encode()).split()
+        entries, modes = [], self._index_modes()
+        for path, sha in zip(tracked, shas):
+            if modes is None:
+                mode = '100755' if os.stat(locations[path]).st_mode & 0o111 else '100644'
+            else:
+                mode = modes.get(path, '100644')
+            entries.append(f'{mode} {sha}\t{path}\0'.encode())
+        self.git_input('update-index', '-z', '--index-info', data=b''.join(entries))
+        tools.Console.info(f' \u2713 {len(tracked)} dropshare files staged.')
+
+    def _index_modes(self) -> Optional[Dict[str, str]]:
+        """Modes staged for the paths added, when core.fileMode is false and the
+        executable bit of files is not to be trusted; None otherwise."""
+        if self.git_config('--bool', 'core.fileMode', default='true') != 'false':
+            return None
+        staged = self.git_input('ls-files', '-z', '--stage', '--', *self._paths).split('\0')
+        return dict((path, meta.split(' ')[0]) for meta, _, path in
+                    (x.partition('\t') for x in staged if x))
+
+    def ds_migrate(self):
+        """Rewrite the history so that files matching --include become stubs."""
+        self.ds_ready()
+        if not self._yes:
+            tools.Console.error(' \u2717 migrate rewrites all branches and tags in place: run again with --yes.')
+            return 1
+        if self.git_input('status', '--porcelain', '--untracked-files=no').strip():
+            tools.Console.error(' \u2717 migrate: commit or stash your changes first.')
+            return 1
+        with self._dropshare_notes():
+            migration = migrate.Migration(self, self._include, self.transfer_jobs('write'))
+            try:
+                migration.backup()
+                migration.run()
+            except migrate.MigrationError as exc:
+                tools.Console.error(str(exc))
+                return 1
+            notes = migration.notes()
+            if notes:
+                index = self.ds_notes_index()
+                existing = self.git_blobs(index[x] for x in notes if x in index)
+                for sha in notes:
+                    notes[sha] = existing.get(index.get(sha), b'') + notes[sha]
+                tip = self.ds_notes_tip()
+                paths = dict() # type: Dict[str, str] # where the notes being extended live
+                if tip and any(x in index for x in notes):
+                    for path in self.git_input('ls-tree', '-r', '-z', '--name-only', tip).split('\0'):
+                        if path.replace('/', '') in notes:
+                            paths[path.replace('/', '')] = path
+                self._ds_import_notes(notes, f'dropshare migration: {len(notes)} objects', [tip] if tip else [],
+                                      paths=paths)
+        tools.Console.info(f' \u2713 {migration.converted} file revisions converted to stubs.')
+        self.git_input('reset', '--hard', '--quiet')
+        attributes = os.path.join(self.toplevel_dir, self.ATTR_LOCS[0])
+        open(attributes, 'at').close()
+        for pattern in self._include:
+            self.ds_add_pattern([pattern], attributes)
+        self._checkout()
+        tools.Console.info(f' * commit {self.ATTR_LOCS[0]} to track these patterns from now on.')
+
     def ds_filter_clean(self):
         """run when a file is added to the index (checking):
         - receives the "smudged" (tree) version of the file on stdin (stub)
         - produces the "clean" (working repository) version on stdout.
         - N.B.: the additional path argument serves only informative purpose."""
         out_stream, path = sys.stdout.buffer, self._filename
-        with tools.scanner(sys.stdin.buffer) as in_stream:
+        with tools.scanner(sys.stdin.buffer) as in_stream, metrics.timer('filter.clean'):
             if in_stream.ds_is_stub():
                 tools.cat_stream(in_stream, out_stream)
             else:
-                # We keep in cache objects not already available in store
                 hexdigest = tools.hash_file(path, self.hasher())
-                if not self.data_exists(hexdigest):
-                    obj_hexdigest = os.path.join(self.obj_directory, hexdigest)
-                    if not os.access(obj_hexdigest, os.W_OK) or \
-                       os.path.getsize(obj_hexdigest) != os.path.getsize(path):
-                        shutil.copy(path, obj_hexdigest)
-                        os.chmod(obj_hexdigest, int('644', 8) & ~tools.umask())
+                self.ds_keep_object(path, hexdigest)
                 out_stream.write(tools.DS_WRITE(hexdigest, path))
 
+    def ds_keep_object(self, source: str, hexdigest: str):
+        """We keep in cache objects not already available in store."""
+        if self.dbx is not None and self.data_exists(hexdigest):
+            return
+        obj_hexdigest = os.path.join(self.obj_directory, hexdigest)
+        if not os.access(obj_hexdigest, os.R_OK) or \
+           os.path.getsize(obj_hexdigest) != os.path.getsize(source):
+            temp = f'{obj_hexdigest}.{os.getpid()}-{threading.get_ident()}.tmp'
+            with metrics.timer('filter.copy'):
+                tools.clone_file(source, temp, 'reflink')
+            os.chmod(temp, int('644', 8) & ~tools.umask())
+            os.replace(temp, obj_hexdigest)
+
+    def ds_cached_object(self, hexdigest: str) -> Optional[str]:
+        obj_hexdigest = os.path.join(self.obj_directory, hexdigest)
+        return obj_hexdigest if os.access(obj_hexdigest, os.R_OK) else None
+
+    def ds_may_fetch(self, hexdigest: str, path: str) -> bool:
+        """Whether smudge downloads missing objects (dropshare.smudgeFetch),
+        within the fetch policy."""
+        if self.dbx is None or not self.ds_flag('dropshare.smudgeFetch', True):
+            return False
+        return self._wanted(path, hexdigest)
+
+    def ds_fetch_object(self, hexdigest: str, path: str) -> bool:
+        """Download an object into the cache; safe to run from several threads."""
+        obj_hexdigest = os.path.join(self.obj_directory, hexdigest)
+        temp = f'{obj_hexdigest}.{os.getpid()}-{threading.get_ident()}.tmp'
+        fetched = False
+        try:
+            with open(temp, 'wb') as out_stream:
+                fetched = self.data_pull(out_stream, hexdigest, path, special=True)
+        except back.BackendException as exc:
+            tools.Console.error(exc.message)
+        if fetched:
+            os.replace(temp, obj_hexdigest)
+        elif os.path.exists(temp):
+            os.unlink(temp)
+        return fetched
+
     def ds_filter_smudge(self):
         """ Checkout process. Warning: path merely informative. """
         out_stream, path = sys.stdout.buffer, self._filename
-        with tools.scanner(sys.stdin.buffer) as in_stream:
+        with tools.scanner(sys.stdin.buffer) as in_stream, metrics.timer('filter.smudge'):
             try:
                 hexdigest, _ = in_stream.ds_stub()
             except:
                 tools.cat_stream(in_stream, out_stream)
             else:
-                obj_hexdigest = os.path.join(self.obj_directory, hexdigest)
-                if os.access(obj_hexdigest, os.R_OK):
-                    with open(obj_hexdigest, 'rb') as obj_stream:
+                obj_hexdigest = self.ds_cached_object(hexdigest)
+                if obj_hexdigest is None and self.ds_may_fetch(hexdigest, path):
+                    if self.ds_fetch_object(hexdigest, path):
+                        obj_hexdigest = self.ds_cached_object(hexdigest)
+                if obj_hexdigest is not None:
+                    with open(obj_hexdigest, 'rb') as obj_stream, metrics.timer('filter.copy'):
                         tools.cat_stream(obj_stream, out_stream)
                 else:
                     tools.cat_stream(in_stream, out_stream)
 
+    def ds_filter_process(self):
+        """Long running filter: serves all clean/smudge requests of a git command."""
+        jobs = int(self.ds_option('dropshare.fetchJobs', '4'))
+        process.FilterProcess(self, sys.stdin.buffer, sys.stdout.buffer, jobs).run()
+
     def ds_init(self):
         if not self.store or self._force:
             self.set_credentials()
@@ -142,8 +393,15 @@ class Dropshare(back.Backend):
             tools.Console.write(f' \u2717 dropshare not configured yet?...')
             sys.exit(1)
         tools.Console.write(f' \u2713 found dropshare account = {tag}')
+        version = '.'.join(map(str, self.git.version_info))
+        if self.git.version_info < self.GIT_MINIMUM:
+            minimum = '.'.join(map(str, self.GIT_MINIMUM))
+            tools.Console.write(f' \u2717 git {version} is too old, dropshare needs git {minimum} or later')
+        else:
+            tools.Console.write(f' \u2713 git {version}')
         missing = False
-        for key in self.DS_KEYS:
+        keys = self.DS_LOCAL_KEYS if self.backend_kind(tag) == 'local' else self.DS_KEYS
+        for key in keys:
             val = self.git_config('--global', f'dropshare.{tag}.{key}')
             if val is None:
                 missing = True
@@ -160,23 +418,120 @@ class Dropshare(back.Backend):
         changed, deleted, inserted = self.dbx.delta()
         if changed:
             tools.Console.info(f' * {len(deleted)} deleted, {len(inserted)} updated.')
+            try:
+                self.sync_pack_indexes()
+            except back.BackendException as exc:
+                tools.Console.error(exc.message)
+                sys.exit(1)
+        self.sync_copy_sources()
 
     def ds_log(self):
         for fname in self._paths:
             if not os.access(fname, os.R_OK):
                 tools.Console.write(f' \u2717 file {fname} does not exist.')
                 return
-            entries = []
-            for tree in self.git.log("--pretty=format:%T", fname).split('\n'):
-                for _, sha in self.git_ls_tree('-r', tree, fname):
-                    for timestamp, dir_, _, _, user in self.ds_manifest(sha, reverse=True):
-                        dt_local = tools.local_date(timestamp)
-                        dt_fmt = dt_local.strftime("%A %d %B %Y, %X")
-                        arrow = '\u2191' if dir_ == 'push' else '\u2193'
-                        entries.append((dt_local, sha[:6], dt_fmt, arrow, dir_, user))
-            sentries = sorted(entries, key=operator.itemgetter(0), reverse=True)
-            for _, sha, date, arrow, direction, user in sentries:
-                tools.Console.write(f' {arrow} ({sha}) {date} - {direction}ed by {user}.')
+        notes, seen = self.ds_notes_index(), set()
+        for _, fname, sha in self.git_log_blobs(self._paths):
+            if sha in seen or sha not in notes:
+                continue
+            seen.add(sha)
+            events = self.ds_note_events(notes[sha])
+            where = f' {fname}' if len(self._paths) > 1 else ''
+            for timestamp, dir_, _, _, user in sorted(events, key=lambda x: float(x[0]), reverse=True):
+                dt_fmt = tools.local_date(timestamp).strftime("%A %d %B %Y, %X")
+                arrow = '\u2191' if dir_ == 'push' else '\u2193'
+                tools.Console.write(f' {arrow} ({sha[:6]}){where} {dt_fmt} - {dir_}ed by {user}.')
+
+    def ds_verify(self):
+        """Check the storage area against the listed content hashes, and the
+        local cache by rehashing it; nothing is downloaded."""
+        self.ds_ready()
+        self.ds_delta()
+        corrupt, checked = self.verify_store()
+        for obj in corrupt:
+            tools.Console.write(f' \u2717 corrupt remote object {obj}')
+        referenced = set(self.ds_referenced_objects(full=False))
+        missing = sorted(x for x in referenced if not self.data_exists(x))
+        for hexdigest in missing:
+            tools.Console.write(f' \u2717 missing remote object {hexdigest}')
+        cached = [os.path.join(self.obj_directory, x) for x in os.listdir(self.obj_directory)
+                  if len(x) == 64 and '.' not in x]
+        digests = self.stat_cache.hash_files(cached)
+        spoiled = sorted(x for x, hexdigest in digests.items() if hexdigest != os.path.basename(x))
+        for location in spoiled:
+            tools.Console.write(f' \u2717 corrupt cached object {os.path.basename(location)}')
+        tools.Console.write(f' * {checked} remote objects checked, {len(referenced)} referenced, '
+                            f'{len(cached)} cached.')
+        if corrupt or missing or spoiled:
+            return 1
+        tools.Console.write(' \u2713 storage area and local cache are sound.')
+
+    def ds_fsck(self):
+        """Check the local cache: cached objects and packs are rehashed by all
+        cores (only those whose stat changed since the last run), the corrupt
+        ones quarantined; then cross-check the cache with the stubs of the
+        history and the storage area, when there is one. Cached chunks no
+        file of the history needs are pruned."""
+        self.ds_ready()
+        if self.dbx is not None:
+            self.ds_delta()
+        locations = [os.path.join(self.obj_directory, x) for x in os.listdir(self.obj_directory)
+                     if len(x) == 64 and '.' not in x]
+        pack_directory = self.pack_index.directory
+        locations += [os.path.join(pack_directory, x) for x in os.listdir(pack_directory)
+                      if x.endswith(packs.PACK_SUFFIX)]
+        with metrics.timer('fsck.rehash'):
+            digests = self.stat_cache.hash_files(locations)
+        corrupt = [x for x in locations if digests[x] != os.path.basename(x).split('.')[0]]
+        quarantine = os.path.join(self.git_directory, 'dropshare', 'quarantine')
+        for location in corrupt:
+            os.makedirs(quarantine, exist_ok=True)
+            name = os.path.basename(location)
+            os.replace(location, os.path.join(quarantine, f'{name}.{int(time.time())}'))
+            self.stat_cache.forget(os.path.abspath(location))
+            tools.Console.write(f' \u2717 corrupt cached object {name}, moved to {quarantine}')
+        self.stat_cache.save()
+        cached = set(os.path.basename(x) for x in locations
+                     if x not in corrupt and os.path.dirname(x) == self.obj_directory)
+        referenced = set(self.ds_referenced_objects(full=False))
+        for hexdigest in sorted(cached - referenced):
+            tools.Console.write(f' * dangling cached object {hexdigest}')
+        pruned, freed = self.prune_chunks(referenced)
+        if pruned:
+            tools.Console.write(f' * {pruned} unreferenced chunks and manifests pruned, {freed} bytes freed.')
+        if self.dbx is None:
+            missing = []
+            tools.Console.write(f' * {len(locations)} cached objects and packs checked, {len(referenced)} referenced, '
+                                f'{len(referenced - cached)} not cached: no storage area to check them against.')
+        else:
+            stored = set(x for x in referenced if self.data_exists(x))
+            missing = sorted(referenced - cached - stored)
+            for hexdigest in missing:
+                tools.Console.write(f' \u2717 missing object {hexdigest}, neither cached nor stored')
+            unpushed = len((cached & referenced) - stored)
+            tools.Console.write(f' * {len(locations)} cached objects and packs checked, {len(referenced)} referenced, '
+                                f'{unpushed} not pushed yet.')
+        if corrupt or missing:
+            return 1
+        tools.Console.write(' \u2713 local cache is sound.')
+
+    def ds_notes_compact(self):
+        with self._dropshare_notes():
+            before, after = self.ds_compact_notes()
+            if before == after:
+                tools.Console.info(f' \u2713 notes already compact ({before} events).')
+            else:
+                tools.Console.info(f' \u2713 notes compacted: {before} -> {after} events.')
+
+    @classmethod
+    def ds_profile_report(cls):
+        """Needs no repository: run without an instance."""
+        directory = cls._directory or os.environ.get(profiling.PROFILE_ENV)
+        if not directory:
+            tools.Console.write(f' \u2717 no directory given and {profiling.PROFILE_ENV} unset.')
+            return 1
+        for line in profiling.report(directory):
+            tools.Console.write(line)
 
     def ds_show(self):
         from subprocess import call
@@ -19,10 +19,20 @@ Remote = NewType('Remote', str)
 Commitish = Union[Sha,Ref,Branch,BaseBranch]
 T = TypeVar('T')
 
-from git import Git as GitCli
+from git import Git as _GitCli
 from git import Repo as GitRepo
 from git.exc import GitCommandError
 
+from . import metrics
+
+class GitCli(_GitCli):
+    """GitPython command wrapper accounting for every git subprocess."""
+    def execute(self, command, *args, **kwargs):
+        name = command[1] if isinstance(command, (list, tuple)) and len(command) > 1 else 'git'
+        metrics.count(f'git.calls.{name}')
+        with metrics.timer('git.subprocess'):
+            return super().execute(command, *args, **kwargs)
+
 EMPTY_TREE = '4b825dc642cb6eb9a060e54bf8d69288fbee4904' # git empty commit tree
 
 __all__ = ['Sha', 'GitCmd', 'GitCli', 'GitCommandError']
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Dropbox content hash, kept apart from the dropbox module for the
+hashing worker processes."""
+
+import hashlib
+from typing import Iterable
+
+class DropboxContentHasher(object):
+    """ From https://github.com/dropbox/dropbox-api-content-hasher """
+    BLOCK_SIZE = 4 * 1024 * 1024
+
+    def __init__(self):
+        self._overall_hasher = hashlib.sha256()
+        self._block_hasher = hashlib.sha256()
+        self._block_pos = 0
+        self.digest_size = self._overall_hasher.digest_size
+
+    def update(self, new_data: bytes):
+        # assert isinstance(new_data, bytes), "Expecting a byte string, got {type(new_data)}"
+        new_data_pos = 0
+        while new_data_pos < len(new_data):
+            if self._block_pos == self.BLOCK_SIZE:
+                self._overall_hasher.update(self._block_hasher.digest())
+                self._block_hasher = hashlib.sha256()
+                self._block_pos = 0
+            space_in_block = self.BLOCK_SIZE - self._block_pos
+            part = new_data[new_data_pos:(new_data_pos+space_in_block)]
+            self._block_hasher.update(part)
+            self._block_pos += len(part)
+            new_data_pos += len(part)
+
+    def _finish(self):
+        if self._block_pos > 0:
+            self._overall_hasher.update(self._block_hasher.digest())
+            self._block_hasher = None
+        hasher = self._overall_hasher
+        self._overall_hasher = None  # Make sure we can't use this object anymore.
+        return hasher
+
+    def hexdigest(self) -> str:
+        return self._finish().hexdigest()
+
+    @staticmethod
+    def block_digest(block: bytes) -> bytes:
+        """Digest of one BLOCK_SIZE block (the last one may be shorter)."""
+        return hashlib.sha256(block).digest()
+
+    @staticmethod
+    def combine(block_digests: Iterable[bytes]) -> str:
+        """Content hash of a file, from the digests of its blocks in order."""
+        return hashlib.sha256(b''.join(block_digests)).hexdigest()
+
+    # def digest(self):
+    #     return self._finish().digest()
+
+    # def copy(self):
+    #     c = ContentHasher.__new__(ContentHasher)
+    #     c._overall_hasher = self._overall_hasher.copy()
+    #     c._block_hasher = self._block_hasher.copy()
+    #     c._block_pos = self._block_pos
+    #     return c
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Compact index of the storage area.
+
+The file holds a small header followed by fixed-size records, sorted by the
+32-byte binary digest they start with: for the storage area, the encoding
+and size of every stored object. It is memory-mapped and searched by
+bisection, so that filter processes answer `exists?`, `where?` and `how
+large?` without loading the whole hash table."""
+
+import os
+import mmap
+import heapq
+import struct
+import posixpath
+from typing import Dict, Iterable, Iterator, Optional, Sequence, Set, Tuple
+
+from . import metrics
+
+DIGEST_SIZE = 32
+HEADER = struct.Struct('>4sIII') # magic, version, count, tag
+
+def obj_digest(obj: str) -> Optional[bytes]:
+    """Binary digest named by a data location, suffixes aside."""
+    name = posixpath.basename(obj).split('.', 1)[0]
+    if len(name) != 2 * DIGEST_SIZE:
+        return None
+    try:
+        return bytes.fromhex(name)
+    except ValueError:
+        return None
+
+class SortedRecords(object):
+    """Memory-mapped file of RECORD structures sorted by their leading digest.
+    The header tag is left to subclasses."""
+
+    MAGIC, VERSION = b'DSRC', 1
+    RECORD = struct.Struct(f'>{DIGEST_SIZE}s')
+
+    def __init__(self, location: str):
+        self.location = location
+        self._map = None # type: Optional[mmap.mmap]
+        self._count = 0
+        self.tag = 0
+        self._open()
+
+    def _open(self):
+        self.close()
+        try:
+            with open(self.location, 'rb') as stream:
+                size = os.fstat(stream.fileno()).st_size
+                if size < HEADER.size:
+                    return
+                self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except FileNotFoundError:
+            return
+        magic, version, count, tag = HEADER.unpack_from(self._map, 0)
+        if (magic != self.MAGIC or version != self.VERSION
+                or HEADER.size + count * self.RECORD.size > len(self._map)):
+            self.close()
+            return
+        self._count, self.tag = count, tag
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._map, self._count, self.tag = None, 0, 0
+
+    @property
+    def available(self) -> bool:
+        return self._map is not None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def _at(self, position: int) -> bytes:
+        offset = HEADER.size + position * self.RECORD.size
+        return self._map[offset:offset + self.RECORD.size]
+
+    def __iter__(self) -> Iterator[bytes]:
+        for position in range(self._count):
+            yield self._at(position)
+
+    def _matching(self, digest: bytes) -> Iterator[Tuple]:
+        """Records starting with digest, unpacked."""
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._at(middle)[:DIGEST_SIZE] < digest:
+                low = middle + 1
+            else:
+                high = middle
+        while low < self._count:
+            record = self._at(low)
+            if record[:DIGEST_SIZE] != digest:
+                break
+            yield self.RECORD.unpack(record)
+            low += 1
+
+    def _write(self, records: Iterable[bytes], tag: int = 0):
+        """Replace the file with records, sorted, duplicates dropped."""
+        temp = f'{self.location}.{os.getpid()}.tmp'
+        count = 0
+        with open(temp, 'wb') as stream:
+            stream.write(HEADER.pack(self.MAGIC, self.VERSION, 0, tag))
+            previous = None
+            for record in records:
+                if record != previous:
+                    stream.write(record)
+                    count += 1
+                previous = record
+            stream.seek(0)
+            stream.write(HEADER.pack(self.MAGIC, self.VERSION, count, tag))
+        self.close()
+        os.replace(temp, self.location)
+        self._open()
+
+class DigestIndex(SortedRecords):
+    """Stored objects: digest, encoding (position of the suffix of the stored
+    name within the suffixes given, OTHER for anything else) and size."""
+
+    MAGIC, VERSION = b'DSIX', 2
+    RECORD = struct.Struct(f'>{DIGEST_SIZE}sBQ')
+    OTHER = 255
+    UNKNOWN_SIZE = 2 ** 64 - 1
+
+    def __init__(self, location: str, suffixes: Sequence[str] = ('',)):
+        self.suffixes = tuple(suffixes)
+        self._pending = dict() # type: Dict[Tuple[bytes, int], Optional[int]]
+        self._removed = set() # type: Set[Tuple[bytes, int]]
+        super().__init__(location)
+
+    def _key(self, obj: str) -> Optional[Tuple[bytes, int]]:
+        digest = obj_digest(obj)
+        if digest is None:
+            return None
+        name = posixpath.basename(obj)
+        suffix = name[2 * DIGEST_SIZE:]
+        encoding = self.suffixes.index(suffix) if suffix in self.suffixes else DigestIndex.OTHER
+        return digest, encoding
+
+    def _record(self, obj: str, size: Optional[int]) -> Optional[bytes]:
+        key = self._key(obj)
+        if key is None:
+            return None
+        return self.RECORD.pack(key[0], key[1], DigestIndex.UNKNOWN_SIZE if size is None else size)
+
+    def encodings(self, obj: str) -> Dict[int, Optional[int]]:
+        """Encodings under which the digest of obj is stored -> stored size."""
+        found = dict() # type: Dict[int, Optional[int]]
+        digest = obj_digest(obj)
+        metrics.count('index.lookups')
+        if digest is None:
+            return found
+        for _, encoding, size in self._matching(digest):
+            found[encoding] = None if size == DigestIndex.UNKNOWN_SIZE else size
+        for (pending, encoding), size in list(self._pending.items()):
+            if pending == digest:
+                found[encoding] = size
+        for removed, encoding in list(self._removed):
+            if removed == digest:
+                found.pop(encoding, None)
+        return found
+
+    def locate(self, obj: str) -> Optional[str]:
+        """Name under which the data location obj is stored, whatever its encoding."""
+        known = sorted(x for x in self.encodings(obj) if x != DigestIndex.OTHER)
+        return obj + self.suffixes[known[0]] if known else None
+
+    def size(self, stored: str) -> Optional[int]:
+        key = self._key(stored)
+        return self.encodings(stored).get(key[1]) if key else None
+
+    def contains_obj(self, obj: str) -> bool:
+        return self.locate(obj) is not None
+
+    def add(self, obj: str, size: Optional[int] = None):
+        """Record an object known to exist, for the current process only."""
+        key = self._key(obj)
+        if key is not None:
+            self._removed.discard(key)
+            self._pending[key] = size
+
+    def discard(self, obj: str):
+        """Forget a deleted object, in the file too."""
+        key = self._key(obj)
+        if key is not None:
+            self._pending.pop(key, None)
+            self._removed.add(key)
+            self.update([], [obj])
+
+    def rebuild(self, items: Iterable[Tuple[str, Optional[int]]]):
+        """Index the (stored object, size) items, only."""
+        with metrics.timer('index.rebuild'):
+            self._write(sorted(filter(None, (self._record(obj, size) for obj, size in items))))
+
+    def update(self, inserted: Iterable[Tuple[str, Optional[int]]], deleted: Iterable[str]):
+        """Merge the changes reported by a delta, (stored object, size) items
+        and stored objects, into the index."""
+        added = sorted(filter(None, (self._record(obj, size) for obj, size in inserted)))
+        replaced = set(x[:DIGEST_SIZE + 1] for x in added)
+        self._removed.difference_update((x[:DIGEST_SIZE], x[DIGEST_SIZE]) for x in replaced)
+        removed = set(filter(None, map(self._key, deleted)))
+        for key in removed:
+            self._pending.pop(key, None)
+        replaced.update(digest + bytes([encoding]) for digest, encoding in removed)
+        if not added and not replaced:
+            return
+        with metrics.timer('index.update'):
+            kept = (x for x in self if x[:DIGEST_SIZE + 1] not in replaced)
+            self._write(heapq.merge(kept, added))
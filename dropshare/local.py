@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+import time
+import posixpath
+from datetime import datetime
+from typing import Optional, Dict, IO, Tuple, Set
+
+from . import tools, metrics
+from .store import HashTable, ObjectStore
+
+class LocalStorage(HashTable, ObjectStore):
+    """Storage area held in a local directory (NAS mount, scratch disk...),
+    using the same fan-out layout as the Dropbox area."""
+
+    def __init__(self, gitdir: str, root_path: str, transfer: str = 'copy'):
+        super().__init__(gitdir)
+        self.db_path = os.path.abspath(os.path.expanduser(root_path))
+        self.cache_path = os.path.realpath(os.path.join(gitdir, 'dropshare', 'objects'))
+        self.transfer = transfer if transfer in tools.TRANSFERS else 'copy'
+        os.makedirs(self.db_path, exist_ok=True)
+
+    def remote_path(self, obj: str) -> str:
+        return os.path.join(self.db_path, *obj.strip('/').split('/'))
+
+    @staticmethod
+    def file_info(location: str) -> Dict:
+        stat = os.stat(location)
+        return {'id': f'ino:{stat.st_ino}',
+                'rev': f'{stat.st_mtime_ns:x}',
+                'size': stat.st_size,
+                'modified': datetime.utcfromtimestamp(stat.st_mtime),
+                'sharing_info': None}
+
+    def locate(self, obj: str) -> Optional[str]:
+        for suffix in ObjectStore.ENCODINGS:
+            if os.path.isfile(self.remote_path(obj + suffix)):
+                return obj + suffix
+        return None
+
+    def exists(self, obj: str) -> bool:
+        return self.locate(obj) is not None
+
+    def size(self, stored: str) -> Optional[int]:
+        try:
+            return os.path.getsize(self.remote_path(stored))
+        except OSError:
+            return None
+
+    def upload(self, in_stream: IO[bytes], obj: str, path: str) -> Optional[Dict]:
+        remote = self.remote_path(obj)
+        os.makedirs(os.path.dirname(remote), exist_ok=True)
+        temp = f'{remote}.{os.getpid()}.tmp'
+        try:
+            source = getattr(in_stream, 'name', None)
+            if self.transfer != 'copy' and isinstance(source, str) and os.path.isfile(source):
+                # a hardlink to a working file would follow its later edits
+                cached = os.path.dirname(os.path.realpath(source)) == self.cache_path
+                tools.clone_file(source, temp, self.transfer if cached else 'reflink')
+            else:
+                with open(temp, 'wb') as out_stream:
+                    tools.cat_stream(in_stream, out_stream)
+            os.chmod(temp, 0o444 & ~tools.umask())
+            os.replace(temp, remote)
+        except OSError as exc:
+            tools.Console.info(f' \u2717 local store: {exc}')
+            if os.path.exists(temp):
+                os.unlink(temp)
+            return None
+        info = LocalStorage.file_info(remote)
+        metrics.count('bytes.uploaded', info['size'])
+        self.hash_table['files'][obj] = info
+        return info
+
+    def download(self, out_stream: IO[bytes], obj: str, path: str) -> Optional[Dict]:
+        remote = self.remote_path(obj)
+        try:
+            if self.transfer != 'copy':
+                temp = f'{out_stream.name}.{os.getpid()}.tmp'
+                tools.clone_file(remote, temp, self.transfer)
+                os.replace(temp, out_stream.name)
+            else:
+                with open(remote, 'rb') as in_stream:
+                    tools.cat_stream(in_stream, out_stream)
+                out_stream.seek(0)
+        except OSError as exc:
+            tools.Console.info(f' \u2717 local store: {exc}')
+            return None
+        info = LocalStorage.file_info(remote)
+        metrics.count('bytes.downloaded', info['size'])
+        return info
+
+    def download_range(self, obj: str, offset: int, length: int) -> Optional[bytes]:
+        try:
+            with open(self.remote_path(obj), 'rb') as in_stream:
+                in_stream.seek(offset)
+                data = in_stream.read(length)
+        except OSError as exc:
+            tools.Console.info(f' \u2717 local store: {exc}')
+            return None
+        metrics.count('bytes.downloaded', len(data))
+        return data
+
+    def delete(self, obj: str) -> bool:
+        try:
+            os.unlink(self.remote_path(obj))
+        except FileNotFoundError:
+            return False
+        self.hash_table['files'].pop(obj, None)
+        return True
+
+    def delta(self) -> Tuple[bool, Dict, Dict]:
+        """Rescan the fan-out directories changed since the last delta; there
+        is no cursor to rely on."""
+        with metrics.span('delta'):
+            return self._rescan()
+
+    RACY = 2 # seconds: a directory modified since may change again unnoticed
+
+    def _rescan(self) -> Tuple[bool, Dict, Dict]:
+        """Only the directories whose mtime changed are listed, and only their
+        files are stat'ed; objects are written by rename, which updates the
+        mtime of their directory."""
+        known = self.hash_table['files']
+        dirs = self.hash_table.setdefault('dirs', dict()) # type: Dict[str, Dict]
+        by_dir = dict() # type: Dict[str, Set[str]]
+        for obj in known:
+            by_dir.setdefault(posixpath.dirname(obj), set()).add(obj)
+        deleted, inserted, relisted = dict(), dict(), False
+        racy = time.time_ns() - LocalStorage.RACY * 1000000000
+        pending = ['']
+        while pending:
+            relative = pending.pop()
+            location = os.path.join(self.db_path, *relative.split('/')) if relative else self.db_path
+            try:
+                mtime = os.stat(location).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            state = dirs.get(relative)
+            if state is not None and state['mtime'] == mtime:
+                pending.extend(posixpath.join(relative, x) for x in state['dirs'])
+                continue
+            subdirs, listed = [], set()
+            with os.scandir(location) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        subdirs.append(entry.name)
+                    elif not entry.name.endswith('.tmp'):
+                        obj = posixpath.join(relative, entry.name)
+                        listed.add(obj)
+                        info = LocalStorage.file_info(entry.path)
+                        if obj not in known or known[obj]['rev'] != info['rev']:
+                            inserted[obj] = known[obj] = info
+            for obj in by_dir.get(relative, set()) - listed:
+                deleted[obj] = posixpath.basename(obj)
+                del known[obj]
+            for name in set(state['dirs'] if state else []) - set(subdirs):
+                self._forget(posixpath.join(relative, name), dirs, by_dir, deleted)
+            dirs[relative] = {'mtime': mtime if mtime < racy else None, 'dirs': sorted(subdirs)}
+            relisted = relisted or dirs[relative] != state
+            pending.extend(posixpath.join(relative, x) for x in subdirs)
+        if deleted or inserted or relisted:
+            self.save()
+        return (bool(deleted or inserted), deleted, inserted)
+
+    def _forget(self, relative: str, dirs: Dict[str, Dict], by_dir: Dict[str, Set[str]], deleted: Dict):
+        """A directory was removed: so were the objects below it."""
+        state = dirs.pop(relative, None)
+        for obj in by_dir.get(relative, set()):
+            if self.hash_table['files'].pop(obj, None) is not None:
+                deleted[obj] = posixpath.basename(obj)
+        for name in state['dirs'] if state else []:
+            self._forget(posixpath.join(relative, name), dirs, by_dir, deleted)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Process wide counters and histograms.
+
+Names are dotted: `bytes.uploaded`, `request.download`, `git.subprocess`...
+Timings are histograms in seconds. Spans are timings which are forwarded
+to OpenTelemetry as well, when the API is installed."""
+
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Generator
+
+try:
+    from opentelemetry import trace as _otel_trace
+except ImportError:
+    _otel_trace = None
+
+_lock = threading.Lock()
+_counters = dict()   # type: Dict[str, float]
+_histograms = dict() # type: Dict[str, List[float]]
+
+def count(name: str, value: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def observe(name: str, value: float):
+    with _lock:
+        _histograms.setdefault(name, []).append(value)
+
+@contextmanager
+def timer(name: str) -> Generator[None, None, None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+@contextmanager
+def span(name: str, **attributes) -> Generator[None, None, None]:
+    if _otel_trace is None:
+        with timer(name):
+            yield
+    else:
+        tracer = _otel_trace.get_tracer('dropshare')
+        with tracer.start_as_current_span(name, attributes=attributes):
+            with timer(name):
+                yield
+
+def _summary(values: List[float]) -> Dict[str, float]:
+    ordered = sorted(values)
+    rank = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+    return {'count': len(ordered), 'sum': sum(ordered),
+            'min': ordered[0], 'p50': rank(0.50), 'p95': rank(0.95), 'max': ordered[-1]}
+
+def snapshot() -> Dict[str, Dict]:
+    with _lock:
+        return {'counters': dict(_counters),
+                'histograms': dict((name, _summary(values))
+                                   for name, values in _histograms.items() if values)}
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+def report() -> List[str]:
+    """Human readable lines, for --stats."""
+    data = snapshot()
+    lines = []
+    for name, val in sorted(data['counters'].items()):
+        lines.append(f' * {name:<32} {val:>14,.0f}')
+    for name, hist in sorted(data['histograms'].items()):
+        lines.append(f' * {name:<32} {hist["count"]:>6} x  total {hist["sum"]:.3f}s'
+                     f'  p50 {hist["p50"]*1000:.1f}ms  p95 {hist["p95"]*1000:.1f}ms'
+                     f'  max {hist["max"]*1000:.1f}ms')
+    return lines
+
+def dump(path: str, command: str):
+    """Append one JSON record for this invocation to path (JSON lines)."""
+    record = {'command': command, 'pid': os.getpid(), 'time': time.time()}
+    record.update(snapshot())
+    with open(path, 'at') as stream:
+        stream.write(json.dumps(record) + '\n')
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""History migration: large blobs committed before dropshare was adopted
+become stubs.
+
+`git fast-export --no-data` streams the history into `git fast-import`;
+file modifications matching the included patterns are rewritten on the fly
+as inline stubs. Their content is read once per blob from the persistent
+`cat-file`, hashed into the object cache, where it stays, and uploaded by a
+bounded pool while the export goes on. The former branch and tag tips are
+kept under refs/dropshare/original/."""
+
+import io
+import os
+import re
+import time
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Dict, List, Optional, Tuple
+
+from . import tools, metrics
+
+class MigrationError(Exception):
+    pass
+
+class Migration(object):
+    """Rewrite the whole history, delegating storage to the Dropshare frontend."""
+
+    BACKUP = 'refs/dropshare/original/'
+
+    def __init__(self, app, includes: List[str], jobs: int = 4, queue: int = 16) -> None:
+        self.app = app
+        self.patterns = [re.compile(x) for x in filter(None, map(tools.fnmatch_normalize, includes))]
+        self.jobs = jobs
+        self._slots = threading.BoundedSemaphore(queue) # uploads waiting, the export pauses beyond
+        self._digests = dict()  # type: Dict[str, Optional[str]] # blob sha -> hexdigest, None if a stub
+        self._uploads = dict()  # type: Dict[str, Future] # hexdigest -> upload
+        self.stubs = dict()     # type: Dict[Tuple[str, str], bytes] # (hexdigest, path) -> stub
+        self.converted = 0
+
+    def matches(self, path: str) -> bool:
+        return any(x.match(path) for x in self.patterns)
+
+    def backup(self):
+        """Keep the branch and tag tips under BACKUP, unless a former backup is there."""
+        if self.app.git_input('for-each-ref', '--count=1', Migration.BACKUP).strip():
+            raise MigrationError(f' \u2717 {Migration.BACKUP} holds a former backup, delete it first: '
+                                 f'git for-each-ref --format="delete %(refname)" {Migration.BACKUP} | '
+                                 'git update-ref --stdin')
+        tips = self.app.git_input('for-each-ref', '--format=%(objectname) %(refname)', 'refs/heads', 'refs/tags')
+        commands = ''.join(f'create {Migration.BACKUP}{ref} {sha}\n'
+                           for sha, ref in (x.split(' ', 1) for x in tips.splitlines()))
+        self.app.git_input('update-ref', '--stdin', data=commands.encode())
+        tools.Console.info(f' * former branch and tag tips kept under {Migration.BACKUP}')
+
+    def run(self):
+        export = subprocess.Popen(['git', 'fast-export', '--branches', '--tags', '--no-data', '--signed-tags=strip',
+                                   '--tag-of-filtered-object=rewrite'],
+                                  cwd=self.app.toplevel_dir, stdout=subprocess.PIPE)
+        fast_import = subprocess.Popen(['git', 'fast-import', '--quiet', '--force'],
+                                       cwd=self.app.toplevel_dir, stdin=subprocess.PIPE)
+        self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+        with self._pool, metrics.timer('migrate'):
+            try:
+                self._rewrite(export.stdout, fast_import.stdin)
+            finally:
+                fast_import.stdin.close()
+                export.stdout.close()
+            if export.wait() != 0 or fast_import.wait() != 0:
+                raise MigrationError(' \u2717 fast-export | fast-import failed.')
+        failed = [x for x, future in self._uploads.items() if future.exception() is not None]
+        if failed:
+            raise MigrationError(f' \u2717 {len(failed)} objects failed to upload, e.g. {failed[0]}.')
+
+    def _rewrite(self, in_stream, out_stream):
+        for line in iter(in_stream.readline, b''):
+            if line.startswith(b'data '):
+                out_stream.write(line)
+                out_stream.write(in_stream.read(int(line[5:])))
+                continue
+            if line.startswith(b'M '):
+                mode, ref, path = line[2:].rstrip(b'\n').split(b' ', 2)
+                # quoted paths (special characters) are left alone
+                if mode in (b'100644', b'100755') and not path.startswith(b'"') and self.matches(path.decode()):
+                    hexdigest = self._convert(ref.decode(), path.decode())
+                    if hexdigest is not None:
+                        stub = self.stubs.setdefault((hexdigest, path.decode()), tools.DS_WRITE(hexdigest, path.decode()))
+                        out_stream.write(b'M %s inline %s\ndata %d\n%s\n' % (mode, path, len(stub), stub))
+                        self.converted += 1
+                        continue
+            out_stream.write(line)
+
+    def _convert(self, sha: str, path: str) -> Optional[str]:
+        if sha not in self._digests:
+            self._digests[sha] = self._store(sha, path)
+        return self._digests[sha]
+
+    def _store(self, sha: str, path: str) -> Optional[str]:
+        """Hash a blob into the object cache and queue its upload; None for stubs."""
+        _, _, size, stream = self.app.git.stream_object_data(sha)
+        if size <= tools.DS_MAX:
+            content = stream.read(size)
+            if tools.ds_stub_string(content.decode(errors='replace')):
+                return None
+            stream = io.BytesIO(content)
+        hash_function = self.app.hasher()
+        with tempfile.NamedTemporaryFile(dir=self.app.obj_directory, suffix='.tmp', delete=False) as out_stream:
+            remaining = size
+            while remaining > 0:
+                block = stream.read(min(tools.BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                hash_function.update(block)
+                out_stream.write(block)
+                remaining -= len(block)
+        hexdigest = hash_function.hexdigest()
+        location = os.path.join(self.app.obj_directory, hexdigest)
+        os.replace(out_stream.name, location)
+        metrics.count('migrate.bytes', size)
+        if self.app.dbx is not None and hexdigest not in self._uploads:
+            self._slots.acquire()
+            self._uploads[hexdigest] = self._pool.submit(self._upload, location, hexdigest, path)
+        return hexdigest
+
+    def _upload(self, location: str, hexdigest: str, path: str):
+        try:
+            if self.app.data_copy_shared([hexdigest]):
+                tools.Console.info(f' * push {path} as a server-side copy')
+                return
+            with open(location, 'rb') as in_stream:
+                self.app.data_push(in_stream, hexdigest, path)
+        finally:
+            self._slots.release()
+
+    def notes(self) -> Dict[str, bytes]:
+        """Push events of the uploaded objects, keyed by stub blob sha."""
+        uploaded = [(key, stub) for key, stub in self.stubs.items() if key[0] in self._uploads]
+        if not uploaded:
+            return dict()
+        with tempfile.TemporaryDirectory(dir=self.app.obj_directory, suffix='.tmp') as directory:
+            names = []
+            for number, (_, stub) in enumerate(uploaded):
+                names.append(os.path.join(directory, str(number)))
+                with open(names[-1], 'wb') as stream:
+                    stream.write(stub)
+            shas = self.app.git_input('hash-object', '--no-filters', '--stdin-paths',
+                                      data='\n'.join(names).encode()).split()
+        user, _ = self.app.git_identity()
+        return dict((sha, f'{time.time()}\tpush\t{hexdigest}\t{path}\t{user}\n'.encode())
+                    for sha, ((hexdigest, path), _) in zip(shas, uploaded))
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Packs of small objects.
+
+Objects below dropshare.packThreshold are concatenated into pack files,
+stored as `packs/<id>.pack` next to an index `packs/<id>.pidx` giving the
+offset and length of every object. The id is the content hash of the pack.
+Pack indexes are mirrored in the local cache, and merged there into a single
+memory-mapped file, so existence checks never reach the storage area nor
+parse every index; objects are fetched as byte ranges, or whole packs when
+most of a pack is wanted."""
+
+import os
+import json
+import heapq
+import struct
+import threading
+import posixpath
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import tools, metrics
+from .index import DIGEST_SIZE, SortedRecords
+
+PACK_DIR = 'packs'
+PACK_SUFFIX = '.pack'
+INDEX_SUFFIX = '.pidx'
+INDEX_VERSION = 1
+LOCATIONS = 'locations.idx'
+
+Entry = Tuple[str, int, int] # pack id, offset, length
+
+def pack_obj(pack_id: str) -> str:
+    return posixpath.join(PACK_DIR, pack_id + PACK_SUFFIX)
+
+def index_obj(pack_id: str) -> str:
+    return posixpath.join(PACK_DIR, pack_id + INDEX_SUFFIX)
+
+def pack_id_of(obj: str, suffix: str = INDEX_SUFFIX) -> Optional[str]:
+    """Pack id named by a stored index (or pack) object, if it is one."""
+    head, name = posixpath.split(obj)
+    if head != PACK_DIR or not name.endswith(suffix):
+        return None
+    return name[:-len(suffix)]
+
+def dump_index(pack_id: str, objects: Dict[str, Tuple[int, int]]) -> bytes:
+    return json.dumps({'version': INDEX_VERSION, 'pack': pack_id,
+                       'objects': {k: list(v) for k, v in objects.items()}}).encode()
+
+def load_index(data: bytes) -> Dict:
+    index = json.loads(data.decode())
+    if index.get('version') != INDEX_VERSION:
+        raise ValueError(f'unsupported pack index version {index.get("version")}')
+    return index
+
+def write_pack(directory: str, items: Iterable[Tuple[str, str]], hasher) -> Tuple[str, Dict[str, Tuple[int, int]]]:
+    """Concatenate the (hexdigest, file) items into directory/<id>.pack; a file
+    whose content does not match its hexdigest raises ValueError."""
+    temp = os.path.join(directory, f'pack.{os.getpid()}.tmp')
+    objects, offset = dict(), 0
+    hash_function = hasher()
+    try:
+        with open(temp, 'wb') as out_stream:
+            for hexdigest, location in items:
+                if hexdigest in objects:
+                    continue
+                entry_hash = hasher()
+                with open(location, 'rb') as in_stream:
+                    length = 0
+                    for block in tools.read_as_blocks(in_stream):
+                        hash_function.update(block)
+                        entry_hash.update(block)
+                        out_stream.write(block)
+                        length += len(block)
+                if entry_hash.hexdigest() != hexdigest:
+                    raise ValueError(f'{location} does not match {hexdigest}')
+                objects[hexdigest] = (offset, length)
+                offset += length
+    except BaseException:
+        os.unlink(temp)
+        raise
+    pack_id = hash_function.hexdigest()
+    os.replace(temp, os.path.join(directory, pack_id + PACK_SUFFIX))
+    metrics.count('packs.written')
+    metrics.count('packs.bytes', offset)
+    return pack_id, objects
+
+class PackLocations(SortedRecords):
+    """Digest, pack id, offset and length of every packed object; the tag
+    counts the pack indexes merged."""
+
+    MAGIC, VERSION = b'DSPX', 1
+    RECORD = struct.Struct(f'>{DIGEST_SIZE}s{DIGEST_SIZE}sQQ')
+
+    @staticmethod
+    def records(index: Dict) -> List[bytes]:
+        pack_id = bytes.fromhex(index['pack'])
+        return sorted(PackLocations.RECORD.pack(bytes.fromhex(hexdigest), pack_id, offset, length)
+                      for hexdigest, (offset, length) in index['objects'].items())
+
+    def find(self, hexdigest: str) -> Optional[Entry]:
+        try:
+            digest = bytes.fromhex(hexdigest)
+        except ValueError:
+            return None
+        for _, pack_id, offset, length in self._matching(digest):
+            return pack_id.hex(), offset, length
+        return None
+
+    def rebuild(self, indexes: List[Dict]):
+        with metrics.timer('packs.locations.rebuild'):
+            self._write(heapq.merge(*map(PackLocations.records, indexes)), len(indexes))
+
+    def merge(self, index: Dict):
+        self._write(heapq.merge(iter(self), PackLocations.records(index)), self.tag + 1)
+
+class PackIndex(object):
+    """Digest -> (pack id, offset, length), from the index files of a directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._entries = None # type: Optional[Dict[str, Entry]]
+        self._packs = dict() # type: Dict[str, int] # pack id -> size
+        self._locations = None # type: Optional[PackLocations]
+        self._lock = threading.Lock()
+
+    def _indexes(self) -> List[str]:
+        return [x for x in os.listdir(self.directory) if x.endswith(INDEX_SUFFIX)]
+
+    def _load(self, name: str) -> Dict:
+        with open(os.path.join(self.directory, name), 'rb') as stream:
+            return load_index(stream.read())
+
+    @property
+    def locations(self) -> PackLocations:
+        """The merged index, rebuilt when it misses some pack index."""
+        with self._lock:
+            if self._locations is None:
+                locations = PackLocations(os.path.join(self.directory, LOCATIONS))
+                names = self._indexes()
+                if not locations.available or locations.tag != len(names):
+                    locations.rebuild([self._load(x) for x in names])
+                self._locations = locations
+            return self._locations
+
+    @property
+    def entries(self) -> Dict[str, Entry]:
+        if self._entries is None:
+            self._entries = dict()
+            with metrics.timer('packs.index.load'):
+                for name in self._indexes():
+                    self._merge(self._load(name))
+        return self._entries
+
+    def _merge(self, index: Dict):
+        pack_id = index['pack']
+        for hexdigest, (offset, length) in index['objects'].items():
+            self._entries.setdefault(hexdigest, (pack_id, offset, length))
+        self._packs[pack_id] = sum(length for _, length in index['objects'].values())
+
+    def known(self, pack_id: str) -> bool:
+        return os.path.exists(os.path.join(self.directory, pack_id + INDEX_SUFFIX))
+
+    def add(self, data: bytes):
+        """Record a pack index, as uploaded or downloaded."""
+        index = load_index(data)
+        location = os.path.join(self.directory, index['pack'] + INDEX_SUFFIX)
+        known = os.path.exists(location)
+        with open(f'{location}.{os.getpid()}.tmp', 'wb') as stream:
+            stream.write(data)
+        os.replace(f'{location}.{os.getpid()}.tmp', location)
+        if self._entries is not None:
+            self._merge(index)
+        if not known:
+            with self._lock:
+                if self._locations is None:
+                    self._locations = PackLocations(os.path.join(self.directory, LOCATIONS))
+                names = self._indexes()
+                if self._locations.available and self._locations.tag + 1 == len(names):
+                    self._locations.merge(index)
+                else:
+                    self._locations.rebuild([self._load(x) for x in names])
+
+    def find(self, hexdigest: str) -> Optional[Entry]:
+        return self.locations.find(hexdigest)
+
+    def cached_pack(self, pack_id: str) -> Optional[str]:
+        location = os.path.join(self.directory, pack_id + PACK_SUFFIX)
+        return location if os.access(location, os.R_OK) else None
+
+    def whole_packs(self, hexdigests: Iterable[str], ratio: float = 0.5) -> List[str]:
+        """Packs of which at least ratio of the content is wanted, and not cached yet."""
+        wanted = dict() # type: Dict[str, int]
+        entries = self.entries # with the pack sizes
+        for hexdigest in set(hexdigests):
+            entry = entries.get(hexdigest)
+            if entry is not None:
+                wanted[entry[0]] = wanted.get(entry[0], 0) + entry[2]
+        return [x for x, size in wanted.items()
+                if size >= ratio * self._packs.get(x, 0) and self.cached_pack(x) is None]
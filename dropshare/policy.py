@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Which objects get materialized, from git config:
+
+    dropshare.fetchInclude  glob (multi-valued): only matching paths
+    dropshare.fetchExclude  glob (multi-valued): never matching paths
+    dropshare.fetchMaxSize  size, with optional k/m/g suffix
+    dropshare.fetchRecent   N: only paths touched by the last N commits
+
+Paths left out remain stubs, both on checkout and on `git ds pull`."""
+
+from typing import Callable, List, Optional, Set
+
+from . import tools
+
+IGNORE_ENV = 'GIT_DS_IGNORE_POLICY' # set by pull --ignore-policy for the filters
+UNITS = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+def parse_size(text: Optional[str]) -> Optional[int]:
+    if not text:
+        return None
+    text = text.strip().lower()
+    if text[-1:] in UNITS:
+        return int(float(text[:-1]) * UNITS[text[-1]])
+    return int(text)
+
+class FetchPolicy(object):
+
+    def __init__(self, include: List[str], exclude: List[str], max_size: Optional[int] = None,
+                 recent: Optional[Callable[[], Set[str]]] = None) -> None:
+        self.include = include
+        self.exclude = exclude
+        self.max_size = max_size
+        self._recent = recent
+        self._recent_paths = None # type: Optional[Set[str]]
+
+    @property
+    def restricted(self) -> bool:
+        return bool(self.include or self.exclude or self.max_size is not None or self._recent)
+
+    def allows(self, path: str, size: Callable[[], Optional[int]] = lambda: None) -> bool:
+        """size is only evaluated when a size limit is set."""
+        if self.include and not any(tools.path_matches_pattern(path, x) for x in self.include):
+            return False
+        if any(tools.path_matches_pattern(path, x) for x in self.exclude):
+            return False
+        if self._recent is not None:
+            if self._recent_paths is None:
+                self._recent_paths = self._recent()
+            if path not in self._recent_paths:
+                return False
+        if self.max_size is not None:
+            actual = size()
+            if actual is not None and actual > self.max_size:
+                return False
+        return True
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Long running filter process (see gitattributes(5), filter.<driver>.process).
+
+A single git-ds process serves every clean and smudge request of a git
+command. Smudge requests for objects missing from the cache are answered
+`delayed` when git allows it: the downloads run in parallel while git goes
+on with the checkout, and git collects the blobs once they are available."""
+
+import io
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from typing import IO, Dict, Iterator, List, Optional, Tuple
+
+from . import tools, metrics
+
+FLUSH = None
+MAX_PACKET = 65516
+
+class ProtocolError(Exception):
+    pass
+
+class PktLine(object):
+    """pkt-line framing, as described in gitprotocol-common(5)."""
+
+    def __init__(self, reader: IO[bytes], writer: IO[bytes]) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    def read_packet(self) -> Optional[bytes]:
+        header = self.reader.read(4)
+        if not header:
+            raise EOFError()
+        size = int(header, 16)
+        if size == 0:
+            return FLUSH
+        if size < 4:
+            raise ProtocolError(f'bad pkt-line length {header!r}')
+        return self.reader.read(size - 4)
+
+    def read_text_list(self) -> List[str]:
+        lines = []
+        while True:
+            packet = self.read_packet()
+            if packet is FLUSH:
+                return lines
+            lines.append(packet.decode().rstrip('\n'))
+
+    def read_content(self) -> Iterator[bytes]:
+        while True:
+            packet = self.read_packet()
+            if packet is FLUSH:
+                return
+            yield packet
+
+    def write_packet(self, data: bytes):
+        self.writer.write(b'%04x' % (len(data) + 4))
+        self.writer.write(data)
+
+    def flush(self):
+        self.writer.write(b'0000')
+        self.writer.flush()
+
+    def write_text(self, *lines: str):
+        for line in lines:
+            self.write_packet(f'{line}\n'.encode())
+        self.flush()
+
+    def write_content(self, stream: IO[bytes]):
+        for block in iter(lambda: stream.read(MAX_PACKET), b''):
+            self.write_packet(block)
+        self.flush()
+
+class FilterProcess(object):
+    """Protocol loop, delegating the actual work to the Dropshare frontend."""
+
+    def __init__(self, app, reader: IO[bytes], writer: IO[bytes], jobs: int = 4) -> None:
+        self.app = app
+        self.pkt = PktLine(reader, writer)
+        self.jobs = jobs
+        self.capabilities = set()  # type: set
+        self._pool = None          # type: Optional[ThreadPoolExecutor]
+        self._delayed = dict()     # type: Dict[str, Tuple[bytes, Future]]
+        self._listed = set()       # type: set
+
+    def handshake(self):
+        welcome = self.pkt.read_text_list()
+        if welcome[:1] != ['git-filter-client'] or 'version=2' not in welcome:
+            raise ProtocolError(f'unexpected handshake {welcome}')
+        self.pkt.write_text('git-filter-server', 'version=2')
+        offered = set(x.partition('=')[2] for x in self.pkt.read_text_list())
+        self.capabilities = offered & {'clean', 'smudge', 'delay'}
+        self.pkt.write_text(*(f'capability={x}' for x in sorted(self.capabilities)))
+
+    def run(self):
+        self.handshake()
+        try:
+            while True:
+                try:
+                    header = dict(x.partition('=')[::2] for x in self.pkt.read_text_list())
+                except EOFError:
+                    return
+                command = header.get('command')
+                with metrics.timer(f'filter.process.{command}'):
+                    if command == 'clean':
+                        self.clean(header['pathname'])
+                    elif command == 'smudge':
+                        self.smudge(header['pathname'], header.get('can-delay') == '1')
+                    elif command == 'list_available_blobs':
+                        self.list_available_blobs()
+                    else:
+                        self.pkt.write_text('status=error')
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+
+    def _success(self, stream: IO[bytes]):
+        self.pkt.write_text('status=success')
+        self.pkt.write_content(stream)
+        self.pkt.flush() # keep status
+
+    def clean(self, path: str):
+        with tempfile.NamedTemporaryFile(dir=self.app.obj_directory, suffix='.tmp') as spool:
+            hash_function = self.app.hasher()
+            for block in self.pkt.read_content():
+                hash_function.update(block)
+                spool.write(block)
+            spool.flush()
+            if spool.tell() <= tools.DS_MAX:
+                spool.seek(0)
+                content = spool.read()
+                if self._stub(content) is not None:
+                    self._success(io.BytesIO(content))
+                    return
+            hexdigest = hash_function.hexdigest()
+            self.app.ds_keep_object(spool.name, hexdigest)
+        self.pkt.write_text('status=success')
+        self.pkt.write_packet(tools.DS_WRITE(hexdigest, path))
+        self.pkt.flush()
+        self.pkt.flush()
+
+    def _stub(self, content: bytes) -> Optional[str]:
+        match = tools.DS_READ.fullmatch(content.strip())
+        return match.group(2).decode() if match else None
+
+    def smudge(self, path: str, can_delay: bool):
+        content = b''.join(self.pkt.read_content())
+        if path in self._delayed:
+            # second request, once the blob was announced as available
+            content, _ = self._delayed.pop(path)
+            self._listed.discard(path)
+        hexdigest = self._stub(content)
+        if hexdigest is None:
+            self._success(io.BytesIO(content))
+            return
+        cached = self.app.ds_cached_object(hexdigest)
+        if cached is None and self.app.ds_may_fetch(hexdigest, path):
+            if can_delay and 'delay' in self.capabilities:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.jobs)
+                future = self._pool.submit(self.app.ds_fetch_object, hexdigest, path)
+                self._delayed[path] = (content, future)
+                metrics.count('filter.process.delayed')
+                self.pkt.write_text('status=delayed')
+                return
+            if self.app.ds_fetch_object(hexdigest, path):
+                cached = self.app.ds_cached_object(hexdigest)
+        if cached is None:
+            self._success(io.BytesIO(content))
+        else:
+            with open(cached, 'rb') as stream:
+                self._success(stream)
+
+    def list_available_blobs(self):
+        waiting = [future for path, (_, future) in self._delayed.items() if path not in self._listed]
+        if waiting and not any(future.done() for future in waiting):
+            wait(waiting, return_when=FIRST_COMPLETED)
+        available = [path for path, (_, future) in self._delayed.items()
+                     if future.done() and path not in self._listed]
+        self._listed.update(available)
+        for path in available:
+            self.pkt.write_packet(f'pathname={path}\n'.encode())
+        self.pkt.flush()
+        self.pkt.write_text('status=success')
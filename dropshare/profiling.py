@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Per invocation profiling, driven by the environment.
+
+GIT_DS_PROFILE=<directory> makes every git-ds process (filters included)
+leave a JSON record of its wall-clock spans in that directory. With
+GIT_DS_PROFILE_MODE=cprofile, a cProfile dump is saved alongside.
+`git ds profile-report` aggregates the records of a whole checkout."""
+
+import os
+import io
+import glob
+import json
+import time
+import pstats
+import cProfile
+from contextlib import contextmanager
+from typing import Dict, List, Generator
+
+from . import metrics
+
+PROFILE_ENV = 'GIT_DS_PROFILE'
+PROFILE_MODE_ENV = 'GIT_DS_PROFILE_MODE'
+
+@contextmanager
+def profile(command: str) -> Generator[None, None, None]:
+    directory = os.environ.get(PROFILE_ENV)
+    if not directory:
+        yield
+        return
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f'{command}-{os.getpid()}-{int(time.time() * 1000)}')
+    profiler = cProfile.Profile() if os.environ.get(PROFILE_MODE_ENV) == 'cprofile' else None
+    start = time.perf_counter()
+    if profiler:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(f'{stem}.prof')
+        record = {'command': command, 'pid': os.getpid(), 'wall': time.perf_counter() - start}
+        record.update(metrics.snapshot())
+        with open(f'{stem}.json', 'wt') as stream:
+            json.dump(record, stream)
+
+def _percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+def report(directory: str, top: int = 20) -> List[str]:
+    records = []
+    for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+        try:
+            with open(path, 'rt') as stream:
+                records.append(json.load(stream))
+        except (OSError, ValueError):
+            pass
+    if not records:
+        return [f' \u2717 no profile records in {directory}.']
+
+    lines = [f' * {len(records)} invocations recorded in {directory}', '', ' = per command:']
+    walls = dict() # type: Dict[str, List[float]]
+    for record in records:
+        walls.setdefault(record['command'], []).append(record['wall'])
+    for command, values in sorted(walls.items(), key=lambda item: -sum(item[1])):
+        lines.append(f'   {command:<24} {len(values):>7} x  total {sum(values):9.3f}s'
+                     f'  mean {1000 * sum(values) / len(values):8.1f}ms'
+                     f'  p95 {1000 * _percentile(values, 0.95):8.1f}ms')
+
+    total = sum(sum(values) for values in walls.values())
+    spans = dict() # type: Dict[str, List[float]]
+    for record in records:
+        for name, hist in record.get('histograms', dict()).items():
+            spans.setdefault(name, [0, 0.0])
+            spans[name][0] += hist['count']
+            spans[name][1] += hist['sum']
+    lines.extend(['', ' = per span (share of total wall-clock time):'])
+    for name, (calls, seconds) in sorted(spans.items(), key=lambda item: -item[1][1]):
+        share = 100 * seconds / total if total else 0.0
+        lines.append(f'   {name:<32} {calls:>8} x  {seconds:9.3f}s  {share:5.1f}%')
+
+    profiles = sorted(glob.glob(os.path.join(directory, '*.prof')))
+    if profiles:
+        output = io.StringIO()
+        stats = pstats.Stats(*profiles, stream=output)
+        stats.sort_stats('cumulative').print_stats(top)
+        lines.extend(['', f' = cProfile, {len(profiles)} dumps merged:', output.getvalue()])
+    return lines
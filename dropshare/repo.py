@@ -11,17 +11,22 @@ import os
 import sys
 import re
 import time
-from typing import List, Optional, Union, Tuple, Iterable, Dict
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Union, Tuple, Iterable, Iterator, Dict, Set
 
-from . import tools
+from . import tools, metrics
 from .git import GitRepo, GitCli, GitCommandError
 from .git import GitCmd, Sha # for type checking
+from .git import EMPTY_TREE
 
 class Repo(object):
 
     ATTR_LOCS = ['.gitattributes', '.git/info/attributes']
     DS_FILT = re.compile(r'^([^\s]*)\s+filter=dropshare\s*$')
     DS_REF_NOTES = 'refs/notes/dropshare'
+    GIT_MINIMUM = (2, 29) # fetch --no-write-fetch-head
+    GIT_TYPE_FILTER = (2, 32) # rev-list --filter=object:type
 
     __instance = None # type: Optional[Repo]
     _repository = '.' # type: str # repository location
@@ -58,6 +63,124 @@ class Repo(object):
                 _, _, sha = meta.split(' ')
                 yield (fname, sha)
 
+    def git_recent_paths(self, count: int, rev: str = 'HEAD') -> Set[str]:
+        """Paths touched by the last count commits reachable from rev."""
+        try:
+            log = self.git.log(f'-n{count}', '--name-only', '--pretty=format:', rev)
+        except GitCommandError:
+            return set()
+        return set(x for x in log.split('\n') if x.strip())
+
+    def git_check_attr(self, attr: str, path: str) -> str:
+        """set, unset, unspecified or the value of attr for path."""
+        try:
+            return self.git.check_attr(attr, '--', path).rpartition(': ')[2].strip()
+        except GitCommandError:
+            return 'unspecified'
+
+    @staticmethod
+    def _subcommand(args: Tuple[str, ...]) -> str:
+        """git command of args, past the global options and their values."""
+        values = iter(args)
+        for arg in values:
+            if arg in ('-c', '-C'):
+                next(values, None)
+            elif not arg.startswith('-'):
+                return arg
+        return ''
+
+    def git_bytes(self, *args: str, data: bytes = b'', env: Optional[Dict[str, str]] = None) -> bytes:
+        """Run a git command fed with data on its standard input; raw output."""
+        metrics.count(f'git.calls.{Repo._subcommand(args)}')
+        with metrics.timer('git.subprocess'):
+            proc = subprocess.run(['git', *args], input=data, cwd=self.toplevel_dir,
+                                  env=dict(os.environ, **env) if env else None,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if proc.returncode != 0:
+            raise GitCommandError(['git', *args], proc.returncode, proc.stderr, proc.stdout)
+        return proc.stdout
+
+    def git_input(self, *args: str, data: bytes = b'', env: Optional[Dict[str, str]] = None) -> str:
+        """Run a git command fed with data on its standard input."""
+        return self.git_bytes(*args, data=data, env=env).decode()
+
+    def git_stream(self, *args: str) -> Iterator[str]:
+        """NUL separated fields of a git command (-z) output, as it runs."""
+        metrics.count(f'git.calls.{Repo._subcommand(args)}')
+        proc = subprocess.Popen(['git', *args], cwd=self.toplevel_dir,
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        pending = b''
+        try:
+            for block in iter(lambda: proc.stdout.read1(tools.BLOCK_SIZE), b''):
+                *fields, pending = (pending + block).split(b'\0')
+                for field in fields:
+                    yield field.decode(errors='surrogateescape')
+            if pending:
+                yield pending.decode(errors='surrogateescape')
+        finally:
+            proc.stdout.close()
+            proc.kill()
+            proc.wait()
+
+    def git_attr_values(self, attr: str, paths: List[str]) -> Dict[str, str]:
+        """Value of attr (as git_check_attr) for every path, with one check-attr call."""
+        if not paths:
+            return dict()
+        fields = self.git_input('check-attr', '-z', '--stdin', attr,
+                                data=b''.join(x.encode() + b'\0' for x in paths)).split('\0')
+        return dict((path, value) for path, _, value in zip(fields[0::3], fields[1::3], fields[2::3]))
+
+    def git_filtered_paths(self, paths: List[str]) -> Set[str]:
+        """Those of paths with the dropshare filter attribute, with one check-attr call."""
+        return set(path for path, value in self.git_attr_values('filter', paths).items() if value == 'dropshare')
+
+    def git_log_blobs(self, paths: List[str]) -> Iterator[Tuple[str, str, str]]:
+        """(commit, path, blob sha) for every revision of paths, newest first, in one log pass."""
+        fields = self.git_stream('log', '--raw', '-z', '--no-abbrev', '--no-renames',
+                                 '--pretty=format:%H', '--', *paths)
+        commit = None
+        for field in fields:
+            if not field:
+                continue
+            if not field.startswith(':'):
+                commit, _, field = field.partition('\n')
+                if not field:
+                    continue
+            _, _, _, sha, status = field[1:].split(' ')
+            path = next(fields)
+            if status != 'D':
+                yield (commit, path, sha)
+
+    def git_blobs(self, shas: Iterable[str], limit: Optional[int] = None) -> Dict[str, bytes]:
+        """Content of the blobs (smaller than limit) with a single cat-file --batch call."""
+        shas = list(dict.fromkeys(shas))
+        if limit is not None and shas:
+            checked = self.git_input('cat-file', '--batch-check', data='\n'.join(shas).encode())
+            shas = [fields[0] for fields in (line.split(' ') for line in checked.split('\n'))
+                    if len(fields) == 3 and fields[1] == 'blob' and int(fields[2]) < limit]
+        if not shas:
+            return dict()
+        blobs, pos = dict(), 0
+        output = self.git_bytes('cat-file', '--batch', data='\n'.join(shas).encode())
+        while pos < len(output):
+            end = output.index(b'\n', pos)
+            fields = output[pos:end].decode().split(' ')
+            if len(fields) != 3: # <sha> missing
+                pos = end + 1
+                continue
+            sha, _, size = fields
+            blobs[sha] = output[end + 1:end + 1 + int(size)]
+            pos = end + 2 + int(size)
+        return blobs
+
+    def git_changed_paths(self, rev: str, base: str = 'HEAD') -> Iterable[Tuple[str, str]]:
+        """(path, sha) of the blobs added or modified from base to rev."""
+        fields = self.git_input('diff-tree', '-r', '-z', '--no-renames', base, rev).split('\0')
+        for meta, path in zip(fields[0::2], fields[1::2]):
+            _, _, _, sha, status = meta.split(' ')
+            if status[:1] in ('A', 'M', 'T') and path:
+                yield (path, sha)
+
     def git_identity(self) -> Tuple[str, str]:
         try:
             return (self.git.config("user.name"), self.git.config("user.email"))
@@ -70,15 +193,66 @@ class Repo(object):
         except GitCommandError:
             return default
 
+    _ds_options = None # type: Optional[Dict[str, List[str]]]
+    def ds_options(self, key: str) -> List[str]:
+        """dropshare.* settings, read with a single git call per process."""
+        if self._ds_options is None:
+            self._ds_options = dict()
+            for item in (self.git_config('-z', '--get-regexp', r'^dropshare\.', default='') or '').split('\0'):
+                name, _, val = item.partition('\n')
+                if name:
+                    self._ds_options.setdefault(name.lower(), []).append(val)
+        return self._ds_options.get(key.lower(), [])
+
+    def ds_option(self, key: str, default: Optional[str] = None) -> Optional[str]:
+        values = self.ds_options(key)
+        return values[-1] if values else default
+
+    def ds_flag(self, key: str, default: bool = False) -> bool:
+        val = self.ds_option(key)
+        if val is None:
+            return default
+        return val.strip().lower() in ('true', 'yes', 'on', '1', '')
+
     # Dropshare specific
 
     def ds_stub(self, sha: Sha) -> Optional[Tuple[str, str]]:
         return tools.ds_stub_string(self.git.show(sha))
 
+    _notes_tips = dict() # type: Dict[str, str] # remote notes tips, as seen by ls-remote
+
+    def ds_notes_tip(self) -> Optional[str]:
+        try:
+            return self.git.rev_parse('--verify', '-q', Repo.DS_REF_NOTES)
+        except GitCommandError:
+            return None
+
+    def _ds_remote_notes_tip(self, remote: str) -> Optional[str]:
+        """Notes tip on remote, '' when absent, None when unknown."""
+        try:
+            listing = self.git.ls_remote(remote, Repo.DS_REF_NOTES)
+        except GitCommandError:
+            return None
+        self._notes_tips[remote] = listing.split('\t')[0].strip()
+        return self._notes_tips[remote]
+
+    def _ds_notes_contain(self, tip: str) -> bool:
+        try:
+            self.git.merge_base('--is-ancestor', tip, Repo.DS_REF_NOTES)
+        except GitCommandError:
+            return False
+        return True
+
     def ds_push_notes(self, remote='origin'):
         # tools.Console.info(f' * push ds notes to {remote}... ')
+        local = self.ds_notes_tip()
+        if local is not None and self._notes_tips.get(remote) == local:
+            metrics.count('notes.push.skipped')
+            return
         try:
             self.git.push(remote, Repo.DS_REF_NOTES)
+            if local is not None:
+                self._notes_tips[remote] = local
         except GitCommandError as exc:
             if exc.stderr:
                 if 'failed to push' in exc.stderr:
@@ -90,6 +264,11 @@ class Repo(object):
 
     def ds_pull_notes(self, remote='origin', initial=False):
         # tools.Console.info(f' * pull ds notes from {remote}...')
+        if not initial:
+            tip = self._ds_remote_notes_tip(remote)
+            if tip == '' or (tip and self._ds_notes_contain(tip)):
+                metrics.count('notes.pull.skipped')
+                return
         try:
             if initial:
                 self.git.fetch("origin", f"{Repo.DS_REF_NOTES}:{Repo.DS_REF_NOTES}")
@@ -101,6 +280,73 @@ class Repo(object):
             self.ds_notes("merge", '--strategy', 'cat_sort_uniq', f"{Repo.DS_REF_NOTES}-{remote}")
         # tools.Console.info('done')
 
+    def _ds_fetch_notes(self, remote: str) -> Optional[str]:
+        """Fetch remote notes into their per-remote ref; their tip when not merged yet."""
+        ref = f'{Repo.DS_REF_NOTES}-{remote}'
+        try:
+            # concurrent fetches: FETCH_HEAD would be shared
+            self.git_input('fetch', '--quiet', '--force', '--no-write-fetch-head', remote, f'{Repo.DS_REF_NOTES}:{ref}')
+            tip = self.git_input('rev-parse', '--verify', '-q', ref).strip()
+        except GitCommandError:
+            return None
+        return None if self._ds_notes_contain(tip) else tip
+
+    def ds_fetch_all_notes(self, remotes: List[str], jobs: int = 8) -> List[str]:
+        """Fetch the notes of all remotes concurrently, then merge them at once."""
+        with ThreadPoolExecutor(max_workers=max(1, min(jobs, len(remotes)))) as pool:
+            tips = list(dict.fromkeys(filter(None, pool.map(self._ds_fetch_notes, remotes))))
+        if tips:
+            self.ds_octopus_merge_notes(tips)
+        return tips
+
+    def ds_octopus_merge_notes(self, tips: List[str]):
+        """Merge several notes commits into refs/notes/dropshare with a single
+        fast-import commit. Every note is merged line-wise against the merge
+        base of each tip: lines added on some side are kept, lines removed on
+        some side (compaction) are dropped. Only the notes changed on some
+        remote side are read and rewritten."""
+        local = self.ds_notes_tip()
+        parents = ([local] if local else []) + tips
+        sides = dict() # type: Dict[str, List[Tuple[str, str]]] # annotated sha -> (base, tip) note blobs
+        for tip in tips:
+            base = None
+            if local:
+                try:
+                    base = self.git_input('merge-base', local, tip).strip()
+                except GitCommandError:
+                    pass
+            blobs = dict() # type: Dict[str, List[str]]
+            fields = self.git_input('diff-tree', '-r', '-z', base or EMPTY_TREE, tip).split('\0')
+            for meta, path in zip(fields[0::2], fields[1::2]):
+                _, _, src, dst, _ = meta.split(' ')
+                pair = blobs.setdefault(path.replace('/', ''), ['', ''])
+                pair[0] = src if src.strip('0') else pair[0]
+                pair[1] = dst if dst.strip('0') else pair[1]
+            for sha, (src, dst) in blobs.items():
+                if src != dst:
+                    sides.setdefault(sha, []).append((src, dst))
+        paths, current = dict(), dict() # type: Dict[str, str], Dict[str, str] # where notes live, their blob
+        for line in self.git_input('ls-tree', '-r', '-z', parents[0]).split('\0'):
+            if line and line.split('\t', 1)[1].replace('/', '') in sides:
+                meta, path = line.split('\t', 1)
+                paths[path.replace('/', '')] = path
+                if local:
+                    current[path.replace('/', '')] = meta.split(' ')[2]
+        contents = self.git_blobs(list(current.values()) + [x for pairs in sides.values()
+                                                            for pair in pairs for x in pair if x])
+        note_lines = lambda blob: set(x for x in contents.get(blob, b'').decode().split('\n') if x.strip())
+        notes = dict() # type: Dict[str, Optional[bytes]]
+        for sha, pairs in sides.items():
+            lines = note_lines(current.get(sha, ''))
+            for base, tip in pairs:
+                lines |= note_lines(tip) - note_lines(base)
+                lines -= note_lines(base) - note_lines(tip)
+            if lines:
+                notes[sha] = ('\n'.join(sorted(lines)) + '\n').encode()
+            elif sha in paths:
+                notes[sha] = None
+        self._ds_import_notes(notes, f'Notes merged from {len(tips)} remote refs', parents, paths=paths)
+
     def ds_notes(self, *args) -> str:
         return self.git.notes('--ref=dropshare', *args)
 
@@ -121,6 +367,84 @@ class Repo(object):
                 lnotes.reverse()
             yield from [x.split('\t') for x in lnotes]
 
+    def ds_notes_index(self) -> Dict[str, str]:
+        """Annotated object sha -> note blob sha, from a single notes list."""
+        try:
+            listing = self.ds_notes('list')
+        except GitCommandError:
+            return dict()
+        return dict(reversed(line.split(' ')) for line in listing.split('\n') if line.strip())
+
+    def ds_note_events(self, note: str, reverse=False) -> List[List[str]]:
+        """ds_manifest() from a note blob, read through the persistent cat-file."""
+        _, _, _, data = self.git.get_object_data(note)
+        events = [x.split('\t') for x in data.decode().strip().split('\n') if x.strip()]
+        if reverse:
+            events.reverse()
+        return events
+
+    @staticmethod
+    def _compact_note(text: str) -> str:
+        """Keep every push, but only the latest pull of an object by a given user;
+        '' when no event is left."""
+        latest = dict() # type: Dict[Tuple[str, ...], Tuple[float, str]]
+        kept = set()
+        for line in (x for x in text.split('\n') if x.strip()):
+            fields = line.split('\t')
+            try:
+                if len(fields) != 5 or fields[1] != 'pull':
+                    raise ValueError(line)
+                key, stamp = (fields[2], fields[3], fields[4]), float(fields[0])
+            except ValueError:
+                kept.add(line)
+            else:
+                if key not in latest or latest[key][0] < stamp:
+                    latest[key] = (stamp, line)
+        kept.update(line for _, line in latest.values())
+        return ''.join(x + '\n' for x in sorted(kept))
+
+    def _ds_import_notes(self, notes: Dict[str, Optional[bytes]], message: str, parents: List[str],
+                         deleteall: bool = False, paths: Optional[Dict[str, str]] = None):
+        """Write notes (annotated sha -> content, None to remove it) in a single
+        fast-import commit on refs/notes/dropshare. Notes annotate blobs, which
+        fast-import notemodify refuses: the tree is written with a 2-character
+        fanout instead, unless paths tells where a note already lives."""
+        name, email = self.git_identity()
+        stream = (f'commit {Repo.DS_REF_NOTES}\n'
+                  f'committer {name} <{email}> {int(time.time())} +0000\n').encode()
+        stream += b'data %d\n%s\n' % (len(message.encode()), message.encode())
+        if parents:
+            stream += f'from {parents[0]}\n'.encode()
+        stream += b''.join(f'merge {x}\n'.encode() for x in parents[1:])
+        if deleteall:
+            stream += b'deleteall\n'
+        for sha, data in sorted(notes.items()):
+            path = (paths or dict()).get(sha, f'{sha[:2]}/{sha[2:]}').encode()
+            if data is None:
+                stream += b'D %s\n' % path
+            else:
+                stream += b'M 100644 inline %s\ndata %d\n%s\n' % (path, len(data), data)
+        self.git_input('fast-import', '--quiet', '--force', data=stream + b'\n')
+
+    def ds_compact_notes(self) -> Tuple[int, int]:
+        """Rewrite refs/notes/dropshare with compacted notes, on top of the current
+        tip. Returns the number of lines before and after."""
+        index = self.ds_notes_index()
+        contents = self.git_blobs(index.values())
+        before = after = 0
+        notes = dict() # type: Dict[str, bytes]
+        for sha, note in index.items():
+            text = contents.get(note, b'').decode()
+            compacted = self._compact_note(text)
+            before += len([x for x in text.split('\n') if x.strip()])
+            after += compacted.count('\n')
+            if compacted: # others go with deleteall
+                notes[sha] = compacted.encode()
+        if after != before or len(notes) != len(index):
+            self._ds_import_notes(notes, f'dropshare notes compaction: {before} -> {after} events',
+                                  [self.git.rev_parse(Repo.DS_REF_NOTES)], deleteall=True)
+        return (before, after)
+
     def ds_has_note(self, sha: Sha, fname: str, hexdigest: str, path: str) -> bool:
         manifest = self.ds_manifest(sha, reverse=True)
         for _, direction, hexdigest_, _, _ in manifest:
@@ -147,6 +471,7 @@ class Repo(object):
         self.ds_pull_notes(initial=True)
         for val in ('clean', 'smudge'):
             self.git_config(f"filter.dropshare.{val}", f"git-ds filter-{val} -f %f")
+        self.git_config("filter.dropshare.process", "git-ds filter-process")
 
     DS_RE = re.compile(r'^dropshare\.([^.]+).([^.]+)=(.*)$')
     def list_credentials(self) -> Dict[str, Dict[str, str]]:
@@ -197,6 +522,22 @@ class Repo(object):
                             if regex:
                                 yield regex
 
+    def ds_changed_stubs(self, rev: str, base: str = 'HEAD') -> Iterable[Tuple[str, str, str]]:
+        """(sha, fname, hexdigest) of the stubs brought in by rev, relative to base."""
+        patterns = list(self._ds_patterns(Repo.ATTR_LOCS))
+        if not patterns:
+            return
+        pat_re = re.compile('|'.join(patterns))
+        changed = [(fname, sha) for fname, sha in self.git_changed_paths(rev, base) if pat_re.match(fname)]
+        blobs = self.git_blobs((sha for _, sha in changed), limit=tools.DS_MAX)
+        for fname, sha in changed:
+            try:
+                stub = tools.ds_stub_string(blobs[sha].decode()) if sha in blobs else None
+            except UnicodeDecodeError:
+                stub = None
+            if stub:
+                yield (sha, fname, stub[0])
+
     def filtered_by_attributes(self, match: List[str] = []) -> Iterable[Tuple[str, str, str]]:
         patterns = list(self._ds_patterns(Repo.ATTR_LOCS))
         selected = re.compile('|'.join(filter(None.__ne__, map(tools.fnmatch_normalize, match))))
@@ -221,25 +562,54 @@ class Repo(object):
     def ds_staging_objects(self):
         return set(os.listdir(self.obj_directory))
 
-    def ds_orphan_files(self) -> Iterable[Tuple[str, str]]:
-        for path in self.git.ls_files(self.toplevel_dir).split('\n'):
-            stub = tools.ds_stub_file(path)
-            if stub:
-                yield stub
+    def _ds_orphan(self, path: str) -> Optional[Tuple[str, str]]:
+        location = os.path.join(self.toplevel_dir, path)
+        try:
+            if os.stat(location).st_size > tools.DS_MAX:
+                return None
+        except OSError:
+            return None
+        stub = tools.ds_stub_file(location)
+        return (stub[0], path) if stub else None
+
+    def ds_orphan_files(self, jobs: int = 8) -> Iterable[Tuple[str, str]]:
+        """(hexdigest, path) of the working files still holding a stub. Only
+        paths tracked by dropshare rules are considered, and only files small
+        enough to be a stub are opened."""
+        patterns = list(self._ds_patterns(Repo.ATTR_LOCS))
+        if not patterns:
+            return
+        pat_re = re.compile('|'.join(patterns))
+        paths = [x for x in self.git_input('ls-files', '-z').split('\0') if x and pat_re.match(x)]
+        with ThreadPoolExecutor(max_workers=jobs) as pool:
+            yield from filter(None, pool.map(self._ds_orphan, paths))
+
+    def ds_touch(self, paths: List[str]):
+        """Make the index entries of paths stale: checkout-index --force, like
+        checkout, leaves stat-clean entries alone, stubs included. The mtime
+        goes back a second, since git may only compare whole seconds, and
+        cleans the file again when they are equal."""
+        for path in paths:
+            location = os.path.join(self.toplevel_dir, path)
+            stat = os.stat(location)
+            os.utime(location, ns=(stat.st_atime_ns, stat.st_mtime_ns - 1000000000))
 
     def ds_referenced_objects(self, full=True) -> Union[Iterable[Tuple[str, str]], Iterable[str]]:
-        for line in self.git.rev_list(objects=True, all=True).split('\n'):
+        """Stubs of the whole history, read with a batched cat-file call: rev-list
+        only lists the blobs small enough to be stubs (named, unlike commits),
+        or else cat-file --batch-check sorts them out before git 2.32."""
+        if self.git.version_info >= Repo.GIT_TYPE_FILTER:
+            listed = self.git_input('rev-list', '--objects', '--all',
+                                    f'--filter=combine:object:type=blob+blob:limit={tools.DS_MAX}')
+            limit = None
+        else:
+            listed = self.git_input('rev-list', '--objects', '--all')
+            limit = tools.DS_MAX
+        shas = (line[:40] for line in listed.split('\n') if ' ' in line)
+        for content in self.git_blobs(shas, limit=limit).values():
             try:
-                sha = line[:40]
-                _, obj_type, size = self.git.get_object_header(sha)
-                if obj_type != b'blob' or int(size) >= 250: # fixme tools.ds_stub max size
-                    continue
-            except  ValueError:
+                hexdigest, path = tools.ds_stub_string(content.decode())
+            except (UnicodeDecodeError, TypeError):
                 pass
             else:
-                try:
-                    hexdigest, path = tools.ds_stub_string(self.git.show(sha))
-                except:
-                    pass
-                else:
-                    yield (hexdigest, path) if full else hexdigest
+                yield (hexdigest, path) if full else hexdigest
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Content hashes of files, keyed by path and stat (size, mtime, inode),
+so that unchanged files are never hashed twice."""
+
+import os
+import json
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import tools, metrics
+from .hashing import DropboxContentHasher
+
+def stat_key(stat: os.stat_result) -> List[int]:
+    return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+def rehash(location: str) -> Tuple[str, Optional[str]]:
+    """Content hash of a file, run by worker processes."""
+    try:
+        return (location, tools.hash_file(location, DropboxContentHasher()))
+    except OSError:
+        return (location, None)
+
+class StatCache(object):
+
+    def __init__(self, location: str):
+        self.location = location
+        self._entries = None # type: Optional[Dict[str, List]]
+        self._dirty = False
+
+    @property
+    def entries(self) -> Dict[str, List]:
+        if self._entries is None:
+            try:
+                with open(self.location, 'rt') as stream:
+                    self._entries = json.load(stream)
+            except (OSError, ValueError):
+                self._entries = dict()
+        return self._entries
+
+    def get(self, path: str, stat: os.stat_result) -> Optional[str]:
+        entry = self.entries.get(path)
+        if entry is not None and entry[:3] == stat_key(stat):
+            return entry[3]
+        return None
+
+    def put(self, path: str, stat: os.stat_result, hexdigest: str):
+        self.entries[path] = stat_key(stat) + [hexdigest]
+        self._dirty = True
+
+    def forget(self, path: str):
+        if self.entries.pop(path, None) is not None:
+            self._dirty = True
+
+    def save(self):
+        if self._dirty:
+            with open(f'{self.location}.{os.getpid()}.tmp', 'wt') as stream:
+                json.dump(self.entries, stream)
+            os.replace(f'{self.location}.{os.getpid()}.tmp', self.location)
+            self._dirty = False
+
+    def hash_files(self, paths: Iterable[str], jobs: Optional[int] = None) -> Dict[str, Optional[str]]:
+        """Content hash of every path (None when unreadable), rehashing in
+        parallel processes only the files whose stat changed."""
+        digests, stats = dict(), dict()
+        for path in paths:
+            try:
+                stats[path] = os.stat(path)
+            except OSError:
+                digests[path] = None
+                continue
+            digests[path] = self.get(os.path.abspath(path), stats[path])
+        todo = [path for path in stats if digests[path] is None]
+        metrics.count('statcache.hits', len(stats) - len(todo))
+        if todo:
+            with ProcessPoolExecutor(max_workers=jobs) as pool, metrics.timer('statcache.rehash'):
+                for path, hexdigest in pool.map(rehash, todo, chunksize=16):
+                    digests[path] = hexdigest
+                    if hexdigest is not None:
+                        self.put(os.path.abspath(path), stats[path], hexdigest)
+        self.save()
+        return digests
@@ -11,13 +11,18 @@ import os
 import sys
 import posixpath # for Dropbox API
 import time
-import hashlib
+import threading
+import urllib.error
+import urllib.request
+from abc import ABCMeta, abstractmethod
 from contextlib import contextmanager
 from typing import List, Optional, Generator, IO, Tuple, Iterable, Dict
 
 import yaml # fixme json!
 
-from . import tools
+from . import tools, metrics, chunks, codecs, throttle
+from .index import DigestIndex
+from .hashing import DropboxContentHasher # re-exported
 
 try:
     import dropbox
@@ -25,63 +30,24 @@ except ImportError:
     tools.Console.error('fatal: "dropbox" module missing...')
     sys.exit(1)
 else:
-    from dropbox.files import WriteMode
-    from dropbox.exceptions import ApiError, HttpError
+    from dropbox.files import WriteMode, RelocationPath, UploadSessionCursor, CommitInfo
+    from dropbox.exceptions import ApiError, HttpError, RateLimitError
     from dropbox.files import FileMetadata, DeletedMetadata
 
-class DropboxContentHasher(object):
-    """ From https://github.com/dropbox/dropbox-api-content-hasher """
-    BLOCK_SIZE = 4 * 1024 * 1024
-
-    def __init__(self):
-        self._overall_hasher = hashlib.sha256()
-        self._block_hasher = hashlib.sha256()
-        self._block_pos = 0
-        self.digest_size = self._overall_hasher.digest_size
-
-    def update(self, new_data: bytes):
-        # assert isinstance(new_data, bytes), "Expecting a byte string, got {type(new_data)}"
-        new_data_pos = 0
-        while new_data_pos < len(new_data):
-            if self._block_pos == self.BLOCK_SIZE:
-                self._overall_hasher.update(self._block_hasher.digest())
-                self._block_hasher = hashlib.sha256()
-                self._block_pos = 0
-            space_in_block = self.BLOCK_SIZE - self._block_pos
-            part = new_data[new_data_pos:(new_data_pos+space_in_block)]
-            self._block_hasher.update(part)
-            self._block_pos += len(part)
-            new_data_pos += len(part)
-
-    def _finish(self):
-        if self._block_pos > 0:
-            self._overall_hasher.update(self._block_hasher.digest())
-            self._block_hasher = None
-        hasher = self._overall_hasher
-        self._overall_hasher = None  # Make sure we can't use this object anymore.
-        return hasher
-
-    def hexdigest(self) -> str:
-        return self._finish().hexdigest()
-
-    # def digest(self):
-    #     return self._finish().digest()
-
-    # def copy(self):
-    #     c = ContentHasher.__new__(ContentHasher)
-    #     c._overall_hasher = self._overall_hasher.copy()
-    #     c._block_hasher = self._block_hasher.copy()
-    #     c._block_pos = self._block_pos
-    #     return c
-
 @contextmanager
-def apply_request(message: str):
-    start = time.time()
+def apply_request(api: str):
+    start = time.perf_counter()
+    metrics.count(f'request.{api}.calls')
     try:
         yield
+    except throttle.Throttled:
+        metrics.count(f'request.{api}.errors')
+        tools.Console.info(f' \u2717 {api}: still rate limited, giving up.')
     except HttpError as err:
+        metrics.count(f'request.{api}.errors')
         tools.Console.info(f' \u2717 HTTP error {err}')
     except ApiError as err:
+        metrics.count(f'request.{api}.errors')
         if err.error.is_path() and err.error.get_path().reason.is_insufficient_space():
             tools.Console.info(' \u2717 insufficient space on account.')
         elif err.user_message_text:
@@ -90,25 +56,57 @@ def apply_request(message: str):
             tools.Console.info(f" \u2717 API error {err}\n")
         sys.exit(1)
     finally:
-        stop = time.time()
-        tools.Console.info(f' \u2713 {message} took {stop - start:.3f} seconds')
+        metrics.observe(f'request.{api}', time.perf_counter() - start)
+
+def _too_many_writes(err: ApiError) -> bool:
+    """Whether a write was refused for too_many_write_operations."""
+    try:
+        return err.error.get_path().reason.is_too_many_write_operations()
+    except AttributeError:
+        return False
 
 class HashTable(object):
     _ht = None
     _ht_ver = "1"
     _ht_loc = None
 
-    def __init__(self, gitdir: str):
+    def __init__(self, gitdir: str, area: Optional[str] = None):
+        # N.B. the table itself is loaded lazily, filters only need the index
+        # metadata of other storage areas (copy sources) live in dropshare/areas/<tag>
+        directory = os.path.join(gitdir, 'dropshare')
+        if area is not None:
+            directory = os.path.join(directory, 'areas', area)
+            os.makedirs(directory, exist_ok=True)
         self._ht = None
-        self._ht_loc = os.path.join(gitdir, 'dropshare', 'hash_table.yml')
-        self.load()
+        self._ht_loc = os.path.join(directory, 'hash_table.yml')
+        self._index = None # type: Optional[DigestIndex]
+        self._index_loc = os.path.join(directory, 'digests.idx')
+        # the filter process pulls from several threads
+        self._load_lock = threading.RLock()
+
+    @property
+    def index(self) -> DigestIndex:
+        if self._index is None:
+            with self._load_lock:
+                if self._index is None:
+                    index = DigestIndex(self._index_loc, ObjectStore.ENCODINGS)
+                    if not index.available:
+                        index.rebuild(HashTable.sizes(self.hash_table['files']))
+                    self._index = index
+        return self._index
 
     @property
     def hash_table(self):
         if self._ht is None:
-            self.load()
+            with self._load_lock:
+                if self._ht is None:
+                    self.load()
         return self._ht
 
+    @staticmethod
+    def sizes(files: Dict[str, Dict]) -> Iterable[Tuple[str, Optional[int]]]:
+        return ((obj, info.get('size')) for obj, info in files.items())
+
     @staticmethod
     def init():
         return {"version": HashTable._ht_ver,
@@ -118,6 +116,10 @@ class HashTable(object):
                 "dirs": dict(), "files": dict()}
 
     def load(self):
+        with metrics.timer('hash_table.load'):
+            self._load()
+
+    def _load(self):
         if not os.path.exists(self._ht_loc):
             self._ht = HashTable.init()
         else:
@@ -134,18 +136,74 @@ class HashTable(object):
         with open(self._ht_loc, 'wt') as stream:
             stream.write(yaml.dump(self._ht, default_flow_style=False))
 
-class Storage(HashTable):
+class ObjectStore(metaclass=ABCMeta):
+    """Storage area interface: objects are addressed by their data location
+    (see Backend.data_location), the metadata being kept in a HashTable."""
+    @abstractmethod
+    def exists(self, obj: str) -> bool: pass
+    @abstractmethod
+    def upload(self, in_stream: IO[bytes], obj: str, path: str) -> Optional[Dict]: pass
+    @abstractmethod
+    def download(self, out_stream: IO[bytes], obj: str, path: str) -> Optional[Dict]: pass
+    @abstractmethod
+    def download_range(self, obj: str, offset: int, length: int) -> Optional[bytes]: pass
+    @abstractmethod
+    def delete(self, obj: str) -> bool: pass
+    @abstractmethod
+    def delta(self) -> Tuple[bool, Dict, Dict]: pass
+
+    # an object may be stored under its data location plus one of these suffixes
+    ENCODINGS = ('', chunks.MANIFEST_SUFFIX) + tuple(codecs.SUFFIXES.values())
+
+    def locate(self, obj: str) -> Optional[str]:
+        """Name under which obj is actually stored, whatever its encoding."""
+        return self.index.locate(obj)
+
+    def size(self, stored: str) -> Optional[int]:
+        """Stored size of an object, as returned by locate(); the index
+        knows data objects, the hash table the others (packs)."""
+        size = self.index.size(stored)
+        if size is None:
+            size = self.hash_table['files'].get(stored, dict()).get('size')
+        return size
+
+class Storage(HashTable, ObjectStore):
 
     mode = WriteMode.add
 
-    def __init__(self, gitdir, root_path='', token: Optional[str] = None):
-        super().__init__(gitdir)
-        self.db_client = None
+    def __init__(self, gitdir, root_path='', token: Optional[str] = None, client=None,
+                 area: Optional[str] = None):
+        super().__init__(gitdir, area)
+        self.db_client = client
         self.db_path = '/' + posixpath.normpath(root_path.strip('/'))
-        if token:
-            self.db_client = dropbox.Dropbox(token)
-        if self.db_client:
-            self.update_id_info()
+        if token and client is None:
+            # throttling is left to the limiters, which retry outside their slot
+            self.db_client = dropbox.Dropbox(token, max_retries_on_error=0, max_retries_on_rate_limit=0)
+        self.limits = {'read': throttle.AdaptiveLimiter('read', 8),
+                       'write': throttle.AdaptiveLimiter('write', 4)}
+        self._links = dict() # type: Dict[str, Tuple[str, float]] # obj -> temporary link, expiry
+
+    def request(self, kind: str, function, *args, **kwargs):
+        """Call function under the read or write limiter, retrying when throttled."""
+        def attempt():
+            try:
+                return function(*args, **kwargs)
+            except RateLimitError as err:
+                raise throttle.Throttled(err.backoff)
+            except HttpError as err:
+                if err.status_code in (429, 503):
+                    raise throttle.Throttled()
+                raise
+            except ApiError as err:
+                if _too_many_writes(err):
+                    raise throttle.Throttled()
+                raise
+            except urllib.error.HTTPError as err:
+                if err.code in (429, 503):
+                    retry_after = err.headers.get('Retry-After')
+                    raise throttle.Throttled(float(retry_after) if retry_after else None)
+                raise
+        return self.limits[kind].run(attempt)
 
     @staticmethod
     def sharing_info(entry):  # fixme
@@ -171,6 +229,7 @@ class Storage(HashTable):
         return {'id': entry.id,
                 'rev': entry.rev,
                 'size': entry.size,
+                'content_hash': entry.content_hash,
                 'modified': entry.client_modified,
                 'sharing_info': sharing_info}
 
@@ -195,51 +254,196 @@ class Storage(HashTable):
             pass
 
     def download(self, out_stream: IO[bytes], obj: str, path: str):
-        with apply_request(f"dn {obj}"):
+        with apply_request("download"):
             with self.remote_path(obj) as remote:
-                meta = self.db_client.files_download_to_file(out_stream.name, remote)
+                meta = self.request('read', self.db_client.files_download_to_file, out_stream.name, remote)
                 out_stream.seek(0)
+                if meta:
+                    metrics.count('bytes.downloaded', meta.size)
                 return Storage.file_info(meta) if meta else None
 
+    LINK_LIFETIME = 3 * 3600 # seconds, temporary links last 4 hours
+
+    def _temporary_link(self, obj: str) -> str:
+        """Temporary link to obj, reused by the ranges of a same object."""
+        link, expiry = self._links.get(obj, (None, 0.0))
+        if link is None or expiry < time.monotonic():
+            with self.remote_path(obj) as remote:
+                link = self.request('read', self.db_client.files_get_temporary_link, remote).link
+            self._links[obj] = (link, time.monotonic() + Storage.LINK_LIFETIME)
+        return link
+
+    def download_range(self, obj: str, offset: int, length: int) -> Optional[bytes]:
+        """length bytes of obj from offset, through a temporary link; None when
+        the range is not served as such, the whole object is never read."""
+        with apply_request("download_range"):
+            link = self._temporary_link(obj)
+            request = urllib.request.Request(link, headers={'Range': f'bytes={offset}-{offset + length - 1}'})
+            def fetch() -> Optional[bytes]:
+                with urllib.request.urlopen(request) as response:
+                    return response.read() if response.status == 206 else None
+            try:
+                data = self.request('read', fetch)
+            except OSError as exc:
+                tools.Console.info(f' \u2717 ranged download failed: {exc}')
+                return None
+            if data is None:
+                tools.Console.info(f' \u2717 ranged download of {obj} not served as a range.')
+                return None
+            metrics.count('bytes.downloaded', len(data))
+            return data
+        return None
+
+    UPLOAD_BLOCK = 8 * 1024 * 1024 # bytes per upload session request
+
     def upload(self, in_stream: IO[bytes], obj: str, path: str):
-        with apply_request(f"up {obj}"):
-            data = in_stream.read() # fixme gerer barriere 150Mo
+        """Upload in_stream as obj, read by blocks of UPLOAD_BLOCK: one request
+        for a single block, an upload session beyond."""
+        with apply_request("upload"):
             with self.remote_path(obj) as remote:
-                meta = self.db_client.files_upload(data, remote, mode=Storage.mode)
+                data = in_stream.read(Storage.UPLOAD_BLOCK)
+                following = in_stream.read(Storage.UPLOAD_BLOCK) if len(data) == Storage.UPLOAD_BLOCK else b''
+                if not following:
+                    meta = self.request('write', self.db_client.files_upload, data, remote, mode=Storage.mode)
+                    uploaded = len(data)
+                else:
+                    meta, uploaded = self._upload_session(in_stream, data, following, remote)
+                metrics.count('bytes.uploaded', uploaded)
+                if meta:
+                    self._stored(obj, meta)
                 return Storage.file_info(meta) if meta else None
 
+    def _upload_session(self, in_stream: IO[bytes], data: bytes, following: bytes, remote: str):
+        """Upload data, following and the rest of in_stream through an upload
+        session, one block in memory at a time."""
+        session = self.request('write', self.db_client.files_upload_session_start, data)
+        cursor = UploadSessionCursor(session.session_id, len(data))
+        data = following
+        while True:
+            following = in_stream.read(Storage.UPLOAD_BLOCK)
+            if not following:
+                break
+            self.request('write', self.db_client.files_upload_session_append_v2, data, cursor)
+            cursor.offset += len(data)
+            data = following
+        commit = CommitInfo(remote, mode=Storage.mode)
+        meta = self.request('write', self.db_client.files_upload_session_finish, data, cursor, commit)
+        return meta, cursor.offset + len(data)
+
+    COPY_BATCH = 1000 # entries per files_copy_batch_v2
+
+    def copy_from(self, source: 'Storage', objs: List[str]) -> List[str]:
+        """Copy server-side objects stored in source, another area: batch copies
+        within a same Dropbox account, copy references across accounts.
+        Returns the objects copied."""
+        copied = []
+        own_id = self.hash_table.get('dropbox_id')
+        with apply_request("copy"):
+            if own_id is not None and own_id == source.hash_table.get('dropbox_id'):
+                for start in range(0, len(objs), Storage.COPY_BATCH):
+                    batch = objs[start:start + Storage.COPY_BATCH]
+                    entries = []
+                    for obj in batch:
+                        with source.remote_path(obj) as from_path, self.remote_path(obj) as to_path:
+                            entries.append(RelocationPath(from_path, to_path))
+                    for obj, entry in zip(batch, self._copy_batch(entries)):
+                        if entry.is_success():
+                            self._copied(obj, entry.get_success())
+                            copied.append(obj)
+            else:
+                for obj in objs:
+                    with source.remote_path(obj) as from_path, self.remote_path(obj) as to_path:
+                        try:
+                            reference = source.request('read', source.db_client.files_copy_reference_get,
+                                                       from_path).copy_reference
+                            result = self.request('write', self.db_client.files_copy_reference_save,
+                                                  reference, to_path)
+                        except ApiError as err:
+                            tools.Console.info(f' \u2717 copy of {obj} failed: {err}')
+                            continue
+                    self._copied(obj, result.metadata)
+                    copied.append(obj)
+        return copied
+
+    def _copy_batch(self, entries: List) -> List:
+        """Result entries of a files_copy_batch_v2, polling the job if needed;
+        none when the job failed, the objects being uploaded instead."""
+        try:
+            status = self.request('write', self.db_client.files_copy_batch_v2, entries)
+            if status.is_async_job_id():
+                job = status.get_async_job_id()
+                status = self.request('read', self.db_client.files_copy_batch_check_v2, job)
+                while status.is_in_progress():
+                    time.sleep(0.5)
+                    status = self.request('read', self.db_client.files_copy_batch_check_v2, job)
+        except ApiError as err:
+            tools.Console.info(f' \u2717 batch copy failed: {err}')
+            return []
+        if not status.is_complete():
+            tools.Console.info(f' \u2717 batch copy failed: {status}')
+            return []
+        return status.get_complete().entries
+
+    def _stored(self, obj: str, meta):
+        """Record an object uploaded or copied, until the next delta lists it."""
+        info = Storage.file_info(meta)
+        self.index.add(obj, info['size'])
+        self.hash_table['files'][obj] = info
+
+    def _copied(self, obj: str, meta):
+        self._stored(obj, meta)
+        metrics.count('copies')
+        metrics.count('bytes.copied', getattr(meta, 'size', 0))
+
+    def delete(self, obj: str) -> bool:
+        with apply_request("delete"):
+            with self.remote_path(obj) as remote:
+                self.request('write', self.db_client.files_delete_v2, remote)
+                self.hash_table['files'].pop(obj, None)
+                self.index.discard(obj)
+                return True
+        return False
+
     def infos(self, obj: str):
         with self.remote_path(obj) as remote:
-            return self.db_client.files_get_metadata(remote)
+            return self.request('read', self.db_client.files_get_metadata, remote)
 
     def exists(self, obj: str) -> bool:
-        return obj in self.hash_table['files']
+        return self.index.contains_obj(obj)
 
     def get_id_info(self, account_id: str):
         if "sharing" not in self.hash_table:
             self.hash_table["sharing"] = dict()
         if account_id in self.hash_table["sharing"]:
             return self.hash_table["sharing"][account_id]
-        info = Storage.account_info(self.db_client.users_get_account(account_id))
+        info = Storage.account_info(self.request('read', self.db_client.users_get_account, account_id))
         self.hash_table["sharing"][account_id] = info
         return info
 
     def update_id_info(self):
         if not self.hash_table.get("dropbox_id", None):
-            account = self.db_client.users_get_current_account()
+            account = self.request('read', self.db_client.users_get_current_account)
             self.hash_table["dropbox_id"] = account.account_id
             return self.get_id_info(account.account_id)
 
     def get_state(self, cursor_val: str):
         if cursor_val is None:
             tools.Console.info('dropshare initial synchronization!')
-            return self.db_client.files_list_folder(self.db_path, recursive=True, include_deleted=True)
-        return self.db_client.files_list_folder_continue(cursor_val)
+            return self.request('read', self.db_client.files_list_folder, self.db_path,
+                                recursive=True, include_deleted=True)
+        return self.request('read', self.db_client.files_list_folder_continue, cursor_val)
+
+    def relist(self):
+        """List the whole area again, from a new cursor."""
+        self.hash_table['cursor'] = None
+        self.hash_table['files'] = dict()
+        return self.delta()
 
     def delta(self):
+        self.update_id_info()
         cursor_previous = cursor_val = self.hash_table["cursor"]
         changes, deleted, inserted = 0, dict(), dict()
-        with apply_request(f"delta()"):
+        with apply_request("list_folder"), metrics.span('delta'):
             has_more = True
             while has_more:
                 try:
@@ -266,4 +470,9 @@ class Storage(HashTable):
         if changes > 0 and cursor_previous != cursor_val:
             self.hash_table["cursor"] = cursor_val
             self.save()
+            files = self.hash_table['files']
+            if cursor_previous is None:
+                self.index.rebuild(HashTable.sizes(files))
+            else:
+                self.index.update(HashTable.sizes(inserted), [x for x in deleted if x not in files])
         return (changes > 0, deleted, inserted)
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Adaptive concurrency of storage requests (AIMD).
+
+Every request holds a slot of its limiter (one for reads, one for writes).
+The number of slots grows by one after a window of successful requests and
+is halved when the server throttles (429, 503), all requests then pausing
+for the advertised Retry-After."""
+
+import time
+import random
+import threading
+from contextlib import contextmanager
+from typing import Generator, Optional
+
+from . import metrics
+
+DEFAULT_BACKOFF = 1.0 # seconds, without Retry-After
+MAX_BACKOFF = 60.0
+
+class Throttled(Exception):
+    """Raised by a request the server asked to retry later."""
+    def __init__(self, retry_after: Optional[float] = None):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class AdaptiveLimiter(object):
+
+    def __init__(self, name: str, maximum: int, initial: int = 2):
+        self.name = name
+        self.maximum = max(1, maximum)
+        self.limit = min(initial, self.maximum)
+        self._active = 0
+        self._successes = 0
+        self._resume_at = 0.0
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self) -> Generator[None, None, None]:
+        with self._cond:
+            while True:
+                pause = self._resume_at - time.monotonic()
+                if pause > 0:
+                    self._cond.wait(pause)
+                elif self._active >= self.limit:
+                    self._cond.wait()
+                else:
+                    break
+            self._active += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+
+    def success(self):
+        with self._cond:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def throttled(self, retry_after: Optional[float], attempt: int):
+        backoff = retry_after or min(MAX_BACKOFF, DEFAULT_BACKOFF * 2 ** attempt)
+        with self._cond:
+            self.limit = max(1, self.limit // 2)
+            self._successes = 0
+            # jitter, so that waiting requests do not all retry at once
+            self._resume_at = max(self._resume_at, time.monotonic() + backoff * random.uniform(1.0, 1.2))
+            metrics.count(f'throttle.{self.name}.throttled')
+
+    def run(self, request, retries: int = 8):
+        """Run request() within a slot, retrying when Throttled."""
+        for attempt in range(retries + 1):
+            with self.slot():
+                try:
+                    result = request()
+                except Throttled as exc:
+                    if attempt == retries:
+                        raise
+                    self.throttled(exc.retry_after, attempt)
+                    continue
+            self.success()
+            return result
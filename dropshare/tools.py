@@ -12,7 +12,9 @@ import os
 import re
 import fnmatch
 import io
+import shutil
 import socket
+import time
 from contextlib import contextmanager
 from datetime import datetime
 
@@ -22,6 +24,8 @@ from typing import Generator, Iterable, Optional, Tuple, Callable, IO
 import pytz
 import dateutil.tz
 
+from . import metrics
+
 class Hasher(metaclass=ABCMeta):
     @abstractmethod
     def update(self, bytes) -> None: pass
@@ -45,6 +49,7 @@ class Console:
 DS_HEAD = b'dropshare\n'
 DS_WRITE = lambda hexdigest, path: f'dropshare\n{path}\n{hexdigest}\n'.encode()
 DS_READ = re.compile(b'^dropshare\n([^\n]+)\n([0-9A-Za-z]+)$', re.M)
+DS_MAX = 250 # 10 + 64 + max size of path
 
 class Peeker:
     """Wrapper for stdin that implements proper peeking
@@ -93,7 +98,7 @@ from https://stackoverflow.com/questions/14283025/python-3-reading-bytes-from-st
         return self.peek(len(DS_HEAD)) == DS_HEAD
 
     def ds_stub(self) -> Optional[Tuple[str, str]]:
-        match = DS_READ.match(self.peek(250)) # 10 + 64 + max size of path
+        match = DS_READ.match(self.peek(DS_MAX))
         if match is None:
             return None
         return (match.group(2).decode(), match.group(1).decode())
@@ -150,10 +155,37 @@ def hash_cat_stream(in_stream: IO[bytes], out_stream: IO[bytes], hash_function:
 def hash_file(filename: str, hash_function: Hasher) -> str:
     if not os.path.exists(filename):
         return ''
+    start, size = time.perf_counter(), 0
     with open(filename, 'rb') as in_stream:
         for block in read_as_blocks(in_stream):
             hash_function.update(block)
-        return hash_function.hexdigest()
+            size += len(block)
+    metrics.count('hash.bytes', size)
+    metrics.observe('hash.file', time.perf_counter() - start)
+    return hash_function.hexdigest()
+
+# Linux ioctl cloning dst extents from src (btrfs, xfs, ...)
+FICLONE = 0x40049409
+TRANSFERS = ('copy', 'reflink', 'hardlink')
+def clone_file(src: str, dst: str, method: str = 'copy') -> str:
+    """Materialize src as dst (which must not exist yet) by the cheapest means
+    available: hardlink, then reflink, then plain copy. Returns the method used."""
+    if method == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            method = 'reflink'
+    if method == 'reflink':
+        try:
+            import fcntl
+            with open(src, 'rb') as in_stream, open(dst, 'wb') as out_stream:
+                fcntl.ioctl(out_stream.fileno(), FICLONE, in_stream.fileno())
+            return 'reflink'
+        except (ImportError, OSError):
+            pass
+    shutil.copyfile(src, dst)
+    return 'copy'
 
 # int(self.date.replace(tzinfo=datetime.timezone.utc).timestamp())
 # DT_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
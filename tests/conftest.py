@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+"""Throwaway repositories for the test suite.
+
+A Workspace is a work tree with its bare origin and a local storage area,
+all under tmp_path, so that no network is involved; Dropbox itself is
+stood in for by dropshare.fakebox."""
+
+import io
+import os
+import sys
+import random
+import subprocess
+from contextlib import contextmanager
+from typing import Optional
+
+import pytest
+
+from dropshare import tools, repo, front
+from dropshare.store import DropboxContentHasher
+
+pytest_plugins = ['dropshare.fakebox']
+
+def git(cwd: str, *args: str, data: bytes = None) -> str:
+    return subprocess.run(['git', *args], cwd=cwd, input=data, check=True,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE).stdout.decode()
+
+def payload(size: int, seed) -> bytes:
+    return random.Random(seed).getrandbits(8 * size).to_bytes(size, 'little') if size else b''
+
+def hexdigest(data: bytes) -> str:
+    hasher = DropboxContentHasher()
+    hasher.update(data)
+    return hasher.hexdigest()
+
+class Workspace(object):
+    """Work tree whose *.bin files are tracked by dropshare, its origin and
+    the local storage area; a clone shares the origin and the area."""
+
+    def __init__(self, root: str, name: str = 'work', origin: Optional[str] = None):
+        self.root = root
+        self.work = os.path.join(root, name)
+        self.origin = origin or os.path.join(root, 'origin.git')
+        self.area = os.path.join(root, 'area')
+        if origin is None:
+            git(root, 'init', '-q', '--bare', self.origin)
+            git(root, 'init', '-q', '-b', 'master', self.work)
+        else:
+            git(root, 'clone', '-q', '--no-checkout', self.origin, self.work)
+        for key, val in (('user.name', 'test'), ('user.email', 'test@localhost'),
+                         ('remote.origin.url', self.origin),
+                         ('remote.origin.fetch', '+refs/heads/*:refs/remotes/origin/*'),
+                         ('dropshare.account', 'test'),
+                         ('dropshare.test.backend', 'local'),
+                         ('dropshare.test.root-path', self.area),
+                         ('filter.dropshare.clean', 'git-ds filter-clean -f %f'),
+                         ('filter.dropshare.smudge', 'git-ds filter-smudge -f %f')):
+            self.git('config', key, val)
+        if origin is None:
+            self.write('.gitattributes', b'*.bin filter=dropshare\n')
+            self.git('add', '.gitattributes')
+            self.git('commit', '-q', '-m', 'dropshare rules')
+            self.git('push', '-q', 'origin', 'HEAD:refs/heads/master')
+
+    def git(self, *args: str, data: bytes = None) -> str:
+        return git(self.work, *args, data=data)
+
+    def clone(self, name: str, **config: str) -> 'Workspace':
+        """Clone checked out with the given extra settings."""
+        clone = Workspace(self.root, name, self.origin)
+        for key, val in config.items():
+            clone.git('config', key, val)
+        clone.git('reset', '-q', '--hard')
+        return clone
+
+    def path(self, fname: str) -> str:
+        return os.path.join(self.work, fname)
+
+    def write(self, fname: str, data: bytes):
+        os.makedirs(os.path.dirname(self.path(fname)), exist_ok=True)
+        with open(self.path(fname), 'wb') as stream:
+            stream.write(data)
+
+    def read(self, fname: str) -> bytes:
+        with open(self.path(fname), 'rb') as stream:
+            return stream.read()
+
+    def is_stub(self, fname: str) -> bool:
+        return tools.ds_stub_file(self.path(fname)) is not None
+
+    @property
+    def cache(self) -> str:
+        return os.path.join(self.work, '.git', 'dropshare', 'objects')
+
+    def cached(self) -> set:
+        return set(x for x in os.listdir(self.cache) if len(x) == 64) if os.path.isdir(self.cache) else set()
+
+    def stored(self) -> set:
+        return set(name for _, _, names in os.walk(self.area) for name in names)
+
+    @contextmanager
+    def app(self, **args):
+        with dropshare_app(self.work, **args) as app:
+            yield app
+
+@pytest.fixture(scope='session', autouse=True)
+def git_ds_on_path(tmp_path_factory):
+    """The filters run `git-ds`: make sure it resolves to this source tree."""
+    bindir = tmp_path_factory.mktemp('bin')
+    script = bindir / 'git-ds'
+    script.write_text(f'#!{sys.executable}\n'
+                      f'import sys\nsys.path.insert(0, {os.path.dirname(os.path.dirname(os.path.abspath(__file__)))!r})\n'
+                      'from dropshare import main\nsys.exit(main())\n')
+    script.chmod(0o755)
+    previous = os.environ['PATH']
+    os.environ['PATH'] = f'{bindir}{os.pathsep}{previous}'
+    yield str(bindir)
+    os.environ['PATH'] = previous
+
+@pytest.fixture
+def workspace(tmp_path) -> Workspace:
+    return Workspace(str(tmp_path))
+
+@contextmanager
+def dropshare_app(path: str, **args):
+    """Fresh front.Dropshare instance run from path, with its CLI arguments."""
+    cwd = os.getcwd()
+    defaults = dict((key, getattr(front.Dropshare, key)) for key in args)
+    repo.Repo._Repo__instance = None
+    repo.Repo._notes_tips.clear()
+    os.chdir(path)
+    try:
+        for key, val in args.items():
+            setattr(front.Dropshare, key, val)
+        yield front.Dropshare()
+    finally:
+        for key, val in defaults.items():
+            setattr(front.Dropshare, key, val)
+        repo.Repo._Repo__instance = None
+        os.chdir(cwd)
+
+def run_filter(app: front.Dropshare, method: str, data: bytes, fname: str) -> bytes:
+    """Feed data to a filter as git would, returning its output."""
+    stdin, stdout = sys.stdin, sys.stdout
+    output = io.BytesIO()
+    sys.stdin = io.TextIOWrapper(io.BytesIO(data))
+    sys.stdout = io.TextIOWrapper(output, write_through=True)
+    try:
+        app._filename = fname
+        getattr(app, method)()
+        sys.stdout.flush()
+        return output.getvalue()
+    finally:
+        sys.stdin, sys.stdout = stdin, stdout
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+
+import pytest
+
+from dropshare import chunks, codecs, packs
+from dropshare.back import Backend, BackendException
+from dropshare.fakebox import fake_storage_for
+from dropshare.store import Storage
+
+from conftest import payload, hexdigest
+
+def push(app, workspace, fname: str, data: bytes) -> str:
+    workspace.write(fname, data)
+    with open(workspace.path(fname), 'rb') as stream:
+        assert app.data_push(stream, hexdigest(data), fname)
+    return hexdigest(data)
+
+def pull(app, tmp_path, digest: str, fname: str) -> bytes:
+    location = tmp_path / f'pulled-{digest}'
+    with open(location, 'wb') as stream:
+        assert app.data_pull(stream, digest, fname)
+    return location.read_bytes()
+
+@pytest.fixture
+def app(workspace):
+    with workspace.app() as app:
+        yield app
+
+def stored_as(app, digest: str) -> str:
+    with Backend.data_location(digest) as obj:
+        return app.dbx.locate(obj)
+
+def test_local_round_trip(app, workspace, tmp_path):
+    data = payload(100000, 'local')
+    digest = push(app, workspace, 'a.bin', data)
+    assert stored_as(app, digest).endswith(digest)
+    assert app.data_exists(digest) and app.data_size(digest) == len(data)
+    # a second push finds the object in store
+    with open(workspace.path('a.bin'), 'rb') as stream:
+        assert not app.data_push(stream, digest, 'a.bin')
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+
+def test_local_delta_sees_other_writers(app, workspace):
+    data = payload(1000, 'other')
+    with Backend.data_location(hexdigest(data)) as obj:
+        location = os.path.join(workspace.area, *obj.split('/'))
+    os.makedirs(os.path.dirname(location))
+    with open(location, 'wb') as stream:
+        stream.write(data)
+    changed, deleted, inserted = app.dbx.delta()
+    assert changed and list(inserted) == [obj] and not deleted
+    os.unlink(location)
+    changed, deleted, inserted = app.dbx.delta()
+    assert changed and list(deleted) == [obj] and not inserted
+
+def test_missing_object(app, tmp_path):
+    with pytest.raises(BackendException):
+        pull(app, tmp_path, '0' * 64, 'a.bin')
+
+def test_fake_dropbox_round_trip(app, workspace, fake_dropbox, tmp_path):
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    data = payload(100000, 'fake')
+    digest = push(app, workspace, 'a.bin', data)
+    assert fake_dropbox.calls['files_upload'] == 1
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    # filters find objects, their encoding and size from the indexes alone
+    app.dbx.delta()
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    assert app.data_size(digest) == len(data)
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    assert app.dbx._ht is None
+
+def test_chunk_round_trip(app, workspace, tmp_path):
+    workspace.git('config', 'dropshare.chunking', 'true')
+    workspace.git('config', 'dropshare.chunkThreshold', '1000')
+    app._ds_options = None
+    data = payload(3 * chunks.MAX_SIZE // 2, 'chunks')
+    digest = push(app, workspace, 'a.bin', data)
+    assert stored_as(app, digest).endswith(chunks.MANIFEST_SUFFIX)
+    assert os.listdir(app.chunk_directory)
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    # chunks are fetched again when the local ones are gone
+    for name in os.listdir(app.chunk_directory):
+        os.unlink(os.path.join(app.chunk_directory, name))
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    # chunks are kept as long as an object referenced needs them
+    cached = sorted(os.listdir(app.chunk_directory))
+    assert digest + chunks.MANIFEST_SUFFIX in cached
+    assert app.prune_chunks({digest}) == (0, 0)
+    assert app.prune_chunks(set())[0] == len(cached)
+    assert not os.listdir(app.chunk_directory)
+
+def test_codec_attributes(app, workspace, monkeypatch, capsys):
+    workspace.git('config', 'dropshare.compression', 'zstd')
+    workspace.write('.gitattributes', b'*.bin filter=dropshare\n*.raw -dropshare-compress\n*.txt dropshare-compress\n')
+    app._ds_options = None
+    monkeypatch.setattr(codecs, 'zstandard', None)
+    app.prefetch_compress_attributes(['a.raw', 'b.txt'])
+    monkeypatch.setattr(app, 'git_check_attr', None) # read once, above
+    assert app._codec(None, 'a.raw') is None
+    assert 'unavailable' not in capsys.readouterr().err
+    assert app._codec(None, 'b.txt') == 'zlib'
+    assert 'zstd compression unavailable' in capsys.readouterr().err
+
+def test_codec_round_trip(app, workspace, tmp_path):
+    workspace.git('config', 'dropshare.compression', 'zlib')
+    app._ds_options = None
+    data = b'compressible ' * 10000
+    digest = push(app, workspace, 'a.bin', data)
+    assert stored_as(app, digest).endswith(codecs.SUFFIXES['zlib'])
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    # random data does not compress, and is stored as is
+    data = payload(100000, 'codec')
+    digest = push(app, workspace, 'b.bin', data)
+    assert stored_as(app, digest).endswith(digest)
+
+def test_codec_dictionary(app, workspace, tmp_path):
+    dictionary = b'compressible dictionary ' * 100
+    (tmp_path / 'dict').write_bytes(dictionary)
+    workspace.git('config', 'dropshare.compression', 'zlib')
+    workspace.git('config', 'dropshare.compressionDict', str(tmp_path / 'dict'))
+    app._ds_options = None
+    data = b'compressible dictionary ' * 10000
+    digest = push(app, workspace, 'a.bin', data)
+    assert stored_as(app, digest).endswith(codecs.SUFFIXES['zlib'])
+    assert stored_as(app, hexdigest(dictionary)).endswith(hexdigest(dictionary))
+    # another dictionary configured: the one recorded is fetched from the area
+    (tmp_path / 'dict').write_bytes(b'another dictionary')
+    app._dictionary, app._dictionary_hash = None, None
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    assert os.path.isfile(os.path.join(app.obj_directory, hexdigest(dictionary)))
+    # and its absence is reported as such
+    os.unlink(os.path.join(app.obj_directory, hexdigest(dictionary)))
+    app._dictionaries = None
+    with Backend.data_location(hexdigest(dictionary)) as obj:
+        assert app.dbx.delete(obj)
+    with pytest.raises(BackendException) as raised:
+        pull(app, tmp_path, digest, 'a.bin')
+    assert f'compressed with dictionary {hexdigest(dictionary)}' in raised.value.message
+
+def test_session_upload(app, workspace, fake_dropbox, tmp_path, monkeypatch):
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    monkeypatch.setattr(Storage, 'UPLOAD_BLOCK', 1000)
+    data = payload(3500, 'session')
+    digest = push(app, workspace, 'a.bin', data)
+    assert fake_dropbox.calls['files_upload_session_start'] == 1
+    assert fake_dropbox.calls['files_upload_session_append_v2'] == 2
+    assert fake_dropbox.calls['files_upload_session_finish'] == 1
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    # compressed content streams the same way
+    workspace.git('config', 'dropshare.compression', 'zlib')
+    app._ds_options = None
+    data = b''.join(payload(100, number) * 20 for number in range(10))
+    digest = push(app, workspace, 'b.bin', data)
+    assert fake_dropbox.calls['files_upload_session_start'] == 2
+    assert 'files_upload' not in fake_dropbox.calls
+    assert pull(app, tmp_path, digest, 'b.bin') == data
+
+def test_pack_round_trip(app, workspace, tmp_path):
+    items = []
+    for number in range(5):
+        data = payload(1000 + number, number)
+        workspace.write(f'{number}.bin', data)
+        items.append((workspace.path(f'{number}.bin'), hexdigest(data)))
+    assert app.data_push_packs(items) == 1
+    for location, digest in items:
+        assert app.data_exists(digest)
+        assert app.data_size(digest) == os.path.getsize(location)
+    # from the cached pack, then as a byte range of the stored one
+    with open(items[2][0], 'rb') as stream:
+        data = stream.read()
+    assert pull(app, tmp_path, items[2][1], '2.bin') == data
+    for name in os.listdir(app.pack_index.directory):
+        if name.endswith(packs.PACK_SUFFIX):
+            os.unlink(os.path.join(app.pack_index.directory, name))
+    assert pull(app, tmp_path, items[2][1], '2.bin') == data
+    # other processes read the merged index, not every pack index
+    app._pack_index = None
+    assert app.pack_index.find(items[0][1])[1:] == (0, os.path.getsize(items[0][0]))
+    assert app.pack_index._entries is None
+
+def test_hardlinks_only_from_the_cache(workspace):
+    workspace.git('config', 'dropshare.test.transfer', 'hardlink')
+    with workspace.app() as app:
+        data = payload(5000, 'hardlink')
+        digest = push(app, workspace, 'a.bin', data)
+        stored = app.dbx.remote_path(stored_as(app, digest))
+        assert not os.path.samefile(stored, workspace.path('a.bin'))
+        assert not os.stat(stored).st_mode & 0o222
+        # editing the working file leaves the store alone
+        with open(workspace.path('a.bin'), 'r+b') as stream:
+            stream.write(b'edited')
+        with open(stored, 'rb') as stream:
+            assert stream.read() == data
+        other = payload(5000, 'cached')
+        cached = os.path.join(app.obj_directory, hexdigest(other))
+        with open(cached, 'wb') as stream:
+            stream.write(other)
+        with open(cached, 'rb') as stream:
+            assert app.data_push(stream, hexdigest(other), 'b.bin')
+        assert os.path.samefile(app.dbx.remote_path(stored_as(app, hexdigest(other))), cached)
+
+def test_local_delta_lists_changed_directories_only(app, workspace, monkeypatch):
+    monkeypatch.setattr(type(app.dbx), 'RACY', 0)
+    digests = [push(app, workspace, f'{x}.bin', payload(100, x)) for x in range(20)]
+    app.dbx.delta()
+    listed = []
+    scandir = os.scandir
+    monkeypatch.setattr(os, 'scandir', lambda path: listed.append(path) or scandir(path))
+    assert app.dbx.delta() == (False, {}, {})
+    assert listed == []
+    with Backend.data_location(digests[0]) as obj:
+        os.unlink(app.dbx.remote_path(obj))
+    changed, deleted, inserted = app.dbx.delta()
+    assert changed and list(deleted) == [obj] and not inserted
+    assert listed == [os.path.dirname(app.dbx.remote_path(obj))]
+    # a whole fan-out directory removed
+    with Backend.data_location(digests[1]) as obj:
+        top = os.path.join(workspace.area, obj.split('/')[0])
+    removed = set(x for x in app.dbx.hash_table['files'] if x.startswith(obj.split('/')[0] + '/'))
+    for root, _, names in os.walk(top, topdown=False):
+        for name in names:
+            os.unlink(os.path.join(root, name))
+        os.rmdir(root)
+    changed, deleted, inserted = app.dbx.delta()
+    assert set(deleted) == removed and not set(removed) & set(app.dbx.hash_table['files'])
+
+@pytest.mark.parametrize('failing', [False, True])
+def test_copy_from_another_area(app, workspace, fake_dropbox, failing):
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    source = Storage(app.git_directory, 'upstream', client=fake_dropbox, area='upstream')
+    app._copy_sources = [source]
+    data = payload(5000, 'shared')
+    with Backend.data_location(hexdigest(data)) as obj:
+        fake_dropbox.put(f'/upstream/{obj}', data)
+    app.sync_copy_sources()
+    app.dbx.delta()
+    fake_dropbox.fail_jobs = failing
+    listings = dict(fake_dropbox.calls)
+    copied = app.data_copy_shared([hexdigest(data)])
+    assert copied == (set() if failing else {hexdigest(data)})
+    # pushes read the listings synced beforehand, a failed copy is uploaded
+    assert all(fake_dropbox.calls.get(x) == listings.get(x) for x in ('files_list_folder', 'files_list_folder_continue'))
+    if failing:
+        push(app, workspace, 'a.bin', data)
+    assert fake_dropbox.calls['files_copy_batch_v2'] == 1
+    assert fake_dropbox.calls.get('files_upload', 0) == (1 if failing else 0)
+    assert app.data_exists(hexdigest(data))
+
+@pytest.mark.parametrize('ranges', [True, False])
+def test_ranged_pull(app, workspace, fake_dropbox, tmp_path, ranges):
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    workspace.git('config', 'dropshare.rangedThreshold', '1m')
+    workspace.git('config', 'dropshare.rangeSize', '4m')
+    app._ds_options = None
+    data = payload(9 * 1024 * 1024, 'ranged')
+    digest = push(app, workspace, 'a.bin', data)
+    fake_dropbox.ranges = ranges
+    assert pull(app, tmp_path, digest, 'a.bin') == data
+    # ranges unavailable, the object is downloaded whole
+    assert fake_dropbox.calls.get('files_download', 0) == (0 if ranges else 1)
+
+def test_delta_reports_pack_index_failures(app, fake_dropbox, capsys):
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    pack_id = hexdigest(b'pack')
+    fake_dropbox.put(f'/dropshare/{packs.index_obj(pack_id)}', b'{}')
+    app.dbx.download = lambda *args: None
+    with pytest.raises(SystemExit):
+        app.ds_delta()
+    assert f'fails to download pack index {pack_id}' in capsys.readouterr().err
+
+def test_verify_relists_missing_content_hashes(app, workspace, fake_dropbox):
+    app.dbx = fake_storage_for(app.git_directory, fake_dropbox)
+    data = payload(3000, 'verify')
+    push(app, workspace, 'a.bin', data)
+    app.dbx.delta()
+    for info in app.dbx.hash_table['files'].values():
+        info['content_hash'] = None # as listed by older versions
+    assert app.verify_store() == ([], 1)
+    assert fake_dropbox.calls['files_list_folder'] == 2
+    assert 'files_get_metadata' not in fake_dropbox.calls
+
+def test_packs_reject_mismatching_files(app, workspace):
+    workspace.write('a.bin', b'content')
+    with pytest.raises(BackendException):
+        app.data_push_packs([(workspace.path('a.bin'), hexdigest(b'other'))])
+    assert not [x for x in os.listdir(app.pack_index.directory) if x.endswith('.tmp')]
@@ -0,0 +1,305 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import os
+import json
+import subprocess
+
+from dropshare import tools
+from dropshare.repo import Repo
+
+from conftest import Workspace, payload, hexdigest
+
+def commit(workspace: Workspace, files: dict, message: str = 'files'):
+    for fname, data in files.items():
+        workspace.write(fname, data)
+    workspace.git('add', *files)
+    workspace.git('commit', '-q', '-m', message)
+
+def test_push_then_clone(workspace):
+    files = dict((f'd/{x}.bin', payload(5000 + x, x)) for x in range(3))
+    commit(workspace, files)
+    assert workspace.git('show', 'HEAD:d/0.bin').startswith('dropshare\n')
+    assert workspace.cached() == set(map(hexdigest, files.values()))
+    with workspace.app() as app:
+        app.ds_push()
+    assert workspace.stored() >= set(map(hexdigest, files.values()))
+    with workspace.app() as app:
+        assert all(x[1] == 'push' for _, fname, _ in app.filtered_by_attributes()
+                   for x in app.ds_manifest(app.git.rev_parse(f'HEAD:{fname}')))
+    # a clone smudges the stubs from the storage area
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone')
+    clone.git('fetch', '-q', 'origin', 'refs/notes/dropshare:refs/notes/dropshare')
+    for fname, data in files.items():
+        assert clone.read(fname) == data
+
+def test_add(workspace):
+    files = dict((f'{x}.bin', payload(3000, x)) for x in range(4))
+    for fname, data in files.items():
+        workspace.write(fname, data)
+    workspace.write('notes.txt', b'plain text\n')
+    with workspace.app(_paths=['.']) as app:
+        app.ds_add()
+    staged = workspace.git('diff', '--cached', '--name-only').split()
+    assert sorted(staged) == sorted(list(files) + ['notes.txt'])
+    for fname, data in files.items():
+        assert tools.ds_stub_string(workspace.git('show', f':{fname}')) == (hexdigest(data), fname)
+    assert workspace.git('show', ':notes.txt') == 'plain text\n'
+    assert workspace.cached() == set(map(hexdigest, files.values()))
+    # the work tree matches the index: nothing left to add
+    assert not workspace.git('diff', '--name-only').strip()
+
+def test_add_without_file_modes(workspace):
+    workspace.git('config', 'core.fileMode', 'false')
+    commit(workspace, {'tool.bin': payload(1000, 'tool')})
+    workspace.git('update-index', '--chmod=+x', 'tool.bin')
+    workspace.write('tool.bin', payload(1000, 'edited'))
+    workspace.write('new.bin', payload(1000, 'new'))
+    os.chmod(workspace.path('new.bin'), 0o755)
+    with workspace.app(_paths=['.']) as app:
+        app.ds_add()
+    # the executable bits of the work tree are ignored, as by git add
+    modes = dict(x.split('\t')[::-1] for x in workspace.git('ls-files', '--stage').splitlines())
+    assert modes['tool.bin'].split()[0] == '100755'
+    assert modes['new.bin'].split()[0] == '100644'
+
+def test_migrate_rewrites_history(workspace):
+    first, second = payload(4000, 'first'), payload(4000, 'second')
+    commit(workspace, {'data.dat': first, 'readme.txt': b'readme\n'}, 'first')
+    commit(workspace, {'data.dat': second}, 'second')
+    workspace.git('tag', 'v1', 'HEAD~1')
+    tips = workspace.git('for-each-ref', '--format=%(objectname) %(refname)', 'refs/heads', 'refs/tags')
+    with workspace.app(_include=['*.dat']) as app:
+        assert app.ds_migrate() == 1 # not confirmed
+    assert workspace.git('rev-parse', 'HEAD:data.dat').strip() == workspace.git('hash-object', 'data.dat').strip()
+    with workspace.app(_include=['*.dat'], _yes=True) as app:
+        assert app.ds_migrate() is None
+    assert tools.ds_stub_string(workspace.git('show', 'HEAD:data.dat')) == (hexdigest(second), 'data.dat')
+    assert tools.ds_stub_string(workspace.git('show', 'v1:data.dat')) == (hexdigest(first), 'data.dat')
+    assert workspace.git('show', 'HEAD:readme.txt') == 'readme\n'
+    assert workspace.stored() >= {hexdigest(first), hexdigest(second)}
+    assert '*.dat filter=dropshare' in workspace.read('.gitattributes').decode()
+    assert workspace.read('data.dat') == second
+    # the former tips are kept
+    kept = workspace.git('for-each-ref', '--format=%(objectname) %(refname)', 'refs/dropshare/original/')
+    assert kept == tips.replace(' refs/', ' refs/dropshare/original/refs/')
+    with workspace.app(_include=['*.dat'], _yes=True) as app:
+        assert app.ds_migrate() == 1 # over a former backup
+
+def test_migrate_needs_a_clean_tree(workspace):
+    commit(workspace, {'data.dat': b'data'})
+    workspace.write('data.dat', b'changed')
+    with workspace.app(_include=['*.dat'], _yes=True) as app:
+        assert app.ds_migrate() == 1
+    assert workspace.git('show', 'HEAD:data.dat') == 'data'
+
+def test_fsck(workspace, monkeypatch):
+    files = dict((f'{x}.bin', payload(2000, x)) for x in range(3))
+    commit(workspace, files)
+    with workspace.app() as app:
+        assert app.ds_fsck() is None
+        assert sorted(app.ds_referenced_objects(full=False)) == sorted(map(hexdigest, files.values()))
+        # before git 2.32, blobs are sorted out by cat-file
+        monkeypatch.setattr(Repo, 'GIT_TYPE_FILTER', (99,))
+        assert sorted(app.ds_referenced_objects(full=False)) == sorted(map(hexdigest, files.values()))
+    # without storage area, the cache alone is checked
+    with workspace.app() as app:
+        app.dbx = None
+        assert app.ds_fsck() is None
+    spoiled = hexdigest(files['1.bin'])
+    os.chmod(os.path.join(workspace.cache, spoiled), 0o644)
+    with open(os.path.join(workspace.cache, spoiled), 'ab') as stream:
+        stream.write(b'garbage')
+    with workspace.app() as app:
+        assert app.ds_fsck() == 1
+    assert spoiled not in workspace.cached()
+    quarantine = os.path.join(workspace.work, '.git', 'dropshare', 'quarantine')
+    assert [x.split('.')[0] for x in os.listdir(quarantine)] == [spoiled]
+
+def test_checkout_smudges_cached_stubs(workspace):
+    data = payload(3000, 'cached')
+    commit(workspace, {'a.bin': data})
+    workspace.write('a.bin', tools.DS_WRITE(hexdigest(data), 'a.bin'))
+    workspace.git('add', 'a.bin') # the stub cleans to the committed blob
+    assert not workspace.git('status', '--porcelain').strip()
+    with workspace.app() as app:
+        app._checkout()
+    assert workspace.read('a.bin') == data
+
+def test_pull_materializes_stubs(workspace):
+    files = dict((f'{x}.bin', payload(3000, x)) for x in range(3))
+    commit(workspace, files)
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false'})
+    assert all(clone.is_stub(x) for x in files)
+    with clone.app() as app:
+        app.ds_pull()
+    for fname, data in files.items():
+        assert clone.read(fname) == data
+    assert not clone.git('status', '--porcelain').strip()
+
+def test_fetch_policy_keeps_stubs(workspace):
+    files = {'keep/a.bin': payload(3000, 'a'), 'skip/b.bin': payload(3000, 'b'), 'big.bin': payload(50000, 'big')}
+    commit(workspace, files)
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false', 'dropshare.fetchExclude': 'skip/*',
+                                        'dropshare.fetchMaxSize': '10k'})
+    with clone.app() as app:
+        app.ds_pull()
+    assert clone.read('keep/a.bin') == files['keep/a.bin']
+    assert clone.is_stub('skip/b.bin') and clone.is_stub('big.bin')
+    # unless the policy is ignored
+    with clone.app(_ignore_policy=True) as app:
+        app.ds_pull()
+    for fname, data in files.items():
+        assert clone.read(fname) == data
+    # checkout applies the policy too
+    other = workspace.clone('other', **{'dropshare.fetchInclude': 'keep/*'})
+    assert other.read('keep/a.bin') == files['keep/a.bin']
+    assert other.is_stub('skip/b.bin') and other.is_stub('big.bin')
+
+def test_fetch_recent_paths(workspace):
+    old, new = payload(3000, 'old'), payload(3000, 'new')
+    commit(workspace, {'old.bin': old}, 'old')
+    commit(workspace, {'new.bin': new}, 'new')
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false', 'dropshare.fetchRecent': '1'})
+    with clone.app() as app:
+        app.ds_pull()
+    assert clone.read('new.bin') == new
+    assert clone.is_stub('old.bin')
+
+def test_prefetch_then_checkout(workspace):
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false'})
+    data = payload(3000, 'feature')
+    workspace.git('checkout', '-q', '-b', 'feature')
+    commit(workspace, {'new.bin': data})
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'feature')
+    clone.git('fetch', '-q', 'origin')
+    with clone.app(_rev='origin/feature') as app:
+        app.ds_prefetch()
+    assert hexdigest(data) in clone.cached()
+    # checkout smudges from the cache, downloads being disabled
+    clone.git('checkout', '-q', '-b', 'feature', 'origin/feature')
+    assert clone.read('new.bin') == data
+
+def test_pull_through_the_filter_process(workspace):
+    files = dict((f'{x}.bin', payload(3000, x)) for x in range(3))
+    commit(workspace, files)
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false',
+                                        'filter.dropshare.process': 'git-ds filter-process'})
+    assert all(clone.is_stub(x) for x in files)
+    with clone.app() as app:
+        app.ds_pull()
+    for fname, data in files.items():
+        assert clone.read(fname) == data
+    assert not clone.git('status', '--porcelain').strip()
+
+def test_pull_keeps_environment_settings(workspace, monkeypatch, tmp_path):
+    files = {'a.bin': payload(3000, 'env')}
+    commit(workspace, files)
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false',
+                                        'filter.dropshare.process': 'git-ds filter-process'})
+    # a setting of the environment reaches the filter process run by checkout
+    monkeypatch.setenv('GIT_CONFIG_COUNT', '1')
+    monkeypatch.setenv('GIT_CONFIG_KEY_0', 'dropshare.metricsFile')
+    monkeypatch.setenv('GIT_CONFIG_VALUE_0', str(tmp_path / 'metrics.jsonl'))
+    with clone.app() as app:
+        app.ds_pull()
+    assert clone.read('a.bin') == files['a.bin']
+    records = [json.loads(x) for x in (tmp_path / 'metrics.jsonl').read_text().splitlines()]
+    assert any('bytes.downloaded' in x['counters'] for x in records if x['command'] == 'ds_filter_process')
+
+def test_log_of_several_paths(workspace, capsys):
+    revisions = [{'a.bin': payload(1000, 'a1'), 'b.bin': payload(1000, 'b1')},
+                 {'a.bin': payload(1000, 'a2')}, {'b.bin': payload(1000, 'b2')}]
+    commits = []
+    for files in revisions:
+        commit(workspace, files)
+        commits.append(workspace.git('rev-parse', 'HEAD').strip())
+        with workspace.app() as app:
+            app.ds_push()
+    sha = lambda rev, fname: workspace.git('rev-parse', f'{rev}:{fname}').strip()
+    expected = [(commits[2], 'b.bin', sha(commits[2], 'b.bin')), (commits[1], 'a.bin', sha(commits[1], 'a.bin')),
+                (commits[0], 'a.bin', sha(commits[0], 'a.bin')), (commits[0], 'b.bin', sha(commits[0], 'b.bin'))]
+    capsys.readouterr()
+    with workspace.app(_paths=['a.bin', 'b.bin']) as app:
+        assert list(app.git_log_blobs(['a.bin', 'b.bin'])) == expected
+        app.ds_log()
+    # one push per blob, newest revision first
+    logged = [x.split()[0:2] for x in capsys.readouterr().err.split(' \u2191 ')[1:]]
+    assert logged == [[f'({blob[:6]})', fname] for _, fname, blob in expected]
+
+def test_add_duplicates_and_removals(workspace):
+    data = payload(3000, 'same')
+    commit(workspace, {'old.bin': payload(100, 'old')})
+    os.unlink(workspace.path('old.bin'))
+    files = dict((f'copy{x}.bin', data) for x in range(8))
+    for fname, content in files.items():
+        workspace.write(fname, content)
+    with workspace.app(_paths=['.']) as app:
+        app.ds_add()
+    status = sorted(workspace.git('status', '--porcelain').splitlines())
+    assert status == sorted([f'A  {x}' for x in files] + ['D  old.bin'])
+    assert hexdigest(data) in workspace.cached()
+    assert not [x for x in os.listdir(workspace.cache) if x.endswith('.tmp')]
+
+def test_metrics_file(workspace, tmp_path):
+    workspace.git('config', 'dropshare.metricsFile', str(tmp_path / 'metrics.jsonl'))
+    with workspace.app() as app:
+        app.ds_metrics('push')
+    assert (tmp_path / 'metrics.jsonl').read_text().strip()
+
+def test_profile_report_needs_no_repository(tmp_path):
+    records = tmp_path / 'profile'
+    records.mkdir()
+    (records / 'one.json').write_text(json.dumps({'command': 'ds_push', 'wall': 0.5}))
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    done = subprocess.run(['git-ds', 'profile-report', str(records)], cwd=str(outside),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60)
+    assert done.returncode == 0
+    assert b'1 invocations' in done.stdout + done.stderr
+
+def test_packed_push_reads_the_committed_content(workspace):
+    workspace.git('config', 'dropshare.packThreshold', '10k')
+    files = dict((f'{x}.bin', payload(3000, x)) for x in range(3))
+    commit(workspace, files)
+    workspace.write('1.bin', b'edited after commit')
+    with workspace.app() as app:
+        app.ds_push()
+    workspace.git('push', '-q', 'origin', 'HEAD')
+    clone = workspace.clone('clone', **{'dropshare.smudgeFetch': 'false'})
+    with clone.app() as app:
+        app.ds_pull()
+    for fname, data in files.items():
+        assert clone.read(fname) == data
+
+def test_check_reports_the_git_version(workspace, monkeypatch, capsys):
+    with workspace.app() as app:
+        app.ds_check()
+        assert ' \u2713 git 2.' in capsys.readouterr().err
+        monkeypatch.setattr(Repo, 'GIT_MINIMUM', (99, 0))
+        app.ds_check()
+        assert 'dropshare needs git 99.0 or later' in capsys.readouterr().err
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import io
+import time
+
+import pytest
+from dropbox.exceptions import ApiError, RateLimitError
+from dropbox.files import CommitInfo, UploadSessionCursor
+
+from dropshare.back import Backend
+from dropshare.fakebox import FakeDropbox
+
+from conftest import payload, hexdigest
+
+def obj_of(data: bytes) -> str:
+    with Backend.data_location(hexdigest(data)) as obj:
+        return obj
+
+def test_upload_download_round_trip(fake_storage, tmp_path):
+    data = payload(70000, 'round trip')
+    obj = obj_of(data)
+    assert not fake_storage.exists(obj)
+    info = fake_storage.upload(io.BytesIO(data), obj, 'a.bin')
+    assert info['size'] == len(data) and info['content_hash'] == hexdigest(data)
+    assert fake_storage.exists(obj)
+    assert fake_storage.locate(obj) == obj and fake_storage.size(obj) == len(data)
+    with open(tmp_path / 'out', 'wb') as stream:
+        assert fake_storage.download(stream, obj, 'a.bin')
+    assert (tmp_path / 'out').read_bytes() == data
+
+def test_delta_follows_the_cursor(fake_storage, fake_dropbox):
+    first, second = payload(100, 1), payload(100, 2)
+    fake_dropbox.put(f'/dropshare/{obj_of(first)}', first)
+    changed, deleted, inserted = fake_storage.delta()
+    assert changed and list(inserted) == [obj_of(first)] and not deleted
+    assert fake_storage.exists(obj_of(first))
+    fake_dropbox.put(f'/dropshare/{obj_of(second)}', second)
+    fake_dropbox.files_delete_v2(f'/dropshare/{obj_of(first)}')
+    changed, deleted, inserted = fake_storage.delta()
+    assert list(inserted) == [obj_of(second)] and list(deleted) == [obj_of(first)]
+    assert fake_storage.exists(obj_of(second)) and not fake_storage.exists(obj_of(first))
+    assert fake_storage.delta() == (False, {}, {})
+
+def test_delta_pages(fake_storage, fake_dropbox):
+    fake_dropbox.page_size = 3
+    objs = [obj_of(payload(10, x)) for x in range(10)]
+    for obj in objs:
+        fake_dropbox.put(f'/dropshare/{obj}', b'x')
+    _, _, inserted = fake_storage.delta()
+    assert sorted(inserted) == sorted(objs)
+    assert fake_dropbox.calls['files_list_folder_continue'] == 3
+
+def test_download_range(fake_storage, fake_dropbox):
+    data = payload(10000, 'range')
+    fake_dropbox.put(f'/dropshare/{obj_of(data)}', data)
+    fake_storage.delta()
+    assert fake_storage.download_range(obj_of(data), 1000, 500) == data[1000:1500]
+    assert fake_storage.download_range(obj_of(data), 9900, 100) == data[9900:]
+    # the temporary link is reused across ranges
+    assert fake_dropbox.calls['files_get_temporary_link'] == 1
+    # a link ignoring the range is no answer
+    fake_dropbox.ranges = False
+    assert fake_storage.download_range(obj_of(data), 1000, 500) is None
+
+def test_delete(fake_storage, fake_dropbox):
+    data = payload(100, 'delete')
+    fake_storage.upload(io.BytesIO(data), obj_of(data), 'a.bin')
+    fake_storage.delta()
+    assert fake_storage.delete(obj_of(data))
+    assert fake_dropbox.calls['files_delete_v2'] == 1
+    assert obj_of(data) not in fake_storage.hash_table['files']
+    assert not fake_storage.exists(obj_of(data))
+    fake_storage.delta()
+    assert not fake_storage.exists(obj_of(data))
+
+def test_network_simulation():
+    client = FakeDropbox(latency=0.05, bandwidth=100000)
+    start = time.monotonic()
+    client.files_upload(payload(10000, 'slow'), '/slow.bin')
+    assert time.monotonic() - start >= 0.15 # latency, then 10000 bytes at 100 kB/s
+    client = FakeDropbox(rate_limit=1.0, retry_after=2.0)
+    with pytest.raises(RateLimitError) as raised:
+        client.files_upload(b'data', '/throttled.bin')
+    assert raised.value.backoff == 2.0
+    assert client.calls['files_upload'] == 1
+
+def test_upload_session_offsets():
+    client = FakeDropbox()
+    session = client.files_upload_session_start(b'abc')
+    with pytest.raises(ApiError):
+        client.files_upload_session_append_v2(b'def', UploadSessionCursor(session.session_id, 2))
+    client.files_upload_session_append_v2(b'def', UploadSessionCursor(session.session_id, 3))
+    cursor = UploadSessionCursor(session.session_id, 6)
+    assert client.files_upload_session_finish(b'g', cursor, CommitInfo('/session.bin')).size == 7
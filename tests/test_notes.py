@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import pytest
+
+from dropshare import metrics
+from dropshare.repo import Repo
+
+from conftest import Workspace
+
+def note(workspace: Workspace, sha: str, line: str):
+    workspace.git('notes', '--ref=dropshare', 'append', '-m', line, sha)
+
+def lines(workspace: Workspace, sha: str) -> list:
+    return [x for x in workspace.git('notes', '--ref=dropshare', 'show', sha).split('\n') if x]
+
+def event(stamp: int, direction: str, user: str) -> str:
+    return f'{stamp}\t{direction}\t{"0" * 64}\ta.bin\t{user}'
+
+def fetch_notes(workspace: Workspace):
+    workspace.git('fetch', '-q', 'origin', f'{Repo.DS_REF_NOTES}:{Repo.DS_REF_NOTES}')
+
+@pytest.fixture
+def annotated(workspace):
+    """Workspace with a committed a.bin, annotated once on origin; and its blob."""
+    workspace.write('a.bin', b'content')
+    workspace.git('add', 'a.bin')
+    workspace.git('commit', '-q', '-m', 'a.bin')
+    sha = workspace.git('rev-parse', 'HEAD:a.bin').strip()
+    note(workspace, sha, event(1, 'push', 'base'))
+    workspace.git('push', '-q', 'origin', 'HEAD', Repo.DS_REF_NOTES)
+    return workspace, sha
+
+def test_octopus_merge_unions_additions(annotated):
+    workspace, sha = annotated
+    remotes = []
+    for name, stamp in (('one', 2), ('two', 3)):
+        clone = workspace.clone(name)
+        fetch_notes(clone)
+        note(clone, sha, event(stamp, 'pull', name))
+        workspace.git('remote', 'add', name, clone.work)
+        remotes.append(name)
+    note(workspace, sha, event(4, 'pull', 'local'))
+    with workspace.app() as app:
+        assert len(app.ds_fetch_all_notes(remotes)) == 2
+    assert lines(workspace, sha) == [event(1, 'push', 'base'), event(2, 'pull', 'one'),
+                                     event(3, 'pull', 'two'), event(4, 'pull', 'local')]
+    # the merge commit has the local tip and both remote tips as parents
+    assert len(workspace.git('rev-list', '--parents', '-n1', Repo.DS_REF_NOTES).split()) == 4
+    with workspace.app() as app:
+        assert app.ds_fetch_all_notes(remotes) == []
+
+def test_compact_keeps_pushes_and_latest_pulls(annotated):
+    workspace, sha = annotated
+    for stamp in (2, 3, 4):
+        note(workspace, sha, event(stamp, 'pull', 'user'))
+    note(workspace, sha, event(5, 'pull', 'other'))
+    with workspace.app() as app:
+        assert app.ds_compact_notes() == (5, 3)
+        assert app.ds_compact_notes() == (3, 3)
+    assert lines(workspace, sha) == [event(1, 'push', 'base'), event(4, 'pull', 'user'), event(5, 'pull', 'other')]
+
+def test_octopus_merge_keeps_compaction(annotated):
+    workspace, sha = annotated
+    for stamp in (2, 3):
+        note(workspace, sha, event(stamp, 'pull', 'user'))
+    workspace.git('push', '-q', 'origin', Repo.DS_REF_NOTES)
+    remotes = []
+    for name, stamp in (('one', 5), ('two', 6)):
+        clone = workspace.clone(name)
+        fetch_notes(clone)
+        note(clone, sha, event(stamp, 'pull', name))
+        if name == 'one':
+            with clone.app() as app:
+                app.ds_compact_notes()
+        workspace.git('remote', 'add', name, clone.work)
+        remotes.append(name)
+    note(workspace, sha, event(7, 'pull', 'local'))
+    with workspace.app() as app:
+        assert len(app.ds_fetch_all_notes(remotes)) == 2
+    # the line compacted away on one side does not come back
+    assert lines(workspace, sha) == [event(1, 'push', 'base'), event(3, 'pull', 'user'), event(5, 'pull', 'one'),
+                                     event(6, 'pull', 'two'), event(7, 'pull', 'local')]
+
+def test_compact_drops_empty_notes(annotated):
+    workspace, sha = annotated
+    empty = workspace.git('rev-parse', 'HEAD').strip()
+    workspace.git('notes', '--ref=dropshare', 'add', '--allow-empty', '-m', ' ', empty)
+    assert Repo._compact_note('\n \n') == ''
+    with workspace.app() as app:
+        assert app.ds_compact_notes() == (1, 1)
+    listed = workspace.git('notes', '--ref=dropshare', 'list').splitlines()
+    assert [x.split()[1] for x in listed] == [sha]
+
+def skipped(name: str) -> float:
+    return metrics.snapshot()['counters'].get(f'notes.{name}.skipped', 0)
+
+def test_pull_notes_without_remote_notes(workspace):
+    metrics.reset()
+    with workspace.app() as app:
+        app.ds_pull_notes()
+        assert app.ds_notes_tip() is None
+    assert skipped('pull') == 1
+
+def test_pull_notes_compares_tips(annotated):
+    workspace, sha = annotated
+    metrics.reset()
+    with workspace.app() as app:
+        app.ds_pull_notes()
+    assert skipped('pull') == 1
+    # remote ahead
+    clone = workspace.clone('clone')
+    fetch_notes(clone)
+    note(clone, sha, event(2, 'pull', 'clone'))
+    clone.git('push', '-q', 'origin', Repo.DS_REF_NOTES)
+    with workspace.app() as app:
+        app.ds_pull_notes()
+    assert skipped('pull') == 1
+    assert lines(workspace, sha) == [event(1, 'push', 'base'), event(2, 'pull', 'clone')]
+
+def test_push_notes_compares_tips(annotated):
+    workspace, sha = annotated
+    metrics.reset()
+    with workspace.app() as app:
+        app.ds_pull_notes()
+        app.ds_push_notes()
+        assert skipped('push') == 1
+        note(workspace, sha, event(2, 'pull', 'local'))
+        app.ds_push_notes()
+        assert skipped('push') == 1
+    remote = workspace.git('ls-remote', 'origin', Repo.DS_REF_NOTES).split('\t')[0]
+    assert remote == workspace.git('rev-parse', Repo.DS_REF_NOTES).strip()
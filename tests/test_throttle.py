@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2018 Philippe Audebaud <paudebau@gmail.com>
+
+# This software falls under the GNU general public license, version 3 or later.
+# It comes WITHOUT ANY WARRANTY WHATSOEVER.
+# You should have received a copy of the license with the software.
+# If not, see http://www.gnu.org/licenses/gpl-3.0.html
+
+import pytest
+
+from dropshare import metrics
+from dropshare.store import Storage
+
+@pytest.mark.parametrize('fake_dropbox', [dict(retry_after=0.01)], indirect=True)
+def test_rate_limits_halve_then_grow_back(fake_storage, fake_dropbox):
+    metrics.reset()
+    limiter = fake_storage.limits['read']
+    limiter.maximum = limiter.limit = 8
+    fake_dropbox.throttle(2)
+    fake_storage.request('read', fake_dropbox.files_list_folder, '/dropshare')
+    assert limiter.limit == 2
+    assert metrics.snapshot()['counters']['throttle.read.throttled'] == 2
+    for _ in range(20):
+        fake_storage.request('read', fake_dropbox.files_list_folder, '/dropshare')
+    assert limiter.limit == 7
+
+def test_sdk_retries_are_disabled(tmp_path):
+    client = Storage(str(tmp_path), 'dropshare', token='token').db_client
+    assert client._max_retries_on_rate_limit == 0 and client._max_retries_on_error == 0